@@ -0,0 +1,417 @@
+# Benchmark of the transform_db steps on synthetic data
+#
+# - a dedicated PostgreSQL database ([benchmark] database in config.ini, on the server of the [database] section) is
+#   (re)created with a minimal legacy schema (biodiv.taxon, commontaxa, media, occurence, ...) filled at the requested
+#   scale
+# - pygbif is pointed to a local stand-in of the GBIF API, serving a synthetic backbone (a regular tree of names
+#   matching the generated taxa), vernacular names and a GRIIS-like checklist, with a configurable latency
+# - each transform_db step is run and timed: items (names, taxa...) per second, number of SQL statements issued and
+#   number of GBIF requests
+#
+# Results are saved as JSON (one file per run, named after the current commit) so runs can be compared:
+#
+#   python benchmark.py --taxa 20000 --latency-ms 20
+#   python benchmark.py --taxa 20000 --latency-ms 20 --compare benchmark_results/<previous run>.json
+import argparse
+import configparser
+import csv
+import datetime
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import helpers
+from helpers import execute_sql_from_file, execute_sql_from_jinja_string, get_database_connection, get_config, \
+    setup_log_file, get_statements_count
+from metrics import metrics
+from transform_db import STEPS, ANNEX_FILE_PATH
+
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+LOG_FILE_PATH = "./logs/benchmark.log"
+RESULTS_DIRECTORY = os.path.join(__location__, "benchmark_results")
+
+BENCHMARK_DEFAULT_DATABASE = 'speciesbim_benchmark'
+
+# Synthetic GBIF Backbone: a regular tree, each taxon has GENUS_SIZE children
+RANKS = ['KINGDOM', 'PHYLUM', 'CLASS', 'ORDER', 'FAMILY', 'GENUS', 'SPECIES']
+GENUS_SIZE = 10
+# keys of the taxa of rank RANKS[level]: (level + 1) * KEY_LEVEL_OFFSET + index
+KEY_LEVEL_OFFSET = 100000000
+# one species in SYNONYM_EVERY is a synonym of the previous one
+SYNONYM_EVERY = 20
+# one species in EXOTIC_EVERY is listed in the synthetic GRIIS checklist
+EXOTIC_EVERY = 7
+# one taxon in UNMATCHED_EVERY has a name unknown to the backbone (see benchmark_populate_legacy_schema.sql)
+UNMATCHED_EVERY = 25
+VERNACULAR_NAME_SOURCES = [f"Synthetic checklist {i}" for i in range(5)]
+BACKBONE_PUB_DATE = '2023-08-28T00:00:00.000+0000'
+
+# What is counted for each step (to compute the throughput): (item type, query, counted before or after the step)
+STEP_ITEMS = {
+    'prepare': ('taxa', """SELECT COUNT(*) FROM biodiv.taxon""", 'before'),
+    '2': ('names', """SELECT COUNT(*) FROM scientificname""", 'after'),
+    '3': ('annex entries', """SELECT COUNT(*) FROM annexscientificname""", 'after'),
+    '4': ('names', """SELECT COUNT(*) FROM scientificname WHERE "lastMatched" IS NOT NULL""", 'after'),
+    '5': ('taxa', """SELECT COUNT(*) FROM taxonomy""", 'after'),
+    '6': ('taxa', """SELECT COUNT(*) FROM taxonomy""", 'after')
+}
+
+
+class SyntheticBackbone(object):
+    """ Names and taxa served by the GBIF stand-in, for n_species species """
+
+    def __init__(self, n_species):
+        self.n_species = n_species
+
+    @staticmethod
+    def key(level, index):
+        return (level + 1) * KEY_LEVEL_OFFSET + index
+
+    @staticmethod
+    def _level_and_index(key):
+        return key // KEY_LEVEL_OFFSET - 1, key % KEY_LEVEL_OFFSET
+
+    def _exists(self, level, index):
+        return 0 <= level < len(RANKS) and 0 <= index <= self.n_species // GENUS_SIZE ** (len(RANKS) - 1 - level)
+
+    @staticmethod
+    def _canonical_name(level, index):
+        if RANKS[level] == 'SPECIES':
+            return f"Genus{index // GENUS_SIZE} species{index}"
+        return f"{RANKS[level].capitalize()}{index}"
+
+    @staticmethod
+    def _authorship(level, index):
+        return f"Author{index % 50}, 1900" if RANKS[level] == 'SPECIES' else ''
+
+    def name_usage(self, key):
+        level, index = self._level_and_index(key)
+        if not self._exists(level, index):
+            return None
+        canonical_name = self._canonical_name(level, index)
+        authorship = self._authorship(level, index)
+        usage = {'key': key,
+                 'nubKey': key,
+                 'scientificName': f"{canonical_name} {authorship}".strip(),
+                 'canonicalName': canonical_name,
+                 'authorship': authorship,
+                 'rank': RANKS[level],
+                 'taxonomicStatus': 'ACCEPTED',
+                 'kingdom': f"Kingdom{index // GENUS_SIZE ** level}"}
+        if level > 0:
+            usage['parentKey'] = self.key(level - 1, index // GENUS_SIZE)
+        if RANKS[level] == 'SPECIES' and index % SYNONYM_EVERY == 1:
+            usage['taxonomicStatus'] = 'SYNONYM'
+            usage['acceptedKey'] = self.key(level, index - 1)
+        return usage
+
+    def match(self, name):
+        m = re.match(r'^Genus\d+ species(\d+)( |$)', name or '')
+        if m is None:
+            m_higher = re.match(r'^([A-Z][a-z]+)(\d+)$', name or '')
+            if m_higher is None or m_higher.group(1).upper() not in RANKS:
+                return {'matchType': 'NONE', 'confidence': 100, 'synonym': False}
+            level, index = RANKS.index(m_higher.group(1).upper()), int(m_higher.group(2))
+        else:
+            level, index = len(RANKS) - 1, int(m.group(1))
+        usage = self.name_usage(self.key(level, index))
+        if usage is None:
+            return {'matchType': 'NONE', 'confidence': 100, 'synonym': False}
+        match = {'usageKey': usage['key'],
+                 'scientificName': usage['scientificName'],
+                 'canonicalName': usage['canonicalName'],
+                 'rank': usage['rank'],
+                 'status': usage['taxonomicStatus'],
+                 'confidence': 99,
+                 'matchType': 'EXACT',
+                 'synonym': 'acceptedKey' in usage,
+                 'kingdom': usage['kingdom']}
+        if 'acceptedKey' in usage:
+            match['acceptedUsageKey'] = usage['acceptedKey']
+        return match
+
+    def vernacular_names(self, key):
+        level, index = self._level_and_index(key)
+        if not self._exists(level, index):
+            return []
+        source = VERNACULAR_NAME_SOURCES[index % len(VERNACULAR_NAME_SOURCES)]
+        canonical_name = self._canonical_name(level, index)
+        names = [{'taxonKey': key, 'vernacularName': f"{canonical_name} ({language})", 'language': language,
+                  'source': source}
+                 for language in ('fra', 'nld', 'eng', 'deu')]
+        # higher taxa: english only
+        return names if RANKS[level] == 'SPECIES' else names[2:3]
+
+    def checklist(self):
+        level = len(RANKS) - 1
+        return [{'key': 900000000 + index, 'nubKey': self.key(level, index), 'origin': 'SOURCE',
+                 'scientificName': self._canonical_name(level, index)}
+                for index in range(0, self.n_species + 1, EXOTIC_EVERY)]
+
+
+def _page(records, query):
+    offset = int(query.get('offset', ['0'])[0])
+    limit = int(query.get('limit', ['20'])[0])
+    return {'offset': offset, 'limit': limit, 'endOfRecords': offset + limit >= len(records), 'count': len(records),
+            'results': records[offset:offset + limit]}
+
+
+class GbifStandInHandler(BaseHTTPRequestHandler):
+    """ Answers the GBIF API requests made by our scripts (through pygbif) """
+
+    def log_message(self, format, *args):
+        pass
+
+    def _route(self, path, query):
+        # returns (endpoint name used for the statistics, response body or None for 404)
+        backbone = self.server.backbone
+        parts = path.strip('/').split('/')[1:]  # without the "v1" prefix
+        if parts == ['species', 'match']:
+            return 'species/match', backbone.match(query.get('name', [''])[0])
+        if parts == ['species'] and 'datasetKey' in query:
+            return 'species?datasetKey', _page(self.server.checklist, query)
+        if len(parts) == 2 and parts[0] == 'species':
+            return 'species/{key}', backbone.name_usage(int(parts[1]))
+        if len(parts) == 3 and parts[0] == 'species' and parts[2] == 'vernacularNames':
+            return 'species/{key}/vernacularNames', _page(backbone.vernacular_names(int(parts[1])), query)
+        if parts == ['dataset', 'suggest']:
+            title = query.get('q', [''])[0]
+            return 'dataset/suggest', [{'key': str(uuid.uuid5(uuid.NAMESPACE_URL, title)), 'title': title}]
+        if len(parts) == 2 and parts[0] == 'dataset':
+            return 'dataset/{key}', {'key': parts[1], 'pubDate': BACKBONE_PUB_DATE}
+        return 'unknown', None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        endpoint, body = self._route(url.path, parse_qs(url.query))
+        time.sleep(self.server.latency)
+        with self.server.requests_lock:
+            self.server.requests[endpoint] = self.server.requests.get(endpoint, 0) + 1
+
+        payload = json.dumps(body if body is not None else {'error': 'not found'}).encode('utf-8')
+        self.send_response(200 if body is not None else 404)
+        # pygbif requires this exact content-type
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_gbif_stand_in(backbone, latency):
+    """ Start the GBIF stand-in (in a background thread) and point pygbif to it. Returns the server. """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), GbifStandInHandler)
+    server.daemon_threads = True
+    server.backbone = backbone
+    server.checklist = backbone.checklist()
+    server.latency = latency
+    server.requests = {}
+    server.requests_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # each pygbif module has its own copy of gbif_baseurl (from pygbif.gbifutils import *)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1/"
+    for name, module in list(sys.modules.items()):
+        if name.startswith('pygbif') and hasattr(module, 'gbif_baseurl'):
+            module.gbif_baseurl = base_url
+    return server
+
+
+def write_benchmark_config(config_parser, database):
+    """ Write the configuration used by the steps during the benchmark and make helpers.get_config() read it
+
+    It's the current configuration (workers, batch sizes...: what we want to benchmark), with the benchmark database and
+    without limits, demo mode, rate limit, cache or checklist snapshot (so that all requests reach the GBIF stand-in) """
+    benchmark_config = configparser.RawConfigParser()
+    benchmark_config.read_dict(config_parser)
+    overrides = {'database': {'dbname': database, 'schema': 'biodiv'},
+                 'demo_mode': {'demo': 'False'},
+                 'gbif_cache': {'enabled': 'False'},
+                 'deduplicate_taxon': {'detect-duplicates': 'True'},
+                 'transform_db': {'scientificnames-limit': ''},
+                 'gbif_match': {'scientificnames-limit': '', 'backend': 'api', 'max-requests-per-second': ''},
+                 'vernacular_names': {'taxa-limit': ''},
+                 'exotic_status': {'snapshot': 'False', 'checklist-archive': ''},
+                 'annex_scientificname': {'taxa-limit': ''}}
+    for section, values in overrides.items():
+        if not benchmark_config.has_section(section):
+            benchmark_config.add_section(section)
+        for key, value in values.items():
+            benchmark_config.set(section, key, value)
+
+    fd, path = tempfile.mkstemp(prefix='benchmark_', suffix='.ini')
+    with os.fdopen(fd, 'w') as f:
+        benchmark_config.write(f)
+    helpers.CONFIG_FILE_PATH = path
+    return path
+
+
+def _read_annex_codes(path):
+    with open(path) as csvfile:
+        annex_data = csv.reader(csvfile)
+        next(annex_data)
+        return sorted({row[0] for row in annex_data})
+
+
+def create_benchmark_database(config_parser, database):
+    """ (Re)create the benchmark database, with the legacy schema and its synthetic content """
+    if not re.match(r'^\w+$', database):
+        raise Exception(f"Invalid benchmark database name: {database}")
+    if database == config_parser.get('database', 'dbname'):
+        raise Exception("The benchmark database must not be the database of the [database] section")
+
+    # connected to the database of the [database] section to create the benchmark database
+    conn = get_database_connection()
+    execute_sql_from_jinja_string(conn, """DROP DATABASE IF EXISTS {{ database | sqlsafe }}""",
+                                  context={'database': database})
+    execute_sql_from_jinja_string(conn, """CREATE DATABASE {{ database | sqlsafe }}""", context={'database': database})
+    conn.close()
+
+
+def populate_benchmark_database(conn, n_taxa, n_duplicates, occurrences_per_species):
+    execute_sql_from_file(conn, 'benchmark_create_legacy_schema.sql')
+    execute_sql_from_file(conn, 'benchmark_populate_legacy_schema.sql',
+                          {'n_taxa': n_taxa,
+                           'n_duplicates': n_duplicates,
+                           'genus_size': GENUS_SIZE,
+                           'unmatched_every': UNMATCHED_EVERY,
+                           'occurrences_per_species': occurrences_per_species,
+                           'annex_codes': _read_annex_codes(ANNEX_FILE_PATH)})
+
+
+def _count(conn, sql_string):
+    return execute_sql_from_jinja_string(conn, sql_string).fetchone()[0]
+
+
+def run_steps(conn, config_parser, gbif_stand_in):
+    """ Run and time all the transform_db steps. Returns a list of results (dicts), one per step """
+    results = []
+    for step, message, function in STEPS:
+        print(message)
+        logging.info(message)
+        item_type, count_sql, count_when = STEP_ITEMS.get(step, (None, None, None))
+        n_items = _count(conn, count_sql) if count_when == 'before' else None
+        statements_before = get_statements_count()
+        gbif_requests_before = sum(gbif_stand_in.requests.values())
+
+        start = time.time()
+        with metrics.step(step):
+            function(conn, config_parser, keep_data=False, after_id=None, checkpoint=None)
+        elapsed_time = time.time() - start
+
+        statements = get_statements_count() - statements_before
+        gbif_requests = sum(gbif_stand_in.requests.values()) - gbif_requests_before
+        if count_when == 'after':
+            n_items = _count(conn, count_sql)
+        results.append({'step': step,
+                        'description': message,
+                        'seconds': round(elapsed_time, 3),
+                        'itemType': item_type,
+                        'items': n_items,
+                        'itemsPerSecond': round(n_items / elapsed_time, 2) if n_items and elapsed_time > 0 else None,
+                        'statements': statements,
+                        'gbifRequests': gbif_requests})
+        print(f"Step {step}: {round(elapsed_time, 2)}s, {n_items} {item_type or 'items'}, {statements} statements, "
+              f"{gbif_requests} GBIF requests.")
+    return results
+
+
+def current_commit():
+    """ Returns the git commit of the scripts (None outside of a git checkout) """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=__location__,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(results, previous_results):
+    """ Print the evolution of the time of each step compared to a previous run """
+    previous_steps = {s['step']: s for s in previous_results['steps']}
+    print(f"Comparison with the run of commit {previous_results.get('commit')} ({previous_results.get('date')}):")
+    for step_result in results['steps']:
+        previous = previous_steps.get(step_result['step'])
+        if previous is None or not previous['seconds']:
+            continue
+        change = (step_result['seconds'] - previous['seconds']) / previous['seconds'] * 100
+        print(f"Step {step_result['step']}: {previous['seconds']}s -> {step_result['seconds']}s ({change:+.1f}%), "
+              f"statements: {previous['statements']} -> {step_result['statements']}, "
+              f"GBIF requests: {previous['gbifRequests']} -> {step_result['gbifRequests']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the transform_db steps on synthetic data")
+    parser.add_argument('--taxa', type=int, default=10000, help="number of taxa in the legacy taxon table")
+    parser.add_argument('--duplicates', type=int, default=100, help="number of duplicated taxa")
+    parser.add_argument('--occurrences-per-species', type=int, default=5)
+    parser.add_argument('--latency-ms', type=float, default=20, help="latency of the GBIF stand-in")
+    parser.add_argument('--output', help="result file (default: benchmark_results/<commit>-<date>.json)")
+    parser.add_argument('--compare', help="result file of a previous run, to compare with")
+    arguments = parser.parse_args()
+
+    setup_log_file(LOG_FILE_PATH)
+    config = get_config()
+    benchmark_database = config.get('benchmark', 'database', fallback=BENCHMARK_DEFAULT_DATABASE)
+
+    msg = f"Creating the benchmark database {benchmark_database} ({arguments.taxa} taxa)..."
+    print(msg)
+    logging.info(msg)
+    create_benchmark_database(config, benchmark_database)
+    previous_config_file_path = helpers.CONFIG_FILE_PATH
+    benchmark_config_path = write_benchmark_config(config, benchmark_database)
+    gbif_server = None
+    try:
+        benchmark_config = get_config()
+        connection = get_database_connection()
+        populate_benchmark_database(connection, arguments.taxa, arguments.duplicates,
+                                    arguments.occurrences_per_species)
+
+        gbif_server = start_gbif_stand_in(SyntheticBackbone(n_species=arguments.taxa),
+                                          latency=arguments.latency_ms / 1000)
+        msg = f"GBIF stand-in listening on port {gbif_server.server_address[1]} (latency: {arguments.latency_ms}ms)"
+        print(msg)
+        logging.info(msg)
+
+        start_time = time.time()
+        steps_results = run_steps(connection, benchmark_config, gbif_server)
+        benchmark_results = {'commit': current_commit(),
+                             'date': datetime.datetime.now().isoformat(),
+                             'parameters': {'taxa': arguments.taxa,
+                                            'duplicates': arguments.duplicates,
+                                            'occurrencesPerSpecies': arguments.occurrences_per_species,
+                                            'latencyMs': arguments.latency_ms},
+                             'totalSeconds': round(time.time() - start_time, 3),
+                             'gbifRequestsByEndpoint': dict(gbif_server.requests),
+                             'steps': steps_results,
+                             # details per statement template and GBIF endpoint
+                             'metrics': metrics.summary()}
+    finally:
+        # also when a step fails: no benchmark_*.ini left behind
+        if gbif_server is not None:
+            gbif_server.shutdown()
+        os.remove(benchmark_config_path)
+        helpers.CONFIG_FILE_PATH = previous_config_file_path
+
+    output = arguments.output
+    if output is None:
+        os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+        output = os.path.join(RESULTS_DIRECTORY, f"{(benchmark_results['commit'] or 'nocommit')[:10]}-"
+                                                 f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.json")
+    with open(output, 'w') as f:
+        json.dump(benchmark_results, f, indent=2)
+    msg = f"Benchmark done in {benchmark_results['totalSeconds']}s, results saved in {output}"
+    print(msg)
+    logging.info(msg)
+
+    if arguments.compare:
+        with open(arguments.compare) as f:
+            print_comparison(benchmark_results, json.load(f))
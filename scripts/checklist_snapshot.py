@@ -0,0 +1,163 @@
+# Local snapshots of GBIF checklists (used for the GRIIS Belgium checklist, see exotic_status.py)
+#
+# The GBIF keys (nubKey) of the taxa of a checklist are saved in a SQLite store together with the version of the
+# checklist they come from:
+#   - for a checklist read through the GBIF API: the "modified" timestamp of the dataset in the GBIF registry. A single
+#     registry request tells if the snapshot is still up to date, the (paginated) download is only done if not.
+#   - for a local Darwin Core Archive export of the checklist (zip file or unzipped directory): the modification date of
+#     the archive. The nubKey column is used if the export has one, otherwise the names are matched (strictly) to the
+#     GBIF Backbone.
+import csv
+import datetime
+import io
+import logging
+import os
+import sqlite3
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+import zipfile
+
+from helpers import gbif_dataset_modified, gbif_name_backbone, iter_name_usage
+
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+CHECKLIST_SNAPSHOT_DEFAULT_PATH = './cache/checklist_snapshots.sqlite'
+
+DWC_NAMESPACE = '{http://rs.tdwg.org/dwc/text/}'
+
+
+class ChecklistSnapshots(object):
+    """ SQLite store of the checklists snapshots: for each checklist (datasetKey), its version and the GBIF keys of its
+    taxa """
+
+    def __init__(self, path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS snapshot (
+                                  "datasetKey" TEXT PRIMARY KEY,
+                                  "version" TEXT NOT NULL,
+                                  "retrieved" TEXT NOT NULL)""")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS snapshot_taxon (
+                                  "datasetKey" TEXT NOT NULL,
+                                  "nubKey" INTEGER NOT NULL,
+                                  PRIMARY KEY ("datasetKey", "nubKey"))""")
+        self._conn.commit()
+
+    def get_version(self, dataset_key):
+        with self._lock:
+            row = self._conn.execute("""SELECT "version" FROM snapshot WHERE "datasetKey" = ?""",
+                                     (dataset_key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_nub_keys(self, dataset_key):
+        with self._lock:
+            rows = self._conn.execute("""SELECT "nubKey" FROM snapshot_taxon WHERE "datasetKey" = ?""",
+                                      (dataset_key,)).fetchall()
+        return [row[0] for row in rows]
+
+    def save(self, dataset_key, version, nub_keys):
+        """ Replace the snapshot of the checklist dataset_key (in a single transaction) """
+        with self._lock, self._conn:
+            self._conn.execute("""DELETE FROM snapshot_taxon WHERE "datasetKey" = ?""", (dataset_key,))
+            self._conn.executemany("""INSERT OR IGNORE INTO snapshot_taxon ("datasetKey", "nubKey") VALUES (?, ?)""",
+                                   [(dataset_key, nub_key) for nub_key in nub_keys])
+            self._conn.execute("""INSERT OR REPLACE INTO snapshot ("datasetKey", "version", "retrieved")
+                                  VALUES (?, ?, ?)""",
+                               (dataset_key, version, datetime.datetime.now().isoformat()))
+
+
+def _download_nub_keys(dataset_key):
+    # GBIF keys of the taxa of a checklist, through the API (not through the GBIF cache: the snapshot replaces it)
+    nub_keys = []
+    for taxon in iter_name_usage(datasetKey=dataset_key, cached=False):
+        nub_key = taxon.get('nubKey')
+        if nub_key is not None and taxon.get('origin') == "SOURCE":
+            nub_keys.append(nub_key)
+    return nub_keys
+
+
+def _open_archive_file(archive_path, name):
+    # a file of a Darwin Core Archive, zipped or not
+    if os.path.isdir(archive_path):
+        return open(os.path.join(archive_path, name), encoding='utf-8', newline='')
+    return io.TextIOWrapper(zipfile.ZipFile(archive_path).open(name), encoding='utf-8', newline='')
+
+
+def _read_archive_nub_keys(archive_path):
+    """ GBIF keys of the taxa of the core file of a Darwin Core Archive (see meta.xml): from the nubKey column if
+    present, otherwise by a strict match of the scientific names on the GBIF Backbone """
+    with _open_archive_file(archive_path, 'meta.xml') as f:
+        core = ElementTree.parse(f).getroot().find(f'{DWC_NAMESPACE}core')
+    core_file = core.find(f'{DWC_NAMESPACE}files/{DWC_NAMESPACE}location').text.strip()
+    delimiter = core.get('fieldsTerminatedBy', ',').encode().decode('unicode_escape')
+    ignore_header_lines = int(core.get('ignoreHeaderLines', '0'))
+    columns = {field.get('term').rsplit('/', 1)[-1]: int(field.get('index'))
+               for field in core.findall(f'{DWC_NAMESPACE}field') if field.get('index') is not None}
+
+    nub_keys = []
+    with _open_archive_file(archive_path, core_file) as f:
+        rows = csv.reader(f, delimiter=delimiter, quoting=csv.QUOTE_NONE)
+        for _ in range(ignore_header_lines):
+            next(rows, None)
+        for row in rows:
+            if 'nubKey' in columns:
+                if row[columns['nubKey']]:
+                    nub_keys.append(int(row[columns['nubKey']]))
+            else:
+                name = row[columns['scientificName']]
+                if 'scientificNameAuthorship' in columns and row[columns['scientificNameAuthorship']] \
+                        and row[columns['scientificNameAuthorship']] not in name:
+                    name += " " + row[columns['scientificNameAuthorship']]
+                match = gbif_name_backbone(name=name, strict=True)
+                if match.get('matchType') != 'NONE' and match.get('usageKey') is not None:
+                    nub_keys.append(match['usageKey'])
+    return nub_keys
+
+
+def get_checklist_nub_keys(snapshots, dataset_key, archive_path=None):
+    """ GBIF keys of the taxa of the checklist dataset_key, from its snapshot if it is still up to date (snapshots:
+    ChecklistSnapshots, or None to always retrieve the checklist)
+
+    If archive_path is given, the checklist is read from that local Darwin Core Archive instead of the GBIF API.
+
+    Returns a (nub_keys, save_snapshot) tuple. save_snapshot is None if the snapshot is up to date. Otherwise, the
+    checklist has been (re)loaded (new version or no snapshot yet) and save_snapshot saves it as the new snapshot:
+    call it once the new content has been applied, so that an interrupted run still sees the change the next time. """
+    if archive_path is not None:
+        version = "archive " + datetime.datetime.fromtimestamp(os.path.getmtime(archive_path)).isoformat()
+    else:
+        version = gbif_dataset_modified(dataset_key)
+
+    if snapshots is not None and version is not None and snapshots.get_version(dataset_key) == version:
+        nub_keys = snapshots.get_nub_keys(dataset_key)
+        msg = f"Checklist {dataset_key} unchanged since the last run ({version}): {len(nub_keys)} taxa from the " \
+              f"local snapshot."
+        print(msg)
+        logging.info(msg)
+        return nub_keys, None
+
+    start_time = time.time()
+    if archive_path is not None:
+        nub_keys = _read_archive_nub_keys(archive_path)
+    else:
+        nub_keys = _download_nub_keys(dataset_key)
+    msg = f"Checklist {dataset_key} ({version}) retrieved in {round(time.time() - start_time)}s: {len(nub_keys)} taxa."
+    print(msg)
+    logging.info(msg)
+
+    def save_snapshot():
+        if snapshots is not None and version is not None:
+            snapshots.save(dataset_key, version, nub_keys)
+
+    return nub_keys, save_snapshot
+
+
+def open_checklist_snapshots(config_parser):
+    """ Returns the ChecklistSnapshots store configured by snapshot-path in the [exotic_status] section of config.ini """
+    return ChecklistSnapshots(os.path.join(__location__, config_parser.get('exotic_status', 'snapshot-path',
+                                                                           fallback=CHECKLIST_SNAPSHOT_DEFAULT_PATH)))
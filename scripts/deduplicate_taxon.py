@@ -3,6 +3,9 @@
 # - Load its configuration ("row X should be replaced by row Y") from an external file
 # - Based on that configuration, updates the FK that point to those records in multiple tables => each relationship to X is replaced by a FK to Y
 # - Finally, deletes the X entries in taxon
+#
+# With set-based = True (config.ini), the X -> Y pairs are loaded in a temporary table and each table is updated by a
+# single statement. With detect-duplicates = True, the pairs are not read from the file but detected in the taxon table.
 
 # This gives us cleaner data to import from, and avoid errors later down the road (since our new "scientificname"
 # table rejects duplicate, thus breaking the script)
@@ -29,40 +32,112 @@
 import json
 import os
 
-from helpers import get_database_connection, execute_sql_from_jinja_string, get_config
+from helpers import get_database_connection, execute_sql_from_jinja_string, get_config, BatchTransaction, \
+    execute_values_sql, log_verbose
 
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
+# (table, column) pointing to biodiv.taxon records, rewritten when a taxon is replaced by another one
+REFERENCING_COLUMNS = [('biodiv.commontaxa', 'nptaxonid'),
+                       ('biodiv.media', 'taxonid'),
+                       ('biodiv.identifiablespecies', 'taxonid'),
+                       ('biodiv.occurence', 'identifiablespeciesid'),
+                       ('biodiv.speciesannex', 'taxonid'),
+                       # Also update child taxa that point to the record to be deleted
+                       ('biodiv.taxon', 'parentid')]
+
+
+def _load_replacements(path):
+    """ Returns the content of the configuration file as a dict old taxon id -> new taxon id
+
+    Chains (X replaced by Y, Y replaced by Z) are resolved: X is directly replaced by Z """
+    with open(path, 'r') as fp:
+        taxon_to_replace = {int(old_id): int(new_id) for old_id, new_id in json.load(fp).items()}
+
+    replacements = {}
+    for old_id, new_id in taxon_to_replace.items():
+        seen = {old_id}
+        while new_id in taxon_to_replace and new_id not in seen:
+            seen.add(new_id)
+            new_id = taxon_to_replace[new_id]
+        replacements[old_id] = new_id
+    return replacements
 
-def deduplicate_taxon(conn, config_parser):
-    with open(os.path.join(__location__, config_parser.get('deduplicate_taxon', 'config-filename')), 'r') as fp:
-        taxon_to_replace = json.load(fp)
 
-        with conn:
-            for old_id, new_id in taxon_to_replace.items():
-                print(f"Will replace taxon {old_id} by {new_id}")
-                q = "UPDATE biodiv.commontaxa SET nptaxonid = {{ new_id }} WHERE nptaxonid = {{ old_id }};"
-                execute_sql_from_jinja_string(conn, q, context={'new_id': new_id, 'old_id': old_id})
+def _deduplicate_taxon_row_by_row(conn, taxon_to_replace):
+    for old_id, new_id in taxon_to_replace.items():
+        log_verbose(f"Will replace taxon {old_id} by {new_id}")
+        for table, column in REFERENCING_COLUMNS:
+            q = "UPDATE {{ table | sqlsafe }} SET {{ column | sqlsafe }} = {{ new_id }} " \
+                "WHERE {{ column | sqlsafe }} = {{ old_id }};"
+            execute_sql_from_jinja_string(conn, q, context={'table': table, 'column': column,
+                                                            'new_id': new_id, 'old_id': old_id})
 
-                q = "UPDATE biodiv.media SET taxonid = {{ new_id }} WHERE taxonid = {{ old_id }};"
-                execute_sql_from_jinja_string(conn, q, context={'new_id': new_id, 'old_id': old_id})
+        q = "DELETE FROM biodiv.taxon WHERE id = {{old_id }};"
+        execute_sql_from_jinja_string(conn, q, context={'new_id': new_id, 'old_id': old_id})
 
-                q = "UPDATE biodiv.identifiablespecies SET taxonid = {{ new_id }} WHERE taxonid = {{ old_id }};"
-                execute_sql_from_jinja_string(conn, q, context={'new_id': new_id, 'old_id': old_id})
 
-                q = "UPDATE biodiv.occurence SET identifiablespeciesid = {{ new_id }} WHERE identifiablespeciesid = {{ old_id }};"
-                execute_sql_from_jinja_string(conn, q, context={'new_id': new_id, 'old_id': old_id})
+def _detect_duplicates(conn):
+    """ Fill taxon_replacement with the duplicates in biodiv.taxon: taxa with the same acceptedname and
+    scientificnameauthorship (NULL authorships are considered equal) are replaced by the one with the lowest id """
+    cur = execute_sql_from_jinja_string(conn, """
+        INSERT INTO taxon_replacement (old_id, new_id)
+        SELECT id, kept_id FROM (
+            SELECT id, MIN(id) OVER (PARTITION BY acceptedname, scientificnameauthorship) AS kept_id
+            FROM biodiv.taxon
+            WHERE acceptedname IS NOT NULL
+        ) AS t
+        WHERE id != kept_id""")
+    return cur.rowcount
 
-                q = "UPDATE biodiv.speciesannex SET taxonid = {{ new_id }} WHERE taxonid = {{ old_id }};"
-                execute_sql_from_jinja_string(conn, q, context={'new_id': new_id, 'old_id': old_id})
 
-                # Also update child taxa that point to the record to be deleted
-                q = "UPDATE biodiv.taxon SET parentid = {{ new_id }} WHERE parentid = {{ old_id }};"
-                execute_sql_from_jinja_string(conn, q, context={'new_id': new_id, 'old_id': old_id})
+def _deduplicate_taxon_set_based(conn, taxon_to_replace=None):
+    """ Replace the taxa with one statement per referencing table (plus one DELETE), based on a mapping table
 
-                q = "DELETE FROM biodiv.taxon WHERE id = {{old_id }};"
-                execute_sql_from_jinja_string(conn, q, context={'new_id': new_id, 'old_id': old_id})
-            print('DONE')
+    The mapping is taxon_to_replace (dict old id -> new id) if given, otherwise it's detected by _detect_duplicates.
+    Everything happens in a single transaction. """
+    with BatchTransaction(conn):
+        execute_sql_from_jinja_string(conn, """CREATE TEMPORARY TABLE taxon_replacement (
+                                                   old_id integer PRIMARY KEY,
+                                                   new_id integer NOT NULL
+                                               ) ON COMMIT DROP""")
+        if taxon_to_replace is None:
+            n_taxa = _detect_duplicates(conn)
+        else:
+            n_taxa = len(taxon_to_replace)
+            if taxon_to_replace:
+                execute_values_sql(conn, """INSERT INTO taxon_replacement (old_id, new_id) VALUES %s""",
+                                   list(taxon_to_replace.items()))
+        print(f"Will replace {n_taxa} taxa")
+        execute_sql_from_jinja_string(conn, """ANALYZE taxon_replacement""")
+
+        for table, column in REFERENCING_COLUMNS:
+            cur = execute_sql_from_jinja_string(conn, """
+                UPDATE {{ table | sqlsafe }} AS t SET {{ column | sqlsafe }} = m.new_id
+                FROM taxon_replacement AS m
+                WHERE t.{{ column | sqlsafe }} = m.old_id""", context={'table': table, 'column': column})
+            print(f"{table}.{column}: {cur.rowcount} rows updated")
+
+        cur = execute_sql_from_jinja_string(conn, """DELETE FROM biodiv.taxon AS t
+                                                     USING taxon_replacement AS m
+                                                     WHERE t.id = m.old_id""")
+        print(f"biodiv.taxon: {cur.rowcount} taxa deleted")
+
+
+def deduplicate_taxon(conn, config_parser):
+    # detect-duplicates: find the duplicates in the taxon table instead of reading them from config-filename (always
+    # set-based)
+    if config_parser.getboolean('deduplicate_taxon', 'detect-duplicates', fallback=False):
+        _deduplicate_taxon_set_based(conn)
+    else:
+        taxon_to_replace = _load_replacements(os.path.join(__location__,
+                                                           config_parser.get('deduplicate_taxon', 'config-filename')))
+        if config_parser.getboolean('deduplicate_taxon', 'set-based', fallback=False):
+            _deduplicate_taxon_set_based(conn, taxon_to_replace)
+        else:
+            with conn:
+                _deduplicate_taxon_row_by_row(conn, taxon_to_replace)
+    print('DONE')
 
 
 if __name__ == "__main__":
@@ -1,106 +1,127 @@
 import logging
+import os
 import time
+
 from helpers import execute_sql_from_jinja_string, get_database_connection, get_config, \
-    setup_log_file, paginated_name_usage, print_indent
+    setup_log_file, log_verbose, execute_values_sql
+from checklist_snapshot import get_checklist_nub_keys, open_checklist_snapshots
+from taxonomy_tree import TaxonomyTree
 
-def _get_alien_taxa(datasetKey):
-    """ Retrieve all taxa in GBIF checklist containing the exotic species in BE.
-    The function returns these taxa as a list of nubKey values (= GBIF taxon kayes from GBIF Backbone)"""
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
-    alien_taxa_in_be = paginated_name_usage(datasetKey=datasetKey)
-    alien_taxa_list = []
-    for taxon in alien_taxa_in_be:
-        nubKey = taxon.get('nubKey')
-        origin = taxon.get('origin')
-        if (nubKey is not None and origin == "SOURCE"):
-            alien_taxa_list += [nubKey]
-    return alien_taxa_list
 
-def _find_exotic_taxa(exotic_taxon, taxa, exotic_taxa_list, depth=0):
-    """ Function to search an exotic taxon in taxa and, recursively, all its children.
+def _find_exotic_taxa(alien_taxa, tree):
+    """ Search the exotic taxa (list of GBIF keys) in the TaxonomyTree tree and extend the exotic status to all their
+    children and synonyms (recursively)
 
-    Params: depth is the recursion level (used for log indentation)
+    The taxonomy is traversed once (on the children/synonyms indexes of the tree), so the cost is linear in the number
+    of exotic taxa.
 
-    Returns a list of ids of exotic taxa in taxonomy table
+    Returns a set of ids of exotic taxa in taxonomy table
     """
-
-    if (exotic_taxon in taxa):
-        print_indent(
-            f"Taxon {taxa[exotic_taxon]['scientificName']} (gbifId: {exotic_taxon}) is exotic in Belgium.",
-            depth=depth)
-        id = taxa[exotic_taxon]['id']
-        exotic_taxa_list += [id]
-        for t in taxa.values():
-            # extend exotic status to all its children
-            if (id in [t['parentId'], t['acceptedId']]):
-                exotic_taxa_list = _find_exotic_taxa(exotic_taxon=t['gbifId'],
-                                                     taxa=taxa,
-                                                     exotic_taxa_list=exotic_taxa_list,
-                                                     depth=depth+1)
-
-    return exotic_taxa_list
-
-def populate_is_exotic_be_field(conn, config_parser, exotic_status_source):
-
+    exotic_roots = []
+    for exotic_taxon in alien_taxa:
+        taxonomy_id = tree.id_of_gbif_id(exotic_taxon)
+        if taxonomy_id is not None:
+            log_verbose(f"Taxon with gbifId {exotic_taxon} (id: {taxonomy_id}) is exotic in Belgium.")
+            exotic_roots.append(taxonomy_id)
+
+    return tree.subtrees(exotic_roots, include_synonyms=True)
+
+
+def _set_exotic_be(conn, exotic_taxa_ids):
+    """ Set exotic_be = True for the taxa in exotic_taxa_ids and False for the others, with a single UPDATE joined to
+    a temporary table (instead of a giant IN (...) list). Only the taxa whose status changes are written.
+
+    Returns the number of updated rows """
+    execute_sql_from_jinja_string(conn, """CREATE TEMPORARY TABLE IF NOT EXISTS exotic_taxon ("id" integer PRIMARY KEY)""")
+    execute_sql_from_jinja_string(conn, """TRUNCATE exotic_taxon""")
+    if exotic_taxa_ids:
+        execute_values_sql(conn, """INSERT INTO exotic_taxon ("id") VALUES %s""",
+                           [(taxon_id,) for taxon_id in exotic_taxa_ids])
+    execute_sql_from_jinja_string(conn, """ANALYZE exotic_taxon""")
+    update_exotic_be_cur = execute_sql_from_jinja_string(
+        conn,
+        """UPDATE taxonomy SET "exotic_be" = new."exotic_be"
+           FROM (SELECT t."id", e."id" IS NOT NULL AS "exotic_be"
+                 FROM taxonomy t LEFT JOIN exotic_taxon e ON e."id" = t."id") AS new
+           WHERE taxonomy."id" = new."id" AND taxonomy."exotic_be" IS DISTINCT FROM new."exotic_be" """)
+    execute_sql_from_jinja_string(conn, """DROP TABLE exotic_taxon""")
+    return update_exotic_be_cur.rowcount
+
+
+def get_alien_taxa(exotic_status_source, config_parser):
+    """ Returns the GBIF keys of the taxa of the checklist exotic_status_source (GBIF datasetKey) and a function to
+    call once they have been applied to taxonomy (None if the checklist didn't change since the last run, see
+    checklist_snapshot.get_checklist_nub_keys)
+
+    See the [exotic_status] section of config.ini: the checklist is kept in a local snapshot (only downloaded again
+    if the dataset has been modified) and can be read from a local Darwin Core Archive export. """
     msg = f"We'll now retrieve the GBIF checklist containing the exotic taxa in Belgium, datasetKey: {exotic_status_source}."
     print(msg)
     logging.info(msg)
 
-    start_time = time.time()
-    # get alien taxa from GRIIS Belgium checklist
-    alien_taxa = _get_alien_taxa(datasetKey=exotic_status_source)
-    end_time = time.time()
+    snapshots = None
+    if config_parser.getboolean('exotic_status', 'snapshot', fallback=True):
+        snapshots = open_checklist_snapshots(config_parser)
+    archive_path = config_parser.get('exotic_status', 'checklist-archive', fallback='')
+    return get_checklist_nub_keys(snapshots, exotic_status_source,
+                                  archive_path=os.path.join(__location__, archive_path) if archive_path else None)
+
+
+def set_exotic_be_of_taxa(conn, exotic_be_by_id):
+    """ Set exotic_be for some taxa (dict taxonomy id -> True/False), with a single UPDATE """
+    if exotic_be_by_id:
+        execute_values_sql(conn,
+                           """UPDATE taxonomy SET "exotic_be" = v."exotic_be"
+                              FROM (VALUES %s) AS v("id", "exotic_be")
+                              WHERE taxonomy."id" = v."id" """,
+                           sorted(exotic_be_by_id.items()),  # rows always locked in the same order
+                           page_size=len(exotic_be_by_id))
+
+
+def populate_is_exotic_be_field(conn, config_parser, exotic_status_source, alien_taxa=None):
+    # alien_taxa (optional): GBIF keys of the exotic taxa, if already retrieved from exotic_status_source
+    save_snapshot = None
+    if alien_taxa is None:
+        alien_taxa, save_snapshot = get_alien_taxa(exotic_status_source, config_parser)
+        checklist_changed = save_snapshot is not None
+    else:
+        checklist_changed = True
 
-    msg = f"Retrieved {len(alien_taxa)} exotic taxa in {round(end_time-start_time)}s."
-    print(msg)
-    logging.info(msg)
+    # exotic_be is NULL for the taxa inserted (or moved in the tree) since the last run, see gbif_match
+    cur = execute_sql_from_jinja_string(conn, """SELECT count(*) FROM taxonomy WHERE "exotic_be" IS NULL""")
+    n_taxa_to_check = cur.fetchone()[0]
+    if not checklist_changed and n_taxa_to_check == 0:
+        msg = "Checklist and taxonomy unchanged: exotic_be is up to date."
+        print(msg)
+        logging.info(msg)
+        return
 
-    taxon_cur = execute_sql_from_jinja_string(conn, "SELECT * FROM taxonomy", dict_cursor=True)
+    start_time = time.time()
 
-    total_taxa_count = taxon_cur.rowcount
-    msg = f"We'll now update exotic_be field for {total_taxa_count} taxa of the taxonomy table."
+    tree = TaxonomyTree.load(conn)
+    msg = f"We'll now update exotic_be field for {len(tree)} taxa of the taxonomy table."
     print(msg)
     logging.info(msg)
 
-    start_time = time.time()
-
-    taxa_to_check = dict()
-    for taxon in taxon_cur:
-        id = taxon['id']
-        parentId = taxon['parentId']
-        scientificName = taxon['scientificName']
-        gbifId = taxon['gbifId']
-        acceptedId = taxon['acceptedId']
-        taxa_to_check[gbifId] = {'id': id, 'gbifId': gbifId, 'scientificName': scientificName, 'parentId': parentId, 'acceptedId': acceptedId}
-
-    #initialize list with id of exotic taxa in taxonomy
-    exotic_taxa_ids= []
-
-    for exotic_taxon in alien_taxa:
-        exotic_taxa_ids = _find_exotic_taxa(exotic_taxon=exotic_taxon,
-                                                 taxa=taxa_to_check,
-                                                 exotic_taxa_list= exotic_taxa_ids,
-                                                 depth=0)
+    exotic_taxa_ids = _find_exotic_taxa(alien_taxa=alien_taxa, tree=tree)
 
     msg = f"{len(exotic_taxa_ids)} exotic taxa found in taxonomy."
     print(msg)
     logging.info(msg)
 
-    if (len(exotic_taxa_ids) > 0):
-        # set exotic_be = True for exotic taxa and False for the others
-        template = """ UPDATE taxonomy SET "exotic_be" = """ \
-                   + """ CASE WHEN "id" IN {{ ids | inclause }} THEN true""" \
-                   + """ ELSE false END"""
-    else:
-        template = """ UPDATE taxonomy SET "exotic_be" = false"""
-    update_exotic_be_cur = execute_sql_from_jinja_string(conn, sql_string=template, context={'ids': exotic_taxa_ids})
+    n_updated = _set_exotic_be(conn, exotic_taxa_ids)
 
     end_time = time.time()
 
-    msg = f"Field exotic_be updated for {update_exotic_be_cur.rowcount} taxa in taxonomy in {round(end_time - start_time, 2)}s."
+    msg = f"Field exotic_be updated for {n_updated} taxa in taxonomy in {round(end_time - start_time, 2)}s."
     print(msg)
     logging.info(msg)
 
+    if save_snapshot is not None:
+        save_snapshot()
+
 if __name__ == "__main__":
     connection = get_database_connection()
     config = get_config()
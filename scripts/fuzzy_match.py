@@ -0,0 +1,151 @@
+# Suggestions for the names without match on the GBIF Backbone
+#
+# gbif_match.py matches names strictly: misspelled names get matchType = NONE and have to be corrected by hand (see
+# scientific_name_corrected in official_annexes.csv). This script looks for the most similar names (trigram word
+# similarity, with the pg_trgm extension) among the taxa already in the taxonomy table and, optionally, among all the
+# names of the local GBIF Backbone (see local_backbone.py), and saves the ranked candidates in a CSV file.
+#
+# No GBIF API call is made: the candidates of each batch of names are found with a single query.
+# Run it after transform_db.py (or gbif_match.py), see the [fuzzy_match] section of config.ini.
+import csv
+import logging
+import os
+import tempfile
+import time
+
+from helpers import execute_sql_from_file, execute_sql_from_jinja_string, get_database_connection, get_config, \
+    setup_log_file, BatchTransaction, execute_copy_from_file, ProgressReporter
+from local_backbone import open_local_backbone
+
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+FUZZY_MATCH_DEFAULT_OUTPUT_FILE = "./logs/fuzzy_match_candidates.csv"
+FUZZY_MATCH_DEFAULT_BATCH_SIZE = 500
+FUZZY_MATCH_DEFAULT_MAX_CANDIDATES = 5
+FUZZY_MATCH_DEFAULT_MIN_SCORE = 0.5
+
+OUTPUT_FIELDS = ['scientificNameId', 'scientificName', 'authorship', 'rank', 'score', 'candidateName', 'gbifId',
+                 'source']
+
+
+def _load_backbone_names(conn, backbone):
+    """ (Re)load the canonical names of the local backbone in fuzzymatchbackbonename, if they come from another
+    version of the backbone """
+    backbone_version = backbone.version()
+    cur = execute_sql_from_jinja_string(conn, """SELECT "backboneVersion" FROM fuzzymatchbackbonename LIMIT 1""")
+    row = cur.fetchone()
+    if row is not None and row[0] == backbone_version:
+        return
+
+    msg = f"Loading the names of the local GBIF Backbone ({backbone_version}) in fuzzymatchbackbonename..."
+    print(msg)
+    logging.info(msg)
+    start = time.time()
+    with tempfile.TemporaryFile(mode='w+', newline='', encoding='utf-8') as names_file:
+        writer = csv.writer(names_file)
+        for key, canonical_name in backbone.iter_canonical_names():
+            writer.writerow([key, canonical_name, backbone_version])
+        names_file.seek(0)
+
+        # the index is rebuilt after the load (faster than maintaining it during the COPY)
+        with BatchTransaction(conn):
+            execute_sql_from_jinja_string(conn, """DROP INDEX IF EXISTS fuzzymatchbackbonename_trgm""")
+            execute_sql_from_jinja_string(conn, """TRUNCATE fuzzymatchbackbonename""")
+            cur = execute_copy_from_file(conn,
+                                         """COPY fuzzymatchbackbonename ("gbifId", "canonicalName", "backboneVersion")
+                                            FROM STDIN WITH (FORMAT csv)""",
+                                         names_file)
+            n_names = cur.rowcount
+            execute_sql_from_jinja_string(conn, """CREATE INDEX fuzzymatchbackbonename_trgm ON fuzzymatchbackbonename
+                                                   USING gist ("canonicalName" gist_trgm_ops)""")
+    msg = f"{n_names} backbone names loaded and indexed in {round(time.time() - start)}s."
+    print(msg)
+    logging.info(msg)
+
+
+def _rank_candidates(rows, max_candidates):
+    """ Returns a list of (rank, candidate) tuples, best first, from the rows of get_fuzzy_match_candidates.sql for a
+    name. A taxon found in both sources is kept once (with its best score). """
+    candidates = {}
+    for row in rows:
+        best = candidates.get(row['gbifId'])
+        if best is None or row['score'] > best['score']:
+            candidates[row['gbifId']] = row
+    ranked = sorted(candidates.values(), key=lambda c: (-c['score'], c['source'] != 'taxonomy', c['candidateName']))
+    return list(enumerate(ranked[:max_candidates], start=1))
+
+
+def fuzzy_match(conn, config_parser, output_file):
+    """ Save the fuzzy match candidates of the unmatched names of scientificname (matchType = NONE) in output_file
+
+    Returns the number of names with at least a candidate """
+    batch_size = config_parser.getint('fuzzy_match', 'batch-size', fallback=FUZZY_MATCH_DEFAULT_BATCH_SIZE)
+    max_candidates = config_parser.getint('fuzzy_match', 'max-candidates', fallback=FUZZY_MATCH_DEFAULT_MAX_CANDIDATES)
+    min_score = config_parser.getfloat('fuzzy_match', 'min-score', fallback=FUZZY_MATCH_DEFAULT_MIN_SCORE)
+    include_backbone = config_parser.getboolean('fuzzy_match', 'local-backbone', fallback=False)
+    limit = config_parser.get('fuzzy_match', 'names-limit', fallback='')
+
+    execute_sql_from_file(conn, 'create_fuzzy_match_index.sql')
+    if include_backbone:
+        _load_backbone_names(conn, open_local_backbone(config_parser))
+
+    cur = execute_sql_from_jinja_string(conn, """SELECT "id", "scientificName", "authorship" FROM scientificname
+                                                 WHERE "matchType" = 'NONE'
+                                                 ORDER BY "id"
+                                                 {% if limit %} LIMIT {{ limit }} {% endif %}""",
+                                        context={'limit': limit}, dict_cursor=True)
+    names = [dict(row) for row in cur]
+    msg = f"Looking for fuzzy match candidates for {len(names)} unmatched names"
+    if include_backbone:
+        msg += " (in taxonomy and in the local GBIF Backbone)"
+    print(msg)
+    logging.info(msg)
+
+    start = time.time()
+    n_names_with_candidates = 0
+    progress = ProgressReporter("Fuzzy match", total=len(names))
+    with open(output_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=OUTPUT_FIELDS)
+        writer.writeheader()
+        for i in range(0, len(names), batch_size):
+            batch = names[i:i + batch_size]
+            cur = execute_sql_from_file(conn, 'get_fuzzy_match_candidates.sql',
+                                        {'names': batch,
+                                         'max_candidates': max_candidates,
+                                         'min_score': min_score,
+                                         'include_backbone': include_backbone},
+                                        dict_cursor=True)
+            candidates_by_name = {}
+            for row in cur:
+                candidates_by_name.setdefault(row['id'], []).append(dict(row))
+
+            for name in batch:
+                ranked_candidates = _rank_candidates(candidates_by_name.get(name['id'], []), max_candidates)
+                if ranked_candidates:
+                    n_names_with_candidates += 1
+                for rank, candidate in ranked_candidates:
+                    writer.writerow({'scientificNameId': name['id'],
+                                     'scientificName': name['scientificName'],
+                                     'authorship': name['authorship'],
+                                     'rank': rank,
+                                     'score': round(candidate['score'], 3),
+                                     'candidateName': candidate['candidateName'],
+                                     'gbifId': candidate['gbifId'],
+                                     'source': candidate['source']})
+            progress.update(len(batch))
+    progress.close()
+
+    msg = f"Candidates found for {n_names_with_candidates}/{len(names)} names in {round(time.time() - start)}s, " \
+          f"saved in {output_file}."
+    print(msg)
+    logging.info(msg)
+    return n_names_with_candidates
+
+
+if __name__ == "__main__":
+    connection = get_database_connection()
+    config = get_config()
+    setup_log_file("./logs/fuzzy_match.log")
+    fuzzy_match(connection, config_parser=config,
+                output_file=os.path.join(__location__, config.get('fuzzy_match', 'output-file',
+                                                                  fallback=FUZZY_MATCH_DEFAULT_OUTPUT_FILE)))
@@ -1,39 +1,209 @@
 import logging
 
-import pygbif
+import itertools
+import re
+import threading
 import time
 import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from helpers import execute_sql_from_file, get_database_connection, get_config, setup_log_file, \
-    execute_sql_from_jinja_string, print_indent
+    execute_sql_from_jinja_string, log_verbose, ProgressReporter, gbif_name_backbone, gbif_name_usage, gbif_cache_stats_message, \
+    set_gbif_rate_limit, execute_values_sql, register_prepared_statement, execute_prepared, batch_transaction, \
+    gbif_backbone_version, get_gbif_cache
+from local_backbone import open_local_backbone
+from taxonomy_closure import add_to_taxonomy_closure, move_in_taxonomy_closure, \
+    create_taxonomy_closure_if_missing
 
+# Fields of the taxa given to the on_new_taxa callback of gbif_match
+TAXON_FIELDS = ('id', 'gbifId', 'scientificName', 'parentId', 'acceptedId')
 
-def _insert_or_get_rank(conn, rank_name):
+# Lock of the memos of the GBIF Backbone entries (see _name_usage), shared by the matching workers
+_name_usages_lock = threading.Lock()
+
+
+def _name_backbone(scientific_name, authorship, backbone=None):
+    # Strict match of a name on the GBIF Backbone: through the API or, if backbone is given, on a LocalBackbone
+    if backbone is not None:
+        return backbone.name_backbone(scientific_name, authorship)
+
+    name = scientific_name
+    if authorship is not None:
+        name += " " + authorship
+    return gbif_name_backbone(name=name, strict=True)
+
+
+def _name_usage(gbif_key, backbone=None, name_usages=None):
+    # Get a GBIF Backbone entry: through the API or, if backbone is given, from a LocalBackbone
+    # name_usages (optional): memo dict key -> name_usage info, created for each gbif_match run
+    if name_usages is not None:
+        with _name_usages_lock:
+            if gbif_key in name_usages:
+                return name_usages[gbif_key]
+
+    if backbone is not None:
+        name_usage_info = backbone.name_usage(gbif_key)
+    else:
+        name_usage_info = gbif_name_usage(key=gbif_key)
+
+    if name_usages is not None:
+        with _name_usages_lock:
+            name_usages[gbif_key] = name_usage_info
+    return name_usage_info
+
+
+def _prefetch_lineage(gbif_key, name_usages, backbone=None):
+    # Get the GBIF Backbone entries of a taxon, its parents and accepted taxa (up to the kingdom) in name_usages, so
+    # that _add_taxon_tree doesn't have to wait for them
+    keys_to_fetch = [gbif_key]
+    while keys_to_fetch:
+        key = keys_to_fetch.pop()
+        with _name_usages_lock:
+            already_fetched = key in name_usages
+        if not already_fetched:
+            name_usage_info = _name_usage(key, backbone=backbone, name_usages=name_usages)
+            keys_to_fetch += [k for k in (name_usage_info.get('parentKey'), name_usage_info.get('acceptedKey'))
+                              if k is not None]
+
+
+def _clean_whitespace(value):
+    # "  Rana   ridibunda " -> "Rana ridibunda"
+    if value is None:
+        return None
+    return re.sub(r'\s+', ' ', value).strip() or None
+
+
+def _group_key_part(value, is_authorship=False):
+    # Case, whitespace and punctuation spacing insensitive form of a scientific name or authorship: "L. ,1758" ->
+    # "l., 1758", "( Mill. )  Sw." -> "(mill.) sw.". In authorships, "et" and "and" between authors are written "&".
+    # Only used to group the names, never sent to GBIF
+    value = _clean_whitespace(value)
+    if value is None:
+        return None
+    value = re.sub(r'\s+([,.;:)])', r'\1', value)
+    value = re.sub(r'([(])\s+', r'\1', value)
+    value = re.sub(r'([,;])(?=\S)', r'\1 ', value)
+    if is_authorship:
+        value = re.sub(r'\s+(?:et|and)\s+(?!al\b)', ' & ', value)
+    return value.lower()
+
+
+def _canonical_name(scientific_name, authorship):
+    """ Returns (group key, scientific name, authorship) for a name
+
+    Names with the same group key (see _group_key_part) are matched only once. The returned scientific name and
+    authorship, sent to GBIF, only have their whitespace cleaned. """
+    group_key = (_group_key_part(scientific_name), _group_key_part(authorship, is_authorship=True))
+    return group_key, _clean_whitespace(scientific_name), _clean_whitespace(authorship)
+
+
+def _match_name(scientific_name, authorship, backbone=None, name_usages=None):
+    # Network part of the match of a name (no database access, can be run by the workers)
+    # The lineage of the matched taxon is fetched in name_usages (optional, see _name_usage)
+    # Returns the gbif_taxon_info
+    gbif_taxon_info = _name_backbone(scientific_name, authorship, backbone=backbone)
+    if gbif_taxon_info['matchType'] != 'NONE' and name_usages is not None:
+        _prefetch_lineage(gbif_taxon_info.get('usageKey'), name_usages, backbone=backbone)
+    return gbif_taxon_info
+
+
+class _MatchGroups(object):
+    """ Run-scoped groups of names sharing a canonical form (see _canonical_name): each group is matched once, its
+    result is given to all the rows of the group """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.n_rows = 0
+        self._results = {}  # group key -> gbif_taxon_info (or Future)
+
+    @property
+    def n_groups(self):
+        return len(self._results) if self.enabled else self.n_rows
+
+    def key(self, row):
+        """ Group key of row (None if the names aren't grouped) """
+        if not self.enabled:
+            return None
+        return _canonical_name(row['scientificName'], row['authorship'])[0]
+
+    def get_or_match(self, row, match):
+        """ Returns the (possibly shared) result of match(scientific_name, authorship) for the group of row """
+        self.n_rows += 1
+        if not self.enabled:
+            return match(row['scientificName'], row['authorship'])
+        group_key, scientific_name, authorship = _canonical_name(row['scientificName'], row['authorship'])
+        if group_key not in self._results:
+            self._results[group_key] = match(scientific_name, authorship)
+        return self._results[group_key]
+
+
+def _match_names(rows, backbone=None, workers=1, groups=None, name_usages=None):
+    # Generator of (row, gbif_taxon_info) tuples, in the same order as rows
+    #
+    # groups (optional): _MatchGroups, to match the rows sharing a canonical name only once
+    # name_usages (optional): memo of the GBIF Backbone entries, where the lineages of the matched taxa are fetched
+    #
+    # With workers > 1, names are matched concurrently by a pool of threads. At most 4 * workers matches are pending
+    # at a given time, so the (sequential) database writes of the caller keep pace with the workers.
+    if groups is None:
+        groups = _MatchGroups(enabled=False)
+    if workers <= 1:
+        for row in rows:
+            yield row, groups.get_or_match(
+                row, lambda name, authorship: _match_name(name, authorship, backbone, name_usages))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for row in rows:
+                # rows of an already submitted group share its future
+                future = groups.get_or_match(
+                    row, lambda name, authorship: executor.submit(_match_name, name, authorship, backbone, name_usages))
+                pending.append((row, future))
+                if len(pending) >= 4 * workers:
+                    pending_row, pending_future = pending.popleft()
+                    yield pending_row, pending_future.result()
+            while pending:
+                pending_row, pending_future = pending.popleft()
+                yield pending_row, pending_future.result()
+
+
+register_prepared_statement('insert_or_get_rank', ['character varying'],
+                            """WITH ins AS (
+                                INSERT INTO rank(name)
+                                VALUES ($1)         -- input value
+                                ON CONFLICT(name) DO NOTHING
+                                RETURNING rank.id
+                                )
+                            SELECT id FROM ins
+                            UNION  ALL
+                            SELECT id FROM rank          -- 2nd SELECT never executed if INSERT successful
+                            WHERE name = $1  -- input value a 2nd time
+                            LIMIT  1""")
+
+
+def _insert_or_get_rank(conn, rank_name, rank_ids=None):
     """ Insert or select a rank
 
     If rank_name already exists in the rank table, select it.
     Otherwise, insert it in a new row.
 
-    In both cases, returns the row id """
+    In both cases, returns the row id.
 
-    template = """WITH ins AS (
-        INSERT INTO rank(name)
-        VALUES ({{ rank_name }})         -- input value
-        ON CONFLICT(name) DO NOTHING
-        RETURNING rank.id
-        )
-    SELECT id FROM ins
-    UNION  ALL
-    SELECT id FROM rank          -- 2nd SELECT never executed if INSERT successful
-    WHERE name = {{ rank_name }}  -- input value a 2nd time
-    LIMIT  1;"""
+    rank_ids is an optional (run-scoped) dict rank_name -> id, used to skip the query for already known ranks."""
+    if rank_ids is not None and rank_name in rank_ids:
+        return rank_ids[rank_name]
 
-    cur = execute_sql_from_jinja_string(conn, sql_string=template, context={'rank_name': rank_name}, dict_cursor=True)
-    return cur.fetchone()['id']
+    cur = execute_prepared(conn, 'insert_or_get_rank', (rank_name,), dict_cursor=True)
+    rank_id = cur.fetchone()['id']
+    if rank_ids is not None:
+        rank_ids[rank_name] = rank_id
+    return rank_id
 
 
 def _update_match_info(conn, match_info, scientificname_row_id):
     # update scientificname with info about match and taxonomyId
-    match_info = {k: v for k, v in match_info.items() if v is not None}
+    # taxonomyId is always written: a name re-matched without success loses its previous taxon
+    match_info = {k: v for k, v in match_info.items() if v is not None or k == 'taxonomyId'}
     template = """ UPDATE scientificname SET """ \
                + ", ".join([f'"{i}"' + ' = ' + '{{ ' + str(i) + ' }}' for i in match_info.keys()]) \
                + """ WHERE "id" = {{ id }} """
@@ -42,211 +212,515 @@ def _update_match_info(conn, match_info, scientificname_row_id):
     execute_sql_from_jinja_string(conn, sql_string=template, context=data)
 
 
-def _update_taxonomy_if_needed(conn, taxon_in_taxonomy, taxon, depth=0):
-    # Params: depth is the recursion level (used for log indentation)
+def _load_taxonomy_index(conn):
+    """ Load the taxonomy table in a dict gbifId -> taxonomy row (as a dict)
+
+    The returned dict is the run-scoped index used by _add_taxon_tree: it must be kept in sync with the table (this is
+    done by _insert_new_entry_taxonomy and _update_taxonomy_if_needed) """
+    taxonomy_index = {}
+    cur = execute_sql_from_jinja_string(conn, """SELECT * FROM taxonomy""", dict_cursor=True)
+    for row in cur:
+        taxonomy_index[row['gbifId']] = dict(row)
+    return taxonomy_index
+
+
+def _update_taxonomy_if_needed(conn, taxonomy_index, taxon, depth=0):
+    # Params: depth is the level in the taxon tree (used for log indentation)
 
     # GBIF knows about this taxon, and so we are. Do we need to update or do we already have the latest data
     gbifId = taxon['gbifId']
+    taxon_in_taxonomy = taxonomy_index[gbifId]
+    taxonomyId = taxon_in_taxonomy['id']
 
-    taxonomyId = taxon_in_taxonomy.get('id')
-    taxonomy_fields_to_compare = {k: taxon_in_taxonomy[k] for k in taxon}
-    taxonomy_fields_to_change = taxonomy_fields_to_compare.copy()
-    if taxon == taxonomy_fields_to_compare:
-        print_indent(f"Taxon {taxon['scientificName']} already present in taxonomy (id = {taxonomyId}).", depth)
+    fields_to_change = {k: v for k, v in taxon.items() if taxon_in_taxonomy[k] != v}
+    if not fields_to_change:
+        log_verbose(f"Taxon {taxon['scientificName']} already present in taxonomy (id = {taxonomyId}).", depth)
     else:
-        # unchanged fields
-        keys_same_values = dict(taxonomy_fields_to_compare.items() & taxon.items()).keys()
-        # remove unchanged fields
-        for key in keys_same_values: del taxonomy_fields_to_change[key]
-        for key in keys_same_values: del taxon[key]
-        print(f"Fields - values to change:")
-        [print(key, value) for key, value in taxonomy_fields_to_change.items()]
-        print(f"New fields - values:")
-        [print(key, value) for key, value in taxon.items()]
-        context_to_query = taxon
+        changes = ", ".join(f"{key}: {taxon_in_taxonomy[key]} -> {value}" for key, value in fields_to_change.items())
+        log_verbose(f"Taxon {taxon['scientificName']} updated in taxonomy (id = {taxonomyId}): {changes}", depth)
+        if 'parentId' in fields_to_change or 'acceptedId' in fields_to_change:
+            # moved in the tree: its exotic status (inherited, see exotic_status.py) has to be checked again
+            fields_to_change['exotic_be'] = None
+        context_to_query = fields_to_change.copy()
         context_to_query['gbifId'] = gbifId
         template = """ UPDATE taxonomy SET """ \
-                   + ", ".join([f'"{i}"' + ' = ' + '{{ ' + str(i) + ' }}' for i in taxon.keys()]) \
+                   + ", ".join([f'"{i}"' + ' = ' + '{{ ' + str(i) + ' }}' for i in fields_to_change.keys()]) \
                    + """ WHERE "gbifId" = {{ gbifId }} """
         execute_sql_from_jinja_string(conn, sql_string=template, context=context_to_query)
-        return taxonomyId
+        taxon_in_taxonomy.update(fields_to_change)
+        if 'parentId' in fields_to_change:
+            move_in_taxonomy_closure(conn, taxonomyId)
+    return taxonomyId
 
 
-def _insert_new_entry_taxonomy(conn, taxon):
+def _insert_new_entry_taxonomy(conn, taxonomy_index, taxon, new_taxa=None):
+    # new_taxa (optional): list to which the gbifId of the inserted taxon is appended
     gbifId = taxon['gbifId']
 
-    # insert taxon in taxonomy table
-    execute_sql_from_jinja_string(
+    # insert taxon in taxonomy table and get its id (PK)
+    cur = execute_sql_from_jinja_string(
         conn,
-        """INSERT INTO taxonomy ({{ col_names | surround_by_quote | join(', ') | sqlsafe }}) VALUES {{ values | inclause }}""",
+        """INSERT INTO taxonomy ({{ col_names | surround_by_quote | join(', ') | sqlsafe }}) VALUES {{ values | inclause }}
+           RETURNING id""",
         {'col_names': tuple(taxon.keys()),
          'values': tuple(taxon.values())}
     )
-    # get id (PK) in taxonomy
-    cur = execute_sql_from_jinja_string(conn,
-                                        """SELECT id FROM taxonomy WHERE "gbifId" = {{ gbifId }}""",
-                                        {'gbifId': gbifId})
-    taxonomyId = cur.fetchall()
+    taxonomyId = cur.fetchone()
     assert taxonomyId is not None, f"Taxon with gbifId {gbifId} not inserted into the taxonomy table."
-    assert len(taxonomyId) <= 1, \
-        f"Too many taxa returned for gbifId = {gbifId}. Duplicates in taxonomy table."
 
+    taxonomy_index[gbifId] = dict(taxon, id=taxonomyId[0], exotic_be=None)
+    add_to_taxonomy_closure(conn, [taxonomyId[0]])
     _insert_new_entry_taxonomy.counter += 1
-    return taxonomyId[0][0]
+    if new_taxa is not None:
+        new_taxa.append(gbifId)
+    return taxonomyId[0]
 
 _insert_new_entry_taxonomy.counter = 0
 
 
-def _get_taxon_from_taxonomy_by_gbifId(conn, gbif_id):
-    # Search the taxonomy table by gbif_id
-    # Returns a dict such as: {'id': 1, 'gbifId': 5, 'scientificName': 'Fungi', 'rankId': 1, 'acceptedId': None, 'parentId': None}
-    # If nothing is found, returns all None: {'id': None, 'gbifId': None, ...}
-    template = """SELECT * FROM taxonomy WHERE "gbifId" = {{ gbifId }} """
-    taxon_cur = execute_sql_from_jinja_string(conn, sql_string=template, context={'gbifId': gbif_id})
-    taxon_values = taxon_cur.fetchall()
-    cols_taxonomy = list(map(lambda x: x[0], taxon_cur.description))
+def _add_taxon_tree(conn, gbif_key, taxonomy_index, rank_ids=None, backbone=None, new_taxa=None, name_usages=None):
+    """ Add a GBIF Backbone taxon to the taxonomy table, after its parents and accepted taxa (if not yet present)
+
+    Params: taxonomy_index is the (run-scoped) dict gbifId -> taxonomy row, as returned by _load_taxonomy_index, and
+    rank_ids a dict rank name -> rank id (see _insert_or_get_rank). backbone is a LocalBackbone (None to use the GBIF
+    API). The gbifId of the inserted taxa are appended to new_taxa (optional list), parents first. name_usages is the
+    (run-scoped) memo of the GBIF Backbone entries (see _name_usage).
+
+    The tree is walked iteratively (with an explicit stack), so deep lineages don't hit the recursion limit.
+
+    Returns the taxonomy id of the taxon."""
+    if name_usages is None:
+        name_usages = {}
+    stack = [gbif_key]
+    # taxa whose parent/accepted taxon have already been pushed on the stack (protects against cycles in the data)
+    expanded = set()
+    # taxa inserted or checked during this walk
+    done = set()
+
+    while stack:
+        key = stack[-1]
+        depth = len(stack) - 1
+        if key in done:
+            stack.pop()
+            continue
+
+        # get info from GBIF Backbone
+        name_usage_info = _name_usage(key, backbone=backbone, name_usages=name_usages)
+        gbifId = name_usage_info.get('key')
+        assert gbifId == key, f"Inconsistency in GBIF database. Got {key} from name_usage({gbifId})."
+        scientificName = name_usage_info.get('scientificName')
+        gbif_parentKey = name_usage_info.get("parentKey")
+        # get accepted GBIF Key synonyms are pointing to (None for accepted taxa)
+        gbif_acceptedKey = name_usage_info.get('acceptedKey')
+
+        if key not in taxonomy_index and key not in expanded:  # Taxon is not yet in our taxonomy table
+            log_verbose(f"Adding the taxon with GBIF key {key} ({scientificName}) to the taxonomy table", depth=depth)
+            expanded.add(key)
+            missing_keys = []
+            if gbif_parentKey is None:
+                log_verbose("According to GBIF, this is a root taxon (no more parents to insert)", depth=depth)
+            elif gbif_parentKey not in taxonomy_index:
+                log_verbose("According to GBIF, this is *not* a root taxon, we'll insert parents first", depth=depth)
+                missing_keys.append(gbif_parentKey)
+            if gbif_acceptedKey is None:
+                log_verbose("According to GBIF, this is *not* a synonym (no accepted taxon to insert)", depth=depth)
+            elif gbif_acceptedKey not in taxonomy_index:
+                log_verbose("According to GBIF, this is a synonym. We'll insert accepted taxon first", depth=depth)
+                missing_keys.append(gbif_acceptedKey)
+            if missing_keys:
+                stack += missing_keys
+                continue
+
+        stack.pop()
+        done.add(key)
+        taxon = {
+            'gbifId': gbifId,
+            'scientificName': scientificName,
+            'rankId': _insert_or_get_rank(conn=conn, rank_name=name_usage_info.get('rank'), rank_ids=rank_ids),
+            'parentId': taxonomy_index.get(gbif_parentKey, {}).get('id'),
+            'acceptedId': taxonomy_index.get(gbif_acceptedKey, {}).get('id')
+        }
 
-    assert len(taxon_values) <= 1, f"Multiple taxa with gbifId = {gbif_id} in taxonomy."
-    if len(taxon_values) == 1:
-        taxon = dict(zip(cols_taxonomy, taxon_values[0]))
-    else:
-        taxon = dict.fromkeys(cols_taxonomy)
-    return taxon
-
-
-def _add_taxon_tree(conn, gbif_key, depth=0):
-    # Params: depth is the recursion level (used for log indentation)
-
-    # get info from GBIF Backbone
-    name_usage_info = pygbif.name_usage(key=gbif_key)
-    gbifId = name_usage_info.get('key')
-    assert gbifId == gbif_key, f"Inconsistency in GBIF database. Got {gbif_key} from name_usage({gbifId})."
-    scientificName = name_usage_info.get('scientificName')
-
-    gbif_parentKey = name_usage_info.get("parentKey")
-    parent_in_taxonomy = _get_taxon_from_taxonomy_by_gbifId(conn, gbif_id=gbif_parentKey)
-
-    # get accepted GBIF Key synonyms are pointing to (None for accepted taxa)
-    gbif_acceptedKey = name_usage_info.get('acceptedKey')
-    accepted_in_taxonomy = _get_taxon_from_taxonomy_by_gbifId(conn, gbif_id=gbif_acceptedKey)
-    print_indent(f"Recursively adding the taxon with GBIF key {gbif_key} ({scientificName}) to the taxonomy table", depth=depth)
-
-    taxon = {
-        'gbifId': gbifId,
-        'scientificName': scientificName,
-        'rankId': _insert_or_get_rank(conn=conn, rank_name=name_usage_info.get('rank')),
-        'parentId': parent_in_taxonomy.get('id'),
-        'acceptedId': accepted_in_taxonomy.get('id')
-    }
-    # find and add taxon recursively to taxonomy table
-    taxon_in_taxonomy = _get_taxon_from_taxonomy_by_gbifId(conn, gbif_id=gbif_key)
-
-    if taxon_in_taxonomy.get('gbifId') is None:  # Taxon is not yet in our taxonomy table
-        if gbif_parentKey is None:
-            print_indent("According to GBIF, this is a root taxon (no more parents to insert)", depth=depth)
-        else:
-            print_indent("According to GBIF, this is *not* a root taxon, we'll insert parents first", depth=depth)
-            _add_taxon_tree(conn, gbif_key=gbif_parentKey, depth=depth+1)
-            # get the updated parentId
-            parent_in_taxonomy = _get_taxon_from_taxonomy_by_gbifId(conn, gbif_id=gbif_parentKey)
-            taxon['parentId'] = parent_in_taxonomy.get('id')
-        if gbif_acceptedKey is None:
-            print_indent("According to GBIF, this is *not* a synonym (no accepted taxon to insert)", depth=depth)
-        else:
-            print_indent("According to GBIF, this is a synonym. We'll insert accepted taxon first", depth=depth)
-            _add_taxon_tree(conn, gbif_key=gbif_acceptedKey, depth=depth + 1)
-            # get the updated acceptedId
-            accepted_in_taxonomy = _get_taxon_from_taxonomy_by_gbifId(conn, gbif_id=gbif_acceptedKey)
-            taxon['acceptedId'] = accepted_in_taxonomy.get('id')
-        newly_inserted_id = _insert_new_entry_taxonomy(conn, taxon=taxon)
-        if (taxon['acceptedId'] is None):
-            msg = f"Taxon {taxon['scientificName']} inserted in taxonomy (id = {newly_inserted_id}, parentId = {taxon['parentId']})."
+        if key not in taxonomy_index:
+            newly_inserted_id = _insert_new_entry_taxonomy(conn, taxonomy_index, taxon=taxon, new_taxa=new_taxa)
+            if (taxon['acceptedId'] is None):
+                msg = f"Taxon {taxon['scientificName']} inserted in taxonomy (id = {newly_inserted_id}, parentId = {taxon['parentId']})."
+            else:
+                msg = f"Taxon {taxon['scientificName']} inserted in taxonomy (id = {newly_inserted_id}, parentId = {taxon['parentId']}, acceptedId = {taxon['acceptedId']})."
+            log_verbose(msg, depth=depth)
+        else:  # The taxon already appears in the taxonomy table
+            log_verbose("This taxon already appears in the taxonomy table", depth=depth)
+            _update_taxonomy_if_needed(conn, taxonomy_index, taxon=taxon, depth=depth)
+
+    return taxonomy_index[gbif_key]['id']
+
+
+def _collect_new_lineages(gbif_keys, taxonomy_index, backbone=None, name_usages=None):
+    """ Collect the GBIF Backbone entries of the taxa (and of their parents and accepted taxa) not yet in taxonomy
+
+    Returns a list of name_usage info, deduplicated and topologically sorted: parents and accepted taxa come before the
+    taxa pointing to them. name_usages is the (run-scoped) memo of the GBIF Backbone entries (see _name_usage)."""
+    if name_usages is None:
+        name_usages = {}
+    ordered_name_usages = []
+    visited = set()
+    for gbif_key in gbif_keys:
+        # iterative depth-first walk, a taxon is added to the list once its parent and accepted taxon have been
+        stack = [(gbif_key, False)]
+        while stack:
+            key, dependencies_added = stack.pop()
+            if dependencies_added:
+                ordered_name_usages.append(_name_usage(key, backbone=backbone, name_usages=name_usages))
+                continue
+            if key in taxonomy_index or key in visited:
+                continue
+            visited.add(key)
+            name_usage_info = _name_usage(key, backbone=backbone, name_usages=name_usages)
+            stack.append((key, True))
+            for dependency in (name_usage_info.get('parentKey'), name_usage_info.get('acceptedKey')):
+                if dependency is not None and dependency not in taxonomy_index and dependency not in visited:
+                    stack.append((dependency, False))
+    return ordered_name_usages
+
+
+def _bulk_insert_taxa(conn, name_usages, taxonomy_index, rank_ids, new_taxa=None):
+    """ Insert new taxa (topologically sorted name_usage info, see _collect_new_lineages) in taxonomy
+
+    All taxa are inserted by a single multi-row INSERT ... RETURNING, then the parentId/acceptedId pointing to taxa
+    of the same batch are set by a single UPDATE. The taxonomy_index is kept in sync and the gbifId of the inserted
+    taxa are appended to new_taxa (optional list), in the same (topological) order.
+
+    Returns the number of inserted taxa."""
+    if not name_usages:
+        return 0
+
+    new_keys = {name_usage_info['key'] for name_usage_info in name_usages}
+    taxa = []
+    for name_usage_info in name_usages:
+        parent_key = name_usage_info.get('parentKey')
+        accepted_key = name_usage_info.get('acceptedKey')
+        taxa.append({
+            'gbifId': name_usage_info['key'],
+            'scientificName': name_usage_info.get('scientificName'),
+            'rankId': _insert_or_get_rank(conn=conn, rank_name=name_usage_info.get('rank'), rank_ids=rank_ids),
+            # pointers to taxa of this batch are resolved after the insertion
+            'parentId': taxonomy_index.get(parent_key, {}).get('id') if parent_key not in new_keys else None,
+            'acceptedId': taxonomy_index.get(accepted_key, {}).get('id') if accepted_key not in new_keys else None,
+            'parentKey': parent_key,
+            'acceptedKey': accepted_key
+        })
+
+    inserted = execute_values_sql(
+        conn,
+        """INSERT INTO taxonomy ("gbifId", "scientificName", "rankId", "parentId", "acceptedId") VALUES %s
+           RETURNING "id", "gbifId" """,
+        [(t['gbifId'], t['scientificName'], t['rankId'], t['parentId'], t['acceptedId']) for t in taxa],
+        page_size=len(taxa),
+        fetch=True)
+    taxonomy_ids = dict((gbif_id, taxonomy_id) for taxonomy_id, gbif_id in inserted)
+
+    links = []
+    for t in taxa:
+        parent_key = t.pop('parentKey')
+        accepted_key = t.pop('acceptedKey')
+        if parent_key in new_keys:
+            t['parentId'] = taxonomy_ids.get(parent_key)
+        if accepted_key in new_keys:
+            t['acceptedId'] = taxonomy_ids.get(accepted_key)
+        if parent_key in new_keys or accepted_key in new_keys:
+            links.append((taxonomy_ids[t['gbifId']], t['parentId'], t['acceptedId']))
+        taxonomy_index[t['gbifId']] = dict(t, id=taxonomy_ids[t['gbifId']], exotic_be=None)
+
+    if links:
+        execute_values_sql(
+            conn,
+            """UPDATE taxonomy SET "parentId" = v."parentId", "acceptedId" = v."acceptedId"
+               FROM (VALUES %s) AS v("id", "parentId", "acceptedId")
+               WHERE taxonomy."id" = v."id" """,
+            links,
+            template="(%s, %s::integer, %s::integer)",
+            page_size=len(links))
+
+    add_to_taxonomy_closure(conn, list(taxonomy_ids.values()))
+    if new_taxa is not None:
+        new_taxa.extend(t['gbifId'] for t in taxa)
+
+    return len(taxa)
+
+
+def _bulk_update_match_info(conn, matches_info):
+    # matches_info: list of (scientificname row id, match_info dict) tuples
+    # As in _update_match_info, None values don't overwrite the existing values (except for taxonomyId)
+    execute_values_sql(
+        conn,
+        """UPDATE scientificname SET
+               "taxonomyId" = v."taxonomyId",
+               "lastMatched" = COALESCE(v."lastMatched", scientificname."lastMatched"),
+               "matchType" = COALESCE(v."matchType", scientificname."matchType"),
+               "matchConfidence" = COALESCE(v."matchConfidence", scientificname."matchConfidence"),
+               "backboneVersion" = COALESCE(v."backboneVersion", scientificname."backboneVersion")
+           FROM (VALUES %s) AS v("id", "taxonomyId", "lastMatched", "matchType", "matchConfidence",
+                                 "backboneVersion")
+           WHERE scientificname."id" = v."id" """,
+        [(row_id, m['taxonomyId'], m['lastMatched'], m['matchType'], m['matchConfidence'], m['backboneVersion'])
+         for row_id, m in matches_info],
+        template="(%s, %s::integer, %s::timestamp with time zone, %s::gbifmatchtype, %s::smallint, %s::varchar)",
+        page_size=len(matches_info))
+
+
+def _add_matches_in_batch(conn, matches, taxonomy_index, rank_ids, last_matched, backbone=None,
+                          backbone_version=None, new_taxa=None, name_usages=None):
+    """ Write the results of a chunk of matches ((row, gbif_taxon_info) tuples, see _match_names) to the database
+
+    The lineages of all matched names are inserted at once (see _bulk_insert_taxa) and the match information of all
+    rows is written by a single UPDATE.
+
+    Returns the number of matched names."""
+    matched_keys = [gbif_taxon_info.get('usageKey') for _, gbif_taxon_info in matches
+                    if gbif_taxon_info['matchType'] != 'NONE']
+    already_present_keys = {gbif_key for gbif_key in matched_keys if gbif_key in taxonomy_index}
+
+    new_name_usages = _collect_new_lineages(matched_keys, taxonomy_index, backbone=backbone, name_usages=name_usages)
+    n_inserted = _bulk_insert_taxa(conn, new_name_usages, taxonomy_index, rank_ids, new_taxa=new_taxa)
+    _insert_new_entry_taxonomy.counter += n_inserted
+    log_verbose(f"{n_inserted} taxa inserted in taxonomy for a batch of {len(matches)} names.")
+
+    # taxa already in taxonomy: update them if GBIF changed something
+    for gbif_key in already_present_keys:
+        name_usage_info = _name_usage(gbif_key, backbone=backbone, name_usages=name_usages)
+        taxon = {
+            'gbifId': gbif_key,
+            'scientificName': name_usage_info.get('scientificName'),
+            'rankId': _insert_or_get_rank(conn=conn, rank_name=name_usage_info.get('rank'), rank_ids=rank_ids),
+            'parentId': taxonomy_index.get(name_usage_info.get('parentKey'), {}).get('id'),
+            'acceptedId': taxonomy_index.get(name_usage_info.get('acceptedKey'), {}).get('id')
+        }
+        _update_taxonomy_if_needed(conn, taxonomy_index, taxon=taxon)
+
+    matches_info = []
+    for row, gbif_taxon_info in matches:
+        match_info = {
+            'taxonomyId': None,
+            'lastMatched': last_matched,
+            'matchType': gbif_taxon_info.get('matchType'),
+            'matchConfidence': gbif_taxon_info.get('confidence'),
+            'backboneVersion': backbone_version
+        }
+        if gbif_taxon_info['matchType'] != 'NONE':
+            match_info['taxonomyId'] = taxonomy_index[gbif_taxon_info.get('usageKey')]['id']
         else:
-            msg = f"Taxon {taxon['scientificName']} inserted in taxonomy (id = {newly_inserted_id}, parentId = {taxon['parentId']}, acceptedId = {taxon['acceptedId']})."
-        print_indent(msg, depth=depth)
-    else:  # The taxon already appears in the taxonomy table
-        print_indent("This taxon already appears in the taxonomy table", depth=depth)
-        # get the updated parentId
-        parent_in_taxonomy = _get_taxon_from_taxonomy_by_gbifId(conn, gbif_id=gbif_parentKey)
-        taxon['parentId'] = parent_in_taxonomy.get('id')
-        #  get the updated acceptedId
-        accepted_in_taxonomy = _get_taxon_from_taxonomy_by_gbifId(conn, gbif_id=gbif_acceptedKey)
-        taxon['acceptedId'] = accepted_in_taxonomy.get('id')
-        _update_taxonomy_if_needed(conn, taxon_in_taxonomy=taxon_in_taxonomy, taxon=taxon, depth=depth)
-
-
-def gbif_match(conn, config_parser, unmatched_only=True):
+            name = row['scientificName']
+            if row['authorship'] is not None:
+                name += " " + row['authorship']
+            log_verbose(f"No match found for {name} (id: {row['id']}).")
+        matches_info.append((row['id'], match_info))
+    _bulk_update_match_info(conn, matches_info)
+
+    return len(matched_keys)
+
+
+def _get_backbone_version(backbone=None):
+    # Version of the GBIF Backbone used for matching: the one of the API, or of the LocalBackbone if given
+    if backbone is not None:
+        return backbone.version()
+
+    backbone_version = gbif_backbone_version()
+    # the cached GBIF responses about names are outdated when a new backbone is published
+    cache = get_gbif_cache()
+    if cache is not None and cache.invalidate_if_changed('backboneVersion', backbone_version,
+                                                         endpoints=['species/match', 'species']):
+        msg = f"New GBIF Backbone version ({backbone_version}): cached name responses removed."
+        print(msg)
+        logging.info(msg)
+    return backbone_version
+
+
+def gbif_match(conn, config_parser, unmatched_only=True, after_id=None, checkpoint=None, on_new_taxa=None):
+    # Names are processed by increasing id. after_id (optional): only process the names with a greater id (to resume an
+    # interrupted run). checkpoint (optional): called with the id of the last processed name just before each commit,
+    # in the same transaction
+    #
+    # on_new_taxa (optional): called after each commit with the list of the taxa inserted in taxonomy by the committed
+    # batch (dicts with id, gbifId, scientificName, parentId and acceptedId), parents and accepted taxa first
+    #
+    # If incremental is True in the [gbif_match] section of config.ini, only the names never matched, matched more than
+    # max-match-age-days ago or matched against another version of the GBIF Backbone are processed (unmatched_only is
+    # then ignored)
+    # the taxa added or moved below are also written to taxonomy_closure
+    create_taxonomy_closure_if_missing(conn)
     limit = config_parser.get('gbif_match', 'scientificnames-limit')
     demo = config_parser.getboolean('demo_mode', 'demo')
+
+    # Match on the GBIF API (default) or on a local copy of the GBIF Backbone
+    if config_parser.get('gbif_match', 'backend', fallback='api') == 'local':
+        backbone = open_local_backbone(config_parser)
+        print(f"Using local GBIF Backbone: {backbone.path}")
+    else:
+        backbone = None
+    backbone_version = _get_backbone_version(backbone)
+    print(f"GBIF Backbone version: {backbone_version}")
+
+    incremental = config_parser.getboolean('gbif_match', 'incremental', fallback=False)
+    matched_before = None
+    if incremental:
+        max_match_age_days = config_parser.get('gbif_match', 'max-match-age-days', fallback='')
+        if max_match_age_days:
+            matched_before = datetime.datetime.now() - datetime.timedelta(days=float(max_match_age_days))
+
     # get data from the scientificname table
     scientificname_cur = execute_sql_from_file(conn,
                                     'get_names_scientificname.sql',
                                     {'limit': limit,
                                      'demo': demo,
-                                     'unmatched_only': unmatched_only},
+                                     'unmatched_only': unmatched_only,
+                                     'incremental': incremental,
+                                     'matched_before': matched_before,
+                                     'backbone_version': backbone_version,
+                                     'after_id': after_id},
                                     dict_cursor=True)
     total_sn_count = scientificname_cur.rowcount
     n_taxa_message = f"Number of taxa in scientificname table: {total_sn_count}"
     if demo:
         n_taxa_message += " (demo mode)"
+    if incremental:
+        n_taxa_message += " (incremental: names not matched yet, matched against another backbone version"
+        if matched_before is not None:
+            n_taxa_message += f" or before {matched_before}"
+        n_taxa_message += ")"
     print(n_taxa_message)
+    if total_sn_count == 0:
+        # e.g. incremental run without new names, or resumed run interrupted after its last checkpoint
+        msg = "No names to match."
+        print(msg)
+        logging.info(msg)
+        return
     log = f"Match names (scientificName + authorship) to GBIF Backbone"
     if demo:
         log += " (demo mode)"
     print(log)
     logging.info(log)
 
+    # Matching (network) is done by a pool of workers, database writes stay sequential (in this thread) so that taxa
+    # shared by multiple names are inserted only once
+    workers = config_parser.getint('gbif_match', 'workers', fallback=1)
+    max_requests_per_second = config_parser.get('gbif_match', 'max-requests-per-second', fallback='')
+    set_gbif_rate_limit(float(max_requests_per_second) if max_requests_per_second else None)
+    if workers > 1:
+        print(f"Matching with {workers} workers.")
+
+    # run-scoped indexes, to avoid most of the per-taxon queries
+    taxonomy_index = _load_taxonomy_index(conn)
+    rank_ids = {}
+    # memo of the GBIF Backbone entries (key -> name_usage info), filled by the matching workers
+    name_usages = {}
+    # names are normalized and the rows sharing a name are matched once (see _canonical_name)
+    groups = _MatchGroups(enabled=config_parser.getboolean('gbif_match', 'deduplicate-names', fallback=True))
+
     start = time.time()
     match_count = 0
 
     last_matched = datetime.datetime.now()
     print(f"Timestamp used for this (whole) match process: {last_matched}")
 
-    # match names to GBIF Backbone
-    for row in scientificname_cur:
-        row_id = row['id']
-        # get name to check
-        name = row['scientificName']
-        if row['authorship'] is not None:
-            name += " " + row['authorship']
-        print(f'Try matching the "{name}" name...')
-
-        # initialize match information
-        match_info = {
-            'taxonomyId': None,
-            'lastMatched': last_matched,
-            'matchType': None,
-            'matchConfidence': None
-        }
+    # id of the last processed name, saved by checkpoint with each batch
+    last_row_id = None
 
-        # match name
-        gbif_taxon_info = pygbif.name_backbone(name=name, strict=True)
+    # row mode: match information of the first row of each group (group key -> match_info), and of the other rows of
+    # the groups ((row id, match_info) tuples), written by a single UPDATE before each commit
+    group_match_infos = {}
+    group_member_matches_info = []
 
-        match_info['matchType'] = gbif_taxon_info.get('matchType')
-        match_info['matchConfidence'] = gbif_taxon_info.get('confidence')
+    def _checkpoint():
+        if group_member_matches_info:
+            _bulk_update_match_info(conn, group_member_matches_info)
+            group_member_matches_info.clear()
+        if checkpoint is not None and last_row_id is not None:
+            checkpoint(last_row_id)
 
-        if gbif_taxon_info['matchType'] != 'NONE':
-            match_count += 1
+    # gbifId of the taxa inserted by the current (not yet committed) batch, see on_new_taxa
+    new_taxa = [] if on_new_taxa is not None else None
 
-            gbifId = gbif_taxon_info.get('usageKey')
-            _add_taxon_tree(conn, gbifId)
-            taxon = _get_taxon_from_taxonomy_by_gbifId(conn, gbif_id=gbifId)
-            match_info['taxonomyId'] = taxon['id']
+    def _publish_new_taxa():
+        if new_taxa:
+            on_new_taxa([{k: taxonomy_index[gbif_id][k] for k in TAXON_FIELDS} for gbif_id in new_taxa])
+            new_taxa.clear()
 
+    # match names to GBIF Backbone
+    # writes are committed by batches (see commit-every-rows and commit-every-seconds)
+    with batch_transaction(conn, config_parser, 'gbif_match', before_commit=_checkpoint,
+                           after_commit=_publish_new_taxa) as transaction:
+        matches = _match_names(scientificname_cur, backbone=backbone, workers=workers, groups=groups,
+                               name_usages=name_usages)
+        batch_size = config_parser.get('gbif_match', 'batch-size', fallback='')
+        progress = ProgressReporter("Match names to GBIF Backbone", total=total_sn_count)
+        if batch_size:
+            # batch mode: taxa and match information are written for chunks of batch_size names
+            batch_size = int(batch_size)
+            while True:
+                batch = list(itertools.islice(matches, batch_size))
+                if not batch:
+                    break
+                match_count += _add_matches_in_batch(conn, batch, taxonomy_index=taxonomy_index, rank_ids=rank_ids,
+                                                     last_matched=last_matched, backbone=backbone,
+                                                     backbone_version=backbone_version, new_taxa=new_taxa,
+                                                     name_usages=name_usages)
+                last_row_id = batch[-1][0]['id']
+                transaction.row_done(len(batch))
+                progress.update(len(batch))
         else:
-            log = f"No match found for {name} (id: {row_id})."
-            print(log)
-            logging.warning(log)
-
-        print(f"Add match information (and taxonomiyId, if a match was found) to scientificname for {name} (id: {row_id}).")
-        _update_match_info(conn, match_info, row_id)
-        if (row_id % 10 == 9) and (row_id < total_sn_count - 1): # Get time info after multiple of 10 taxa
-            elapsed_time = time.time() - start
-            # notice expected time as calculated below is highly overestimated at the beginning as all trees up to
-            # kingdoms have to be built at the beginning
-            expected_time = elapsed_time / (row_id + 1) * (total_sn_count - row_id - 1)
-            print(f"{row_id + 1}/{total_sn_count} taxa handled in {round(elapsed_time, 2)}s. Expected time to go: {expected_time}s.")
-
+            for row, gbif_taxon_info in matches:
+                row_id = row['id']
+                group_key = groups.key(row)
+                if group_key is not None and group_key in group_match_infos:
+                    # same name as an already written row: same match information, written with the next commit
+                    match_info = group_match_infos[group_key]
+                    if match_info['taxonomyId'] is not None:
+                        match_count += 1
+                    group_member_matches_info.append((row_id, match_info))
+                    last_row_id = row_id
+                    transaction.row_done()
+                    progress.update()
+                    continue
+
+                # get name to check
+                name = row['scientificName']
+                if row['authorship'] is not None:
+                    name += " " + row['authorship']
+                log_verbose(f'Try matching the "{name}" name...')
+
+                # initialize match information
+                match_info = {
+                    'taxonomyId': None,
+                    'lastMatched': last_matched,
+                    'matchType': None,
+                    'matchConfidence': None,
+                    'backboneVersion': backbone_version
+                }
+
+                match_info['matchType'] = gbif_taxon_info.get('matchType')
+                match_info['matchConfidence'] = gbif_taxon_info.get('confidence')
+
+                if gbif_taxon_info['matchType'] != 'NONE':
+                    match_count += 1
+
+                    gbifId = gbif_taxon_info.get('usageKey')
+                    match_info['taxonomyId'] = _add_taxon_tree(conn, gbifId, taxonomy_index=taxonomy_index,
+                                                               rank_ids=rank_ids, backbone=backbone,
+                                                               new_taxa=new_taxa, name_usages=name_usages)
+
+                else:
+                    log_verbose(f"No match found for {name} (id: {row_id}).")
+
+                log_verbose(f"Add match information (and taxonomiyId, if a match was found) to scientificname for {name} (id: {row_id}).")
+                _update_match_info(conn, match_info, row_id)
+                if group_key is not None:
+                    group_match_infos[group_key] = match_info
+                last_row_id = row_id
+                transaction.row_done()
+                # notice the expected time is highly overestimated at the beginning as all trees up to kingdoms have
+                # to be built at the beginning
+                progress.update()
+        progress.close()
 
     # Logging and statistics
     end = time.time()
@@ -254,10 +728,17 @@ def gbif_match(conn, config_parser, unmatched_only=True):
     n_matched_taxa = f"Number of matched names: {match_count}/{total_sn_count} ({n_matched_taxa_perc:.2f}%)."
     print(n_matched_taxa)
     logging.info(n_matched_taxa)
+    if groups.enabled:
+        msg = f"Distinct names (after normalization) matched: {groups.n_groups} for {groups.n_rows} rows."
+        print(msg)
+        logging.info(msg)
     print(f"Total number of insertions in the taxonomy table: {_insert_new_entry_taxonomy.counter}")
     elapsed_time = f"Match to GBIF Backbone performed in {round(end - start)}s."
     print(elapsed_time)
     logging.info(elapsed_time)
+    cache_stats = gbif_cache_stats_message()
+    print(cache_stats)
+    logging.info(cache_stats)
 
 
 if __name__ == "__main__":
@@ -1,23 +1,182 @@
+import atexit
 import configparser
+import contextlib
+import datetime
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+import requests
 from jinja2 import Environment
 from jinjasql import JinjaSql
-from pygbif import species
+from pygbif import species, registry
+
+from metrics import metrics
 
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
 CONFIG_FILE_PATH = './config.ini'
 
+DATABASE_DEFAULT_POOL_SIZE = 8
+DEFAULT_COMMIT_EVERY_ROWS = 1000
+DEFAULT_COMMIT_EVERY_SECONDS = 10
+
+# name_usage: maximum page size allowed by the GBIF API, and number of pages fetched in advance by iter_name_usage
+NAME_USAGE_MAX_PAGE_SIZE = 1000
+NAME_USAGE_PREFETCH_PAGES = 2
+
+# GBIF API calls failing because of network errors or server-side errors (HTTP 429 and 5xx) are retried, after 1s,
+# then 2s, 4s...
+GBIF_MAX_RETRIES = 3
+GBIF_RETRY_DELAY_SECONDS = 1
+
+# logging: see setup_log_file and ProgressReporter
+DEFAULT_PROGRESS_EVERY_SECONDS = 10
+PROGRESS_BAR_WIDTH = 30
+
+# number of rows fetched at once from the server-side cursors (see iter_sql_from_jinja_string)
+DEFAULT_ITERSIZE = 10000
+
+# maximum length of the statements labels in the metrics (see metrics.py)
+STATEMENT_LABEL_MAX_LENGTH = 80
+
+# GBIF datasetKey of the GBIF Backbone Taxonomy
+GBIF_BACKBONE_DATASET_KEY = 'd7dddbf4-2cf0-4f39-9b2a-bb099caae36c'
+
+GBIF_CACHE_DEFAULT_PATH = './cache/gbif_cache.sqlite'
+GBIF_CACHE_DEFAULT_TTL_DAYS = 30
+# fraction of the TTL under which the lastAccess of the cache entries isn't updated (see GbifCache.get)
+GBIF_CACHE_LAST_ACCESS_RESOLUTION = 0.01
+GBIF_CACHE_DEFAULT_MAX_ENTRIES = 1000000
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """ One JSON object per record: time, level, message and the structured fields given with
+    extra={'fields': {...}} """
+
+    def format(self, record):
+        entry = {'time': datetime.datetime.fromtimestamp(record.created).isoformat(),
+                 'level': record.levelname,
+                 'message': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+
+_log_listener = None
+_verbose = False
+_progress_every_seconds = DEFAULT_PROGRESS_EVERY_SECONDS
+
+
+def _stop_logging():
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()  # writes the records still in the queue
+        _log_listener = None
+
 
 def setup_log_file(relative_path):
-    logging.basicConfig(filename=os.path.join(__location__, relative_path),
-                        level=logging.INFO,
-                        filemode='w',
-                        format='%(asctime)s | %(message)s')
+    """ Configure logging as set in the [logging] section of config.ini
+
+    The records are written to relative_path (as text or JSON lines) by a background thread: logging calls only put
+    them in a queue. """
+    global _log_listener, _verbose, _progress_every_seconds
+    config_parser = get_config()
+    _verbose = config_parser.getboolean('logging', 'verbose', fallback=False)
+    _progress_every_seconds = config_parser.getfloat('logging', 'progress-every-seconds',
+                                                     fallback=DEFAULT_PROGRESS_EVERY_SECONDS)
+
+    file_handler = logging.FileHandler(os.path.join(__location__, relative_path), mode='w')
+    if config_parser.get('logging', 'format', fallback='text') == 'json':
+        file_handler.setFormatter(JsonLinesFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter('%(asctime)s | %(message)s'))
+
+    _stop_logging()
+    log_queue = queue.SimpleQueue()
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(config_parser.get('logging', 'level', fallback='INFO').upper())
+    _log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    _log_listener.start()
+
+
+atexit.register(_stop_logging)
+
+
+def log_verbose(msg, depth=0):
+    """ Details about a single row (name, taxon...): printed and logged (DEBUG level) only if verbose is True in the
+    [logging] section of config.ini """
+    if _verbose:
+        print_indent(msg, depth)
+        logging.debug(msg)
+
+
+class ProgressReporter(object):
+    """ Periodic summary of the progress of a loop (instead of messages for each row)
+
+    Every `every_seconds` (default: progress-every-seconds in the [logging] section of config.ini), the number of
+    processed items, the rate and the expected time to go are printed (as a progress bar in a terminal) and logged
+    (with structured fields). close() reports the final numbers. """
+
+    def __init__(self, description, total=None, every_seconds=None):
+        self.description = description
+        self.total = total
+        self.every_seconds = every_seconds if every_seconds is not None else _progress_every_seconds
+        self.processed = 0
+        self.start = time.time()
+        self._last_report = self.start
+        self._interactive = sys.stdout.isatty()
+
+    def update(self, n=1):
+        self.processed += n
+        now = time.time()
+        if now - self._last_report >= self.every_seconds:
+            self._report(now)
+
+    def close(self):
+        self._report(time.time(), final=True)
+
+    def _report(self, now, final=False):
+        self._last_report = now
+        elapsed_time = now - self.start
+        rate = self.processed / elapsed_time if elapsed_time > 0 else 0
+        expected_time = None
+        msg = f"{self.description}: {self.processed}"
+        if self.total:
+            msg += f"/{self.total}"
+        msg += f" in {round(elapsed_time, 2)}s ({rate:.1f}/s)."
+        if self.total and rate > 0 and not final:
+            expected_time = round((self.total - self.processed) / rate, 3)
+            msg += f" Expected time to go: {round(expected_time)}s."
+
+        if self._interactive and self.total:
+            done = min(1.0, self.processed / self.total)
+            n_done_chars = int(done * PROGRESS_BAR_WIDTH)
+            progress_bar = '#' * n_done_chars + '.' * (PROGRESS_BAR_WIDTH - n_done_chars)
+            print(f"\r[{progress_bar}] {msg}", end="\n" if final else "", flush=True)
+        else:
+            print(msg)
+        logging.info(msg, extra={'fields': {'progress': self.description,
+                                            'processed': self.processed,
+                                            'total': self.total,
+                                            'elapsedSeconds': round(elapsed_time, 3),
+                                            'ratePerSecond': round(rate, 3),
+                                            'expectedSecondsToGo': expected_time}})
 
 
 def get_config():
@@ -33,25 +192,176 @@ def get_config():
     return config_parser
 
 
+def _get_connection_parameters(config_parser):
+    return {'dbname': config_parser.get('database', 'dbname'),
+            'user': config_parser.get('database', 'user'),
+            'password': config_parser.get('database', 'password'),
+            'host': config_parser.get('database', 'host'),
+            'port': int(config_parser.get('database', 'port')),
+            'options': f"-c search_path={config_parser.get('database', 'schema')}"}
+
+
 def get_database_connection():
     """ Read config.ini (in the same directory than this script) and returns a (psycopg2) connection object"""
     config_parser = get_config()
 
-    conn = psycopg2.connect(dbname=config_parser.get('database', 'dbname'),
-                            user=config_parser.get('database', 'user'),
-                            password=config_parser.get('database', 'password'),
-                            host=config_parser.get('database', 'host'),
-                            port=int(config_parser.get('database', 'port')),
-                            options=f"-c search_path={config_parser.get('database', 'schema')}")
+    conn = psycopg2.connect(**_get_connection_parameters(config_parser))
 
     conn.autocommit = True
     return conn
 
 
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    """ Returns the (process-wide) pool of database connections, for the steps that work with multiple threads
+
+    Its maximum size is configured by pool-size in the [database] section of config.ini. Use it with
+    pooled_connection(). """
+    global _connection_pool
+
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            config_parser = get_config()
+            pool_size = config_parser.getint('database', 'pool-size', fallback=DATABASE_DEFAULT_POOL_SIZE)
+            _connection_pool = psycopg2.pool.ThreadedConnectionPool(minconn=1, maxconn=pool_size,
+                                                                    **_get_connection_parameters(config_parser))
+    return _connection_pool
+
+
+@contextlib.contextmanager
+def pooled_connection():
+    """ Borrow a connection from the pool (same settings as get_database_connection()) and give it back at the end
+
+    with pooled_connection() as conn:
+        execute_sql_from_jinja_string(conn, "SELECT version();") """
+    connection_pool = get_connection_pool()
+    conn = connection_pool.getconn()
+    try:
+        conn.autocommit = True
+        yield conn
+    finally:
+        connection_pool.putconn(conn)
+
+
+class BatchTransaction(object):
+    """ Group the writes made on a connection in transactions of (at most) commit_every_rows rows or
+    commit_every_seconds seconds, instead of one transaction per statement (autocommit)
+
+    with BatchTransaction(conn, commit_every_rows=1000, commit_every_seconds=10) as batch:
+        for ...:
+            execute_sql_from_jinja_string(conn, ...)
+            batch.row_done()
+
+    If an exception is raised, the current batch is rolled back (the already committed batches are kept) and the
+    exception is propagated. The autocommit setting of the connection is restored at the end.
+
+    before_commit (optional) is called just before each commit, so that it can write in the same transaction as the
+    batch (e.g. a checkpoint). after_commit (optional) is called just after each commit, when the batch is visible to
+    the other connections. """
+
+    def __init__(self, conn, commit_every_rows=DEFAULT_COMMIT_EVERY_ROWS,
+                 commit_every_seconds=DEFAULT_COMMIT_EVERY_SECONDS, before_commit=None, after_commit=None):
+        self.conn = conn
+        self.commit_every_rows = commit_every_rows
+        self.commit_every_seconds = commit_every_seconds
+        self.before_commit = before_commit
+        self.after_commit = after_commit
+        self.n_commits = 0
+        self._n_rows = 0
+        self._last_commit = time.time()
+        self._autocommit = None
+
+    def __enter__(self):
+        self._autocommit = self.conn.autocommit
+        self.conn.autocommit = False
+        self._last_commit = time.time()
+        return self
+
+    def row_done(self, n_rows=1):
+        """ To be called after each processed row: commits if one of the thresholds is reached """
+        self._n_rows += n_rows
+        if self._n_rows >= self.commit_every_rows or time.time() - self._last_commit >= self.commit_every_seconds:
+            self.commit()
+
+    def commit(self):
+        if self.before_commit is not None:
+            self.before_commit()
+        self.conn.commit()
+        self.n_commits += 1
+        self._n_rows = 0
+        self._last_commit = time.time()
+        if self.after_commit is not None:
+            self.after_commit()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            self.conn.autocommit = self._autocommit
+        return False
+
+
+def batch_transaction(conn, config_parser, section, before_commit=None, after_commit=None):
+    """ Returns a BatchTransaction for conn, configured by commit-every-rows and commit-every-seconds in the given
+    section of config.ini """
+    return BatchTransaction(conn,
+                            commit_every_rows=config_parser.getint(section, 'commit-every-rows',
+                                                                   fallback=DEFAULT_COMMIT_EVERY_ROWS),
+                            commit_every_seconds=config_parser.getfloat(section, 'commit-every-seconds',
+                                                                        fallback=DEFAULT_COMMIT_EVERY_SECONDS),
+                            before_commit=before_commit,
+                            after_commit=after_commit)
+
+
 def surround_by_quote(a_list):
     return ['"%s"' % an_element for an_element in a_list]
 
 
+# Jinja environment and compiled templates, shared by all calls to execute_sql_from_jinja_string
+_jinja_env = Environment()
+_jinja_env.filters["surround_by_quote"] = surround_by_quote
+_jinja_sql = JinjaSql(env=_jinja_env)
+_compiled_templates = {}
+_compiled_templates_lock = threading.Lock()
+
+
+def _get_compiled_template(sql_string):
+    # Each template string is parsed and compiled only once (per process)
+    template = _compiled_templates.get(sql_string)
+    if template is None:
+        with _compiled_templates_lock:
+            template = _compiled_templates.get(sql_string)
+            if template is None:
+                template = _jinja_env.from_string(sql_string)
+                _compiled_templates[sql_string] = template
+    return template
+
+
+# statement -> label used to group the metrics (see metrics.py)
+_statement_labels = {}
+
+
+def _statement_label(sql_string):
+    # the beginning of the statement, comments and whitespace collapsed
+    if sql_string not in _statement_labels:
+        label = ' '.join(re.sub(r'--[^\n]*', ' ', sql_string).split())
+        if len(label) > STATEMENT_LABEL_MAX_LENGTH:
+            label = label[:STATEMENT_LABEL_MAX_LENGTH] + '...'
+        _statement_labels[sql_string] = label
+    return _statement_labels[sql_string]
+
+
+def get_statements_count():
+    """ Number of statements sent to the database by the execute_* functions of this module (process-wide) """
+    return metrics.statements_count
+
+
 def execute_sql_from_jinja_string(conn, sql_string, context=None, dict_cursor=False):
     # conn: a (psycopg2) connection object
     # sql_string: query template (Jinja-supported string)
@@ -65,22 +375,153 @@ def execute_sql_from_jinja_string(conn, sql_string, context=None, dict_cursor=Fa
     #
     # execute_sql_from_jinja_string(conn, "SELECT version();")
     # execute_sql_from_jinja_string(conn, "SELECT * FROM biodiv.address LIMIT {{limit}}", {'limit': 5})
-    e = Environment()
-    e.filters["surround_by_quote"] = surround_by_quote
-    j = JinjaSql(env=e)
+    return _execute_sql(conn, sql_string, context, dict_cursor, label=_statement_label(sql_string))
+
 
+def _execute_sql(conn, sql_string, context, dict_cursor, label):
     if context is None:
         context = {}
 
-    query, bind_params = j.prepare_query(sql_string, context)
+    query, bind_params = _jinja_sql.prepare_query(_get_compiled_template(sql_string), context)
 
     if dict_cursor:
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
     else:
         cur = conn.cursor()
 
+    start = time.time()
     cur.execute(query, bind_params)
+    metrics.record_statement(label, time.time() - start, cur.rowcount)
+
+    return cur
+
+
+def iter_sql_from_jinja_string(conn, sql_string, context=None, itersize=DEFAULT_ITERSIZE):
+    # Same as execute_sql_from_jinja_string for large SELECT queries: the rows are streamed from a server-side cursor,
+    # itersize rows at a time, instead of being all loaded in memory
+    #
+    # returns a generator of rows (tuples)
+    if context is None:
+        context = {}
+
+    query, bind_params = _jinja_sql.prepare_query(_get_compiled_template(sql_string), context)
+
+    # WITH HOLD: the cursor can be used by connections in autocommit mode
+    cur = conn.cursor(name=f"iter_{id(sql_string)}_{threading.get_ident()}", withhold=True)
+    cur.itersize = itersize
+    start = time.time()
+    n_rows = 0
+    try:
+        cur.execute(query, bind_params)
+        for row in cur:
+            n_rows += 1
+            yield row
+    finally:
+        cur.close()
+        metrics.record_statement(_statement_label(sql_string), time.time() - start, n_rows)
+
+
+# Hot, fixed-shape statements that can be run as server-side prepared statements (see execute_prepared)
+# name -> (parameter types, statement using PostgreSQL positional parameters: $1, $2, ...)
+_prepared_statements = {}
+# name -> number of executions
+_prepared_statements_executions = {}
+# connection -> names of the statements already prepared on that connection
+_prepared_statements_by_connection = weakref.WeakKeyDictionary()
+_use_prepared_statements = None
+
+
+def register_prepared_statement(name, param_types, sql_string):
+    """ Register a fixed-shape statement that can be executed with execute_prepared
+
+    name: a unique name (also used as the PostgreSQL prepared statement name)
+    param_types: list of PostgreSQL types of the parameters, such as ['integer', 'character varying']
+    sql_string: statement (no Jinja) using $1, $2, ... as parameters """
+    _prepared_statements[name] = (param_types, sql_string)
+    _prepared_statements_executions.setdefault(name, 0)
+
+
+def _prepared_statements_enabled():
+    global _use_prepared_statements
+    if _use_prepared_statements is None:
+        _use_prepared_statements = get_config().getboolean('database', 'prepared-statements', fallback=False)
+    return _use_prepared_statements
+
+
+def execute_prepared(conn, name, params, dict_cursor=False):
+    # conn: a (psycopg2) connection object
+    # name: name of a statement registered with register_prepared_statement
+    # params: sequence of parameter values ($1, $2, ...)
+    #
+    # If prepared-statements is enabled ([database] section of config.ini), the statement is prepared (PREPARE) once
+    # per connection, then run with EXECUTE. Otherwise, it is sent as a regular query.
+    #
+    # returns the cursor object
+    param_types, sql_string = _prepared_statements[name]
+
+    if dict_cursor:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    else:
+        cur = conn.cursor()
+
+    start = time.time()
+    n_statements = 1
+    if _prepared_statements_enabled():
+        prepared_statements = _prepared_statements_by_connection.setdefault(conn, set())
+        if name not in prepared_statements:
+            cur.execute(f"PREPARE {name} ({', '.join(param_types)}) AS {sql_string}")
+            n_statements += 1
+            prepared_statements.add(name)
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        query = re.sub(r'\$(\d+)', lambda m: f"%(p{m.group(1)})s", sql_string)
+        cur.execute(query, {f"p{i + 1}": value for i, value in enumerate(params)})
+    metrics.record_statement(f"prepared: {name}", time.time() - start, cur.rowcount, n_statements)
+
+    _prepared_statements_executions[name] += 1
+    return cur
+
+
+def prepared_statements_stats_message():
+    executions = ", ".join(f"{name}: {n}" for name, n in sorted(_prepared_statements_executions.items()))
+    mode = "prepared" if _prepared_statements_enabled() else "not prepared"
+    return f"Executions of fixed-shape statements ({mode}): {executions}."
 
+
+def execute_values_sql(conn, sql_string, values, template=None, page_size=1000, fetch=False):
+    # conn: a (psycopg2) connection object
+    # sql_string: query containing a single %s placeholder, replaced by a multi-row VALUES list (no Jinja here)
+    # values: list of tuples (one per row)
+    # template: row template (default: "(%s, %s, ...)"), useful to cast the values
+    # page_size: maximum number of rows per statement
+    #
+    # returns the rows returned by the query if fetch is True (e.g. with a RETURNING clause), otherwise the cursor
+    #
+    # example:
+    #
+    # execute_values_sql(conn, "INSERT INTO rank(name) VALUES %s RETURNING id", [('GENUS',), ('SPECIES',)], fetch=True)
+    cur = conn.cursor()
+    start = time.time()
+    rows = psycopg2.extras.execute_values(cur, sql_string, values, template=template, page_size=page_size,
+                                          fetch=fetch)
+    # one statement per page
+    metrics.record_statement(_statement_label(sql_string), time.time() - start, len(values),
+                             max(1, -(-len(values) // page_size)))
+    if fetch:
+        return rows
+    return cur
+
+
+def execute_copy_from_file(conn, copy_sql, file):
+    # conn: a (psycopg2) connection object
+    # copy_sql: a COPY ... FROM STDIN statement
+    # file: file-like object with the data to load
+    #
+    # returns the cursor object
+    cur = conn.cursor()
+    start = time.time()
+    cur.copy_expert(copy_sql, file)
+    metrics.record_statement(_statement_label(copy_sql), time.time() - start, cur.rowcount)
     return cur
 
 
@@ -90,62 +531,370 @@ def execute_sql_from_file(conn, filename, context=None, dict_cursor=False):
     # context: the context (dict-like) that will be passed to Jinja
     #
     # returns the cursor object
-    dirname = os.path.dirname(__file__)
-    return execute_sql_from_jinja_string(conn=conn,
-                                         sql_string=open(os.path.join(dirname, 'sql_snippets', filename), 'r').read(),
-                                         context=context,
-                                         dict_cursor=dict_cursor)
+    return _execute_sql(conn, _read_sql_snippet(filename), context, dict_cursor, label=filename)
+
+
+_sql_snippets = {}
+
+
+def _read_sql_snippet(filename):
+    # The content of the sql_snippets files is read only once (per process)
+    if filename not in _sql_snippets:
+        dirname = os.path.dirname(__file__)
+        with open(os.path.join(dirname, 'sql_snippets', filename), 'r') as f:
+            _sql_snippets[filename] = f.read()
+    return _sql_snippets[filename]
+
+
+class GbifCache(object):
+    """ Persistent (SQLite) cache of GBIF API responses
+
+    Responses are stored as JSON, keyed by endpoint and normalized arguments. Entries older than ttl (in seconds) are
+    ignored (and removed), and the least recently used entries (at a resolution of GBIF_CACHE_LAST_ACCESS_RESOLUTION
+    * ttl) are evicted when the cache grows over max_entries.
+    The hits/misses/evictions counters are kept for the current process only. """
+
+    def __init__(self, path, ttl, max_entries):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # GBIF calls can be made from multiple threads, the lock serializes the access to the SQLite connection
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # with WAL, no fsync at each commit (a crash can only lose the last writes, which are cached responses)
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS response (
+                                  "key" TEXT PRIMARY KEY,
+                                  "value" TEXT NOT NULL,
+                                  "created" REAL NOT NULL,
+                                  "lastAccess" REAL NOT NULL)""")
+        self._conn.execute("""CREATE INDEX IF NOT EXISTS response_last_access ON response("lastAccess")""")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS metadata ("name" TEXT PRIMARY KEY, "value" TEXT)""")
+        self._n_entries = self._conn.execute("SELECT COUNT(*) FROM response").fetchone()[0]
+
+    @staticmethod
+    def make_key(endpoint, kwargs):
+        # None-valued arguments are the pygbif defaults: name_usage(key=5) and name_usage(key=5, rank=None) are the
+        # same request
+        normalized_kwargs = {k: v for k, v in kwargs.items() if v is not None}
+        return endpoint + "?" + json.dumps(normalized_kwargs, sort_keys=True, default=str)
+
+    def get(self, key):
+        """ Returns a (found, value) tuple """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("""SELECT "value", "created", "lastAccess" FROM response WHERE "key" = ?""",
+                                     (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                self._conn.execute("""DELETE FROM response WHERE "key" = ?""", (key,))
+                self._n_entries -= 1
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return False, None
+
+            # lastAccess (used for the evictions) is only written again when it's older than a fraction of the TTL,
+            # instead of a write at each hit
+            if now - row[2] > self.ttl * GBIF_CACHE_LAST_ACCESS_RESOLUTION:
+                self._conn.execute("""UPDATE response SET "lastAccess" = ? WHERE "key" = ?""", (now, key))
+            self.hits += 1
+            return True, json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute("""UPDATE response SET "value" = ?, "created" = ?, "lastAccess" = ?
+                                        WHERE "key" = ?""", (json.dumps(value), now, now, key))
+            if cur.rowcount == 0:
+                self._conn.execute("""INSERT INTO response ("key", "value", "created", "lastAccess")
+                                      VALUES (?, ?, ?, ?)""", (key, json.dumps(value), now, now))
+                self._n_entries += 1
+
+            if self._n_entries > self.max_entries:
+                # evict by batches (10% of the cache) so we don't have to do it again at the next insertion
+                n_to_evict = self._n_entries - self.max_entries + max(1, self.max_entries // 10)
+                cur = self._conn.execute("""DELETE FROM response WHERE "key" IN (
+                                                SELECT "key" FROM response ORDER BY "lastAccess" LIMIT ?)""",
+                                         (n_to_evict,))
+                self._n_entries -= cur.rowcount
+                self.evictions += cur.rowcount
+
+    def invalidate_if_changed(self, name, value, endpoints):
+        """ Remove the entries of the given endpoints if the metadata name (e.g. the GBIF Backbone version) has another
+        value than at the previous call
+
+        Returns True if the entries have been removed. """
+        with self._lock:
+            row = self._conn.execute("""SELECT "value" FROM metadata WHERE "name" = ?""", (name,)).fetchone()
+            changed = row is not None and row[0] != value
+            if changed:
+                for endpoint in endpoints:
+                    cur = self._conn.execute("""DELETE FROM response WHERE "key" LIKE ?""", (endpoint + "?%",))
+                    self._n_entries -= cur.rowcount
+            self._conn.execute("""INSERT OR REPLACE INTO metadata ("name", "value") VALUES (?, ?)""", (name, value))
+            return changed
+
+    def stats_message(self):
+        total = self.hits + self.misses
+        hit_ratio = self.hits / total * 100 if total > 0 else 0
+        return f"GBIF cache ({self.path}): {self.hits} hits, {self.misses} misses ({hit_ratio:.2f}% hit ratio), " \
+               f"{self.evictions} evictions, {self._n_entries} entries."
+
+
+class TokenBucket(object):
+    """ Thread-safe token bucket rate limiter
+
+    acquire() blocks until a token is available. Tokens are added at `rate` per second, up to `capacity` (the
+    maximum burst size). """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+
+_gbif_rate_limiter = None
+
+
+def set_gbif_rate_limit(requests_per_second):
+    """ Limit the number of requests per second sent to the GBIF API (cache hits are not limited)
+
+    requests_per_second: None or 0 to disable the limitation """
+    global _gbif_rate_limiter
+    if requests_per_second:
+        _gbif_rate_limiter = TokenBucket(rate=requests_per_second)
+    else:
+        _gbif_rate_limiter = None
+
+
+_gbif_cache = None
+_gbif_cache_initialized = False
+_gbif_cache_init_lock = threading.Lock()
+
+
+def get_gbif_cache():
+    """ Returns the (process-wide) GbifCache configured in the [gbif_cache] section of config.ini
+
+    Returns None if the cache is disabled."""
+    global _gbif_cache, _gbif_cache_initialized
+
+    with _gbif_cache_init_lock:
+        if not _gbif_cache_initialized:
+            config_parser = get_config()
+            if config_parser.getboolean('gbif_cache', 'enabled', fallback=True):
+                path = config_parser.get('gbif_cache', 'path', fallback=GBIF_CACHE_DEFAULT_PATH)
+                ttl_days = config_parser.getfloat('gbif_cache', 'ttl-days', fallback=GBIF_CACHE_DEFAULT_TTL_DAYS)
+                max_entries = config_parser.getint('gbif_cache', 'max-entries',
+                                                   fallback=GBIF_CACHE_DEFAULT_MAX_ENTRIES)
+                _gbif_cache = GbifCache(path=os.path.join(__location__, path),
+                                        ttl=ttl_days * 24 * 3600,
+                                        max_entries=max_entries)
+            _gbif_cache_initialized = True
+
+    return _gbif_cache
+
+
+def _is_transient_gbif_error(exception):
+    if isinstance(exception, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(exception, requests.HTTPError) and exception.response is not None:
+        return exception.response.status_code == 429 or exception.response.status_code >= 500
+    return False
+
+
+def _call_gbif(endpoint, gbif_function, **kwargs):
+    # endpoint: name used in the metrics
+    for attempt in range(GBIF_MAX_RETRIES + 1):
+        if _gbif_rate_limiter is not None:
+            _gbif_rate_limiter.acquire()
+
+        # size of the response(s) (pygbif passes the extra arguments to requests)
+        response_sizes = []
+
+        def record_response_size(response, *args, **hook_kwargs):
+            response_sizes.append(len(response.content))
+
+        start = time.time()
+        try:
+            result = gbif_function(**kwargs, hooks={'response': record_response_size})
+        except Exception as e:
+            metrics.record_gbif_call(endpoint, time.time() - start, sum(response_sizes), error=True)
+            if attempt == GBIF_MAX_RETRIES or not _is_transient_gbif_error(e):
+                raise
+            metrics.record_gbif_retry(endpoint)
+            delay = GBIF_RETRY_DELAY_SECONDS * 2 ** attempt
+            logging.warning(f"GBIF API call ({endpoint}) failed: {e}. Retrying in {delay}s.")
+            time.sleep(delay)
+        else:
+            metrics.record_gbif_call(endpoint, time.time() - start, sum(response_sizes))
+            return result
 
 
-def paginated_name_usage(*args, **kwargs):
-    """Small helper to handle the pagination in pygbif and make sure we get all results in one shot"""
-    PER_PAGE = 100
+def _cached_gbif_call(endpoint, gbif_function, **kwargs):
+    # endpoint: the name used to build the cache key (a given endpoint should always use the same gbif_function)
+    cache = get_gbif_cache()
+    if cache is None:
+        return _call_gbif(endpoint, gbif_function, **kwargs)
 
-    results = []
-    offset = 0
+    key = cache.make_key(endpoint, kwargs)
+    found, value = cache.get(key)
+    metrics.record_gbif_cache(endpoint, hit=found)
+    if not found:
+        value = _call_gbif(endpoint, gbif_function, **kwargs)
+        cache.set(key, value)
+    return value
 
-    while True:
-        resp = species.name_usage(*args, **kwargs, limit=PER_PAGE, offset=offset)
-        results = results + resp['results']
-        if resp['endOfRecords']:
-            break
-        else:
-            offset = offset + PER_PAGE
 
-    return results
+def gbif_name_backbone(**kwargs):
+    """ pygbif.species.name_backbone, through the GBIF cache """
+    return _cached_gbif_call('species/match', species.name_backbone, **kwargs)
 
 
-def print_indent(msg, depth=0, indent=4):
-    print("{}{}".format(" " * (indent * depth), msg))
+def gbif_name_usage(**kwargs):
+    """ pygbif.species.name_usage, through the GBIF cache """
+    return _cached_gbif_call('species', species.name_usage, **kwargs)
 
 
-def insert_or_get_scientificnameid(conn, scientific_name, authorship):
-    """ Insert or select a name in scientificname table based on its scientific name and authorship
+def gbif_dataset_suggest(**kwargs):
+    """ pygbif.registry.dataset_suggest, through the GBIF cache """
+    return _cached_gbif_call('dataset/suggest', registry.dataset_suggest, **kwargs)
 
-        If the scientific name - authorship combination already exists in the scientificname table, select it.
-        Otherwise, insert it in a new row.
 
-        In both cases, returns the row id """
-    sc_name_template = """WITH ins AS (
+def gbif_backbone_version():
+    """ Version (publication date) of the GBIF Backbone currently used by the API
+
+    Not cached: it is used to detect new versions of the backbone. """
+    dataset = _call_gbif('dataset', registry.datasets, uuid=GBIF_BACKBONE_DATASET_KEY)
+    # date only (e.g. 2023-08-28), so that it can be compared with the pubDate of a downloaded backbone archive
+    return (dataset.get('pubDate') or dataset.get('modified'))[:10]
+
+
+def gbif_dataset_modified(dataset_key):
+    """ Last modification timestamp of a GBIF dataset (from the registry)
+
+    Not cached: it is used to detect changes of the dataset. """
+    dataset = _call_gbif('dataset', registry.datasets, uuid=dataset_key)
+    return dataset.get('modified')
+
+
+def gbif_cache_stats_message():
+    cache = get_gbif_cache()
+    if cache is None:
+        return "GBIF cache disabled."
+    return cache.stats_message()
+
+
+def _uncached_gbif_name_usage(**kwargs):
+    return _call_gbif('species', species.name_usage, **kwargs)
+
+
+def iter_name_usage(prefetch=NAME_USAGE_PREFETCH_PAGES, cached=True, **kwargs):
+    """ Generator over all the results of pygbif.species.name_usage (through the GBIF cache, unless cached is False),
+    handling the pagination
+
+    Records are yielded as the pages arrive. Pages have the maximum size allowed by the API and, once we know there is
+    more than one page, the next `prefetch` pages are fetched in background threads while the current one is consumed.
+    """
+    page_size = NAME_USAGE_MAX_PAGE_SIZE
+    name_usage = gbif_name_usage if cached else _uncached_gbif_name_usage
+
+    # most requests (vernacular names of a taxon, ...) fit in a single page: no background thread for those
+    resp = name_usage(**kwargs, limit=page_size, offset=0)
+    yield from resp['results']
+    if resp['endOfRecords']:
+        return
+
+    next_offset = page_size
+    pending_pages = deque()
+    executor = ThreadPoolExecutor(max_workers=max(1, prefetch))
+    try:
+        while True:
+            while len(pending_pages) < max(1, prefetch):
+                pending_pages.append(executor.submit(name_usage, **kwargs, limit=page_size, offset=next_offset))
+                next_offset += page_size
+            resp = pending_pages.popleft().result()
+            yield from resp['results']
+            if resp['endOfRecords']:
+                break
+    finally:
+        # pages prefetched after the end of the records (or not needed anymore if the consumer stopped early)
+        for pending_page in pending_pages:
+            pending_page.cancel()
+        executor.shutdown(wait=False)
+
+
+def paginated_name_usage(**kwargs):
+    """Small helper to handle the pagination in pygbif and make sure we get all results in one shot"""
+    return list(iter_name_usage(**kwargs))
+
+
+def print_indent(msg, depth=0, indent=4):
+    print("{}{}".format(" " * (indent * depth), msg))
+
+
+register_prepared_statement('insert_or_get_scientificnameid', ['character varying', 'character varying'],
+                            """WITH ins AS (
                                 INSERT INTO scientificname ("scientificName", "authorship")
-                                VALUES ({{ scientific_name }}, {{ authorship }})         -- input value
+                                VALUES ($1, $2)         -- input value
                                 ON CONFLICT DO NOTHING
                                 RETURNING scientificname.id
                                 )
                             SELECT id FROM ins
                             UNION  ALL
                             SELECT "id" FROM scientificname          -- 2nd SELECT never executed if INSERT successful
-                            {% if authorship is defined %}
-                                WHERE "scientificName" = {{ scientific_name }} AND "authorship" = {{ authorship }} -- input value a 2nd time
-                            {% else %}
-                                WHERE "scientificName" = {{ scientific_name }} AND "authorship" is NULL -- input value a 2nd time
-                            {% endif %}
-                            LIMIT 1;"""
-    cur = execute_sql_from_jinja_string(conn,
-                                        sql_string=sc_name_template,
-                                        context={'scientific_name': scientific_name,
-                                                 'authorship': authorship},
-                                        dict_cursor=True)
+                            WHERE "scientificName" = $1 AND "authorship" = $2 -- input value a 2nd time
+                            LIMIT 1""")
+register_prepared_statement('insert_or_get_scientificnameid_without_authorship', ['character varying'],
+                            """WITH ins AS (
+                                INSERT INTO scientificname ("scientificName", "authorship")
+                                VALUES ($1, NULL)         -- input value
+                                ON CONFLICT DO NOTHING
+                                RETURNING scientificname.id
+                                )
+                            SELECT id FROM ins
+                            UNION  ALL
+                            SELECT "id" FROM scientificname          -- 2nd SELECT never executed if INSERT successful
+                            WHERE "scientificName" = $1 AND "authorship" is NULL -- input value a 2nd time
+                            LIMIT 1""")
+
+
+def insert_or_get_scientificnameid(conn, scientific_name, authorship):
+    """ Insert or select a name in scientificname table based on its scientific name and authorship
+
+        If the scientific name - authorship combination already exists in the scientificname table, select it.
+        Otherwise, insert it in a new row.
+
+        In both cases, returns the row id """
+    if authorship is None:
+        cur = execute_prepared(conn, 'insert_or_get_scientificnameid_without_authorship', (scientific_name,),
+                               dict_cursor=True)
+    else:
+        cur = execute_prepared(conn, 'insert_or_get_scientificnameid', (scientific_name, authorship),
+                               dict_cursor=True)
     return cur.fetchone()['id']
 
 
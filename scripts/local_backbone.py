@@ -0,0 +1,278 @@
+# Offline alternative to the GBIF API for the matching step (gbif_match.py)
+#
+# The GBIF Backbone Taxonomy is published as a Darwin Core Archive (https://hosted-datasets.gbif.org/datasets/backbone/)
+# This module loads its core file (Taxon.tsv) once into an indexed SQLite database and answers name_backbone (strict)
+# and name_usage queries with the same response shape as the GBIF API (the fields used by gbif_match.py).
+#
+# To build (or rebuild) the local store: download and unzip the backbone archive, set [local_backbone] taxon-file in
+# config.ini and run this script. The store is also (re)built automatically when gbif_match is run with
+# [gbif_match] backend = local and the store is missing or older than taxon-file.
+import csv
+import datetime
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+from helpers import get_config, setup_log_file
+
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+LOCAL_BACKBONE_DEFAULT_PATH = './cache/backbone.sqlite'
+LOCAL_BACKBONE_DEFAULT_TAXON_FILE = '../data/external/backbone/Taxon.tsv'
+
+INSERT_BATCH_SIZE = 50000
+
+# Order of preference when multiple backbone entries share the same name
+TAXONOMIC_STATUS_PRIORITY = ['ACCEPTED', 'DOUBTFUL', 'HOMOTYPIC_SYNONYM', 'HETEROTYPIC_SYNONYM', 'PROPARTE_SYNONYM',
+                             'SYNONYM', 'MISAPPLIED']
+
+# Confidence (same scale as GBIF) returned for matches on the full name / on the canonical name + authorship / on the
+# canonical name only
+CONFIDENCE_FULL_NAME = 99
+CONFIDENCE_CANONICAL_NAME_AND_AUTHORSHIP = 98
+CONFIDENCE_CANONICAL_NAME = 95
+
+
+def _to_int(value):
+    return int(value) if value not in ('', None) else None
+
+
+def _read_pub_date(taxon_file):
+    # Publication date of the backbone, from the metadata (eml.xml) of the archive, next to Taxon.tsv (None if absent)
+    eml_file = os.path.join(os.path.dirname(taxon_file), 'eml.xml')
+    if not os.path.exists(eml_file):
+        return None
+    pub_date = ElementTree.parse(eml_file).getroot().find('.//pubDate')
+    return pub_date.text.strip()[:10] if pub_date is not None and pub_date.text else None
+
+
+def _to_gbif_enum(value):
+    # Taxon.tsv uses lower case labels ("heterotypic synonym"), the API uses enum names ("HETEROTYPIC_SYNONYM")
+    return value.strip().upper().replace(' ', '_') if value else None
+
+
+class LocalBackbone(object):
+    """ Local (SQLite) copy of the GBIF Backbone Taxonomy, indexed by key, parentKey, acceptedKey, canonical name and
+    authorship. """
+
+    def __init__(self, path):
+        self.path = path
+        # the store is read-only once loaded, but gbif_match can query it from multiple threads
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+
+    @classmethod
+    def build(cls, path, taxon_file):
+        """ (Re)create the local store at path from a Taxon.tsv file """
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        msg = f"Loading GBIF Backbone from {taxon_file} into {path}..."
+        print(msg)
+        logging.info(msg)
+        start = time.time()
+
+        conn = sqlite3.connect(tmp_path)
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("""CREATE TABLE taxon (
+                            "key" INTEGER PRIMARY KEY,
+                            "parentKey" INTEGER,
+                            "acceptedKey" INTEGER,
+                            "scientificName" TEXT,
+                            "authorship" TEXT,
+                            "canonicalName" TEXT,
+                            "rank" TEXT,
+                            "taxonomicStatus" TEXT,
+                            "kingdom" TEXT)""")
+        conn.execute("""CREATE TABLE metadata ("name" TEXT PRIMARY KEY, "value" TEXT)""")
+
+        n_rows = 0
+        # Taxon.tsv is not quoted and some names contain quotes: disable csv quoting
+        csv.field_size_limit(sys.maxsize)
+        with open(taxon_file, newline='', encoding='utf-8') as f:
+            taxon_data = csv.DictReader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+            batch = []
+            for row in taxon_data:
+                batch.append((_to_int(row['taxonID']),
+                              _to_int(row.get('parentNameUsageID')),
+                              _to_int(row.get('acceptedNameUsageID')),
+                              row.get('scientificName') or None,
+                              row.get('scientificNameAuthorship') or None,
+                              row.get('canonicalName') or None,
+                              _to_gbif_enum(row.get('taxonRank')),
+                              _to_gbif_enum(row.get('taxonomicStatus')),
+                              row.get('kingdom') or None))
+                if len(batch) >= INSERT_BATCH_SIZE:
+                    conn.executemany("INSERT OR REPLACE INTO taxon VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+                    n_rows += len(batch)
+                    batch = []
+            conn.executemany("INSERT OR REPLACE INTO taxon VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+            n_rows += len(batch)
+
+        # Indexes are created after the load (faster than maintaining them during the inserts)
+        conn.execute("""CREATE INDEX taxon_scientific_name ON taxon("scientificName")""")
+        conn.execute("""CREATE INDEX taxon_canonical_name_authorship ON taxon("canonicalName", "authorship")""")
+        conn.execute("""CREATE INDEX taxon_parent_key ON taxon("parentKey")""")
+        conn.execute("""CREATE INDEX taxon_accepted_key ON taxon("acceptedKey")""")
+
+        source_modified = datetime.datetime.fromtimestamp(os.path.getmtime(taxon_file)).isoformat()
+        conn.executemany("""INSERT INTO metadata VALUES (?, ?)""",
+                         [('taxonFile', os.path.realpath(taxon_file)),
+                          ('taxonFileModified', source_modified),
+                          ('pubDate', _read_pub_date(taxon_file)),
+                          ('loaded', datetime.datetime.now().isoformat()),
+                          ('rowCount', str(n_rows))])
+        conn.commit()
+        conn.close()
+        os.replace(tmp_path, path)
+
+        msg = f"{n_rows} backbone entries loaded in {round(time.time() - start)}s."
+        print(msg)
+        logging.info(msg)
+
+        return cls(path)
+
+    def _query(self, sql, params):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def get_metadata(self, name):
+        rows = self._query("""SELECT "value" FROM metadata WHERE "name" = ?""", (name,))
+        return rows[0][0] if rows else None
+
+    def version(self):
+        """ Version of the loaded backbone: its publication date (as the API, see helpers.gbif_backbone_version) if the
+        archive metadata was available, the modification date of Taxon.tsv otherwise """
+        return self.get_metadata('pubDate') or self.get_metadata('taxonFileModified')
+
+    def name_usage(self, key):
+        """ Same shape as (the used fields of) pygbif.species.name_usage(key=key). Returns {} for unknown keys. """
+        rows = self._query("""SELECT "key", "parentKey", "acceptedKey", "scientificName", "authorship",
+                                     "canonicalName", "rank", "taxonomicStatus", "kingdom"
+                              FROM taxon WHERE "key" = ?""", (key,))
+        if not rows:
+            return {}
+        key, parent_key, accepted_key, scientific_name, authorship, canonical_name, rank, status, kingdom = rows[0]
+        name_usage_info = {'key': key,
+                           'nubKey': key,
+                           'scientificName': scientific_name,
+                           'canonicalName': canonical_name,
+                           'authorship': authorship or '',
+                           'rank': rank,
+                           'taxonomicStatus': status,
+                           'kingdom': kingdom}
+        # like the API, do not return None-valued keys
+        if parent_key is not None:
+            name_usage_info['parentKey'] = parent_key
+        if accepted_key is not None:
+            name_usage_info['acceptedKey'] = accepted_key
+        return name_usage_info
+
+    def iter_canonical_names(self, page_size=INSERT_BATCH_SIZE):
+        """ Generator of (key, canonicalName) tuples for all the entries with a canonical name, by increasing key """
+        last_key = -1
+        while True:
+            rows = self._query("""SELECT "key", "canonicalName" FROM taxon
+                                  WHERE "key" > ? AND "canonicalName" IS NOT NULL
+                                  ORDER BY "key" LIMIT ?""", (last_key, page_size))
+            if not rows:
+                return
+            yield from rows
+            last_key = rows[-1][0]
+
+    def _find_candidates(self, scientific_name, authorship):
+        # returns a (candidate keys, confidence) tuple
+        columns = """SELECT "key", "taxonomicStatus", "acceptedKey" FROM taxon"""
+        if authorship:
+            candidates = self._query(columns + """ WHERE "scientificName" = ?""",
+                                     (f"{scientific_name} {authorship}",))
+            if candidates:
+                return candidates, CONFIDENCE_FULL_NAME
+            candidates = self._query(columns + """ WHERE "canonicalName" = ? AND "authorship" = ?""",
+                                     (scientific_name, authorship))
+            return candidates, CONFIDENCE_CANONICAL_NAME_AND_AUTHORSHIP
+        else:
+            # scientific_name may already contain the authorship
+            candidates = self._query(columns + """ WHERE "scientificName" = ?""", (scientific_name,))
+            if candidates:
+                return candidates, CONFIDENCE_FULL_NAME
+            candidates = self._query(columns + """ WHERE "canonicalName" = ?""", (scientific_name,))
+            return candidates, CONFIDENCE_CANONICAL_NAME
+
+    def name_backbone(self, scientific_name, authorship=None):
+        """ Strict match of a name on the local backbone
+
+        Same shape as (the used fields of) pygbif.species.name_backbone(name=..., strict=True): matchType is EXACT or
+        NONE (multiple equally good candidates pointing to different accepted taxa are reported as NONE, as the API
+        does in strict mode) """
+        no_match = {'matchType': 'NONE', 'confidence': 100, 'synonym': False}
+
+        candidates, confidence = self._find_candidates(scientific_name, authorship)
+        if not candidates:
+            return no_match
+
+        def priority(candidate):
+            status = candidate[1]
+            if status in TAXONOMIC_STATUS_PRIORITY:
+                return TAXONOMIC_STATUS_PRIORITY.index(status)
+            return len(TAXONOMIC_STATUS_PRIORITY)
+
+        best_priority = min(priority(c) for c in candidates)
+        best_candidates = [c for c in candidates if priority(c) == best_priority]
+        # homonyms (or duplicates) resolving to different accepted taxa: ambiguous
+        if len({c[2] if c[2] is not None else c[0] for c in best_candidates}) > 1:
+            no_match['confidence'] = max(0, confidence - 5 * len(best_candidates))
+            no_match['note'] = f"Multiple equal matches for {scientific_name}"
+            return no_match
+
+        usage = self.name_usage(best_candidates[0][0])
+        match = {'usageKey': usage['key'],
+                 'scientificName': usage['scientificName'],
+                 'canonicalName': usage['canonicalName'],
+                 'rank': usage['rank'],
+                 'status': usage['taxonomicStatus'],
+                 'confidence': confidence,
+                 'matchType': 'EXACT',
+                 'synonym': 'acceptedKey' in usage,
+                 'kingdom': usage['kingdom']}
+        if 'acceptedKey' in usage:
+            match['acceptedUsageKey'] = usage['acceptedKey']
+        return match
+
+
+def open_local_backbone(config_parser):
+    """ Returns the LocalBackbone configured in the [local_backbone] section of config.ini
+
+    The store is built first if it doesn't exist yet or if taxon-file has been modified since it was built. """
+    path = os.path.join(__location__,
+                        config_parser.get('local_backbone', 'path', fallback=LOCAL_BACKBONE_DEFAULT_PATH))
+    taxon_file = os.path.join(__location__,
+                              config_parser.get('local_backbone', 'taxon-file', fallback=LOCAL_BACKBONE_DEFAULT_TAXON_FILE))
+
+    store_outdated = os.path.exists(path) and os.path.exists(taxon_file) and \
+        os.path.getmtime(taxon_file) > os.path.getmtime(path)
+    if not os.path.exists(path) or store_outdated:
+        if not os.path.exists(taxon_file):
+            raise Exception(f"GBIF Backbone file ({taxon_file}) not found, cannot build the local backbone.")
+        return LocalBackbone.build(path, taxon_file)
+
+    return LocalBackbone(path)
+
+
+if __name__ == "__main__":
+    config = get_config()
+    setup_log_file("./logs/local_backbone.log")
+    backbone_path = os.path.join(__location__,
+                                 config.get('local_backbone', 'path', fallback=LOCAL_BACKBONE_DEFAULT_PATH))
+    backbone_taxon_file = os.path.join(__location__, config.get('local_backbone', 'taxon-file',
+                                                                fallback=LOCAL_BACKBONE_DEFAULT_TAXON_FILE))
+    LocalBackbone.build(backbone_path, backbone_taxon_file)
@@ -0,0 +1,247 @@
+# Process-wide performance metrics of the transform steps
+#
+# helpers.py records every SQL statement (per statement template) and every GBIF API call (per endpoint). Each record
+# is attributed to the current step (see step()). At the end of a run, the metrics are saved as a JSON summary and/or
+# as a Prometheus textfile (for the node_exporter textfile collector).
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Upper bounds (in seconds) of the latency histograms buckets
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
+
+NO_STEP = 'none'
+
+
+class Histogram(object):
+    """ Latency histogram with fixed buckets (counts per bucket are not cumulative, see cumulative_counts()) """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one: above the last bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """ Returns a list of (upper bound, number of values <= upper bound), the last upper bound being '+Inf' """
+        result = []
+        total = 0
+        for upper_bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            total += count
+            result.append((upper_bound, total))
+        return result
+
+    def as_dict(self):
+        return {'count': self.count,
+                'sum': round(self.sum, 6),
+                'buckets': {str(upper_bound): count for upper_bound, count in self.cumulative_counts()}}
+
+
+class _StatementMetrics(object):
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+        self.latency = Histogram()
+
+
+class _GbifMetrics(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.latency = Histogram()
+
+
+class Metrics(object):
+    """ Registry of the metrics (thread-safe) """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()  # step entered by the current thread
+        self._main_step = NO_STEP  # step of the main thread, the default of the other threads
+        self._active_steps = {}  # step -> [number of threads in the step, start time]
+        self.step_durations = {}
+        self.statements_count = 0
+        self._statements = {}  # (step, statement label) -> _StatementMetrics
+        self._gbif = {}  # (step, endpoint) -> _GbifMetrics
+
+    @property
+    def current_step(self):
+        """ Step of the calling thread: the one it entered, or the one of the main thread (e.g. for the workers started
+        by a step) """
+        return getattr(self._local, 'step', self._main_step)
+
+    @contextlib.contextmanager
+    def step(self, name):
+        """ Attribute the metrics recorded in the block by the current thread (and, in the main thread, by the threads
+        which didn't enter a step) to the step name. Threads running concurrently can each enter their own step.
+
+        The duration of a step is the time during which at least one thread was in it. """
+        in_main_thread = threading.current_thread() is threading.main_thread()
+        previous_step = getattr(self._local, 'step', None)
+        previous_main_step = self._main_step
+        self._local.step = name
+        if in_main_thread:
+            self._main_step = name
+        with self._lock:
+            active = self._active_steps.setdefault(name, [0, time.time()])
+            active[0] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                active[0] -= 1
+                if active[0] == 0:
+                    del self._active_steps[name]
+                    self.step_durations[name] = self.step_durations.get(name, 0) + time.time() - active[1]
+            if previous_step is None:
+                del self._local.step
+            else:
+                self._local.step = previous_step
+            if in_main_thread:
+                self._main_step = previous_main_step
+
+    def record_statement(self, label, seconds, rows, n_statements=1):
+        with self._lock:
+            statement = self._statements.setdefault((self.current_step, label), _StatementMetrics())
+            statement.calls += n_statements
+            statement.rows += max(0, rows or 0)
+            statement.latency.observe(seconds)
+            self.statements_count += n_statements
+
+    def _gbif_metrics(self, endpoint):
+        # to be called with the lock
+        return self._gbif.setdefault((self.current_step, endpoint), _GbifMetrics())
+
+    def record_gbif_call(self, endpoint, seconds, n_bytes, error=False):
+        with self._lock:
+            gbif = self._gbif_metrics(endpoint)
+            gbif.calls += 1
+            gbif.bytes += n_bytes
+            if error:
+                gbif.errors += 1
+            gbif.latency.observe(seconds)
+
+    def record_gbif_retry(self, endpoint):
+        with self._lock:
+            self._gbif_metrics(endpoint).retries += 1
+
+    def record_gbif_cache(self, endpoint, hit):
+        with self._lock:
+            gbif = self._gbif_metrics(endpoint)
+            if hit:
+                gbif.cache_hits += 1
+            else:
+                gbif.cache_misses += 1
+
+    def summary(self):
+        """ All the metrics, as a JSON-serializable dict """
+        with self._lock:
+            return {
+                'steps': {step: {'seconds': round(seconds, 3)} for step, seconds in self.step_durations.items()},
+                'statements': [{'step': step,
+                                'statement': label,
+                                'calls': s.calls,
+                                'rows': s.rows,
+                                'seconds': s.latency.as_dict()}
+                               for (step, label), s in sorted(self._statements.items(),
+                                                              key=lambda item: -item[1].latency.sum)],
+                'gbif': [{'step': step,
+                          'endpoint': endpoint,
+                          'calls': g.calls,
+                          'errors': g.errors,
+                          'retries': g.retries,
+                          'bytes': g.bytes,
+                          'cacheHits': g.cache_hits,
+                          'cacheMisses': g.cache_misses,
+                          'seconds': g.latency.as_dict()}
+                         for (step, endpoint), g in sorted(self._gbif.items(), key=lambda item: -item[1].latency.sum)]
+            }
+
+    def prometheus_text(self, prefix='speciesbim'):
+        """ All the metrics, in the Prometheus text exposition format """
+        summary = self.summary()
+        lines = []
+
+        def add_metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            for suffix, labels, value in samples:
+                lines.append(f"{prefix}_{name}{suffix}{_prometheus_labels(labels)} {value}")
+
+        def histogram_samples(labels, histogram):
+            samples = [('_bucket', dict(labels, le=upper_bound), count)
+                       for upper_bound, count in histogram['buckets'].items()]
+            samples.append(('_sum', labels, histogram['sum']))
+            samples.append(('_count', labels, histogram['count']))
+            return samples
+
+        add_metric('step_duration_seconds', 'gauge', "Duration of the transform steps",
+                   [('', {'step': step}, s['seconds']) for step, s in summary['steps'].items()])
+
+        statements = summary['statements']
+        add_metric('sql_statements_total', 'counter', "Number of SQL statements, per step and statement template",
+                   [('', {'step': s['step'], 'statement': s['statement']}, s['calls']) for s in statements])
+        add_metric('sql_rows_total', 'counter', "Rows affected or returned by the SQL statements",
+                   [('', {'step': s['step'], 'statement': s['statement']}, s['rows']) for s in statements])
+        add_metric('sql_statement_duration_seconds', 'histogram', "Latency of the SQL statements",
+                   [sample for s in statements
+                    for sample in histogram_samples({'step': s['step'], 'statement': s['statement']}, s['seconds'])])
+
+        gbif = summary['gbif']
+        for name, key, help_text in [('gbif_requests_total', 'calls', "Number of requests sent to the GBIF API"),
+                                     ('gbif_errors_total', 'errors', "Failed requests to the GBIF API"),
+                                     ('gbif_retries_total', 'retries', "Retried requests to the GBIF API"),
+                                     ('gbif_response_bytes_total', 'bytes', "Size of the GBIF API responses"),
+                                     ('gbif_cache_hits_total', 'cacheHits', "GBIF responses found in the cache"),
+                                     ('gbif_cache_misses_total', 'cacheMisses', "GBIF responses not in the cache")]:
+            add_metric(name, 'counter', help_text,
+                       [('', {'step': g['step'], 'endpoint': g['endpoint']}, g[key]) for g in gbif])
+        add_metric('gbif_request_duration_seconds', 'histogram', "Latency of the GBIF API requests",
+                   [sample for g in gbif
+                    for sample in histogram_samples({'step': g['step'], 'endpoint': g['endpoint']}, g['seconds'])])
+
+        return "\n".join(lines) + "\n"
+
+
+def _prometheus_labels(labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _write_atomically(path, content):
+    # readers (e.g. node_exporter) never see a partially written file
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def write_json_summary(path):
+    _write_atomically(path, json.dumps(metrics.summary(), indent=2))
+
+
+def write_prometheus_textfile(path):
+    _write_atomically(path, metrics.prometheus_text())
+
+
+# The process-wide registry
+metrics = Metrics()
@@ -0,0 +1,275 @@
+# Streaming mode of the steps 4 (GBIF match), 5 (vernacular names) and 6 (exotic status) of transform_db.py
+#
+# Instead of waiting for the end of the previous step, the taxa inserted in taxonomy by gbif_match are sent (as soon as
+# their batch is committed) through bounded queues to:
+#   - a pool of vernacular names workers (each one with its own pooled database connection)
+#   - an exotic status marker, which first retrieves the GRIIS checklist (while the matching goes on) and then sets
+#     exotic_be for the new taxa: a taxon is exotic if it is in the checklist or if its parent or accepted taxon is
+#     exotic (parents and accepted taxa are always inserted, and so received, first, or were already in taxonomy)
+#
+# The network-bound stages overlap: the duration is close to the one of the slowest stage. The queues are bounded, so
+# gbif_match slows down if a stage can't keep pace. Enabled by [transform_db] pipeline = True in config.ini.
+#
+# With --keep-data or a resumed run, the taxa already in taxonomy don't go through the stages: the ones still without
+# vernacular names are processed after the match (only them), and the exotic status of the whole taxonomy is only
+# computed again if the checklist changed or if the status of some taxa couldn't be derived.
+import logging
+import queue
+import threading
+import time
+
+import gbif_match
+import vernacular_names
+import exotic_status
+
+from helpers import pooled_connection, execute_sql_from_jinja_string
+from metrics import metrics
+
+PIPELINE_DEFAULT_QUEUE_SIZE = 1000
+PIPELINE_DEFAULT_VERNACULAR_NAMES_WORKERS = 4
+
+# steps of transform_db.py to which the metrics of the stages are attributed (see metrics.py)
+VERNACULAR_NAMES_STEP = '5'
+EXOTIC_STATUS_STEP = '6'
+
+# Delay (in seconds) between two checks of the state of the other threads when a queue is full/empty
+QUEUE_POLL_SECONDS = 1
+
+_END = object()  # end of stream marker
+
+
+class _Stage(object):
+    """ Consumer threads reading a bounded queue. Exceptions raised by the threads are re-raised in the producer
+    thread by put() and close(). The metrics recorded by the threads are attributed to step. """
+
+    def __init__(self, name, step, n_workers, queue_size):
+        self.name = name
+        self.step = step
+        self.n_workers = n_workers
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._aborted = threading.Event()
+        self._errors = []
+        self._threads = []
+
+    def start(self):
+        for i in range(self.n_workers):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        try:
+            with metrics.step(self.step):
+                self.run()
+        except Exception as e:
+            logging.exception(f"{self.name} failed")
+            self._errors.append(e)
+            self._aborted.set()
+
+    def run(self):
+        """ Body of the worker threads: consume the items given by get() until it returns _END """
+        raise NotImplementedError
+
+    def _raise_if_failed(self):
+        if self._errors:
+            raise Exception(f"{self.name} failed: {self._errors[0]}") from self._errors[0]
+
+    def put(self, item):
+        # blocks while the queue is full (backpressure on the producer)
+        while True:
+            self._raise_if_failed()
+            try:
+                self._queue.put(item, timeout=QUEUE_POLL_SECONDS)
+                return
+            except queue.Full:
+                pass
+
+    def get(self):
+        # returns _END at the end of the stream or if the stage is aborted
+        while not self._aborted.is_set():
+            try:
+                return self._queue.get(timeout=QUEUE_POLL_SECONDS)
+            except queue.Empty:
+                pass
+        return _END
+
+    def close(self):
+        """ Wait for the processing of all the items already put """
+        for _ in self._threads:
+            self.put(_END)
+        for thread in self._threads:
+            thread.join()
+        self._raise_if_failed()
+
+    def abort(self):
+        """ Stop the threads without processing the remaining items (they finish their current item in background) """
+        self._aborted.set()
+
+
+class _VernacularNamesStage(_Stage):
+    """ Load the vernacular names of the taxa (see vernacular_names.py). Items: taxa (dicts with id and gbifId). """
+
+    def __init__(self, config_parser, filter_lang, n_workers, queue_size):
+        super().__init__("Vernacular names", VERNACULAR_NAMES_STEP, n_workers, queue_size)
+        self.insert_batch_size = config_parser.getint('vernacular_names', 'insert-batch-size',
+                                                      fallback=vernacular_names.DEFAULT_INSERT_BATCH_SIZE)
+        self.languages3, self.filter_lang_dict = vernacular_names._language_codes(filter_lang)
+        self.n_taxa = 0
+        self.n_vernacular_names = 0
+        self.n_without_source = 0
+        self.taxa_ids = set()  # ids of the processed taxa
+        self._lock = threading.Lock()  # counters, taxa_ids and vernacular name sources caches
+        self._ids_by_title = None
+        self._ids_by_key = None
+
+    def start(self):
+        with pooled_connection() as conn:
+            self._ids_by_title, self._ids_by_key = vernacular_names._load_vernacularnamesources(conn)
+        super().start()
+
+    def run(self):
+        with pooled_connection() as conn:
+            buffer = []
+            while True:
+                taxon = self.get()
+                if taxon is _END:
+                    break
+                names, n_without_source = vernacular_names._vernacular_names_of_taxon(
+                    conn, taxon, self.languages3, self.filter_lang_dict, self._ids_by_title, self._ids_by_key,
+                    lock=self._lock)
+                buffer += names
+                with self._lock:
+                    self.taxa_ids.add(taxon['id'])
+                    self.n_taxa += 1
+                    self.n_vernacular_names += len(names)
+                    self.n_without_source += n_without_source
+                if len(buffer) >= self.insert_batch_size:
+                    vernacular_names._insert_vernacular_names(conn, buffer)
+                    buffer = []
+            if not self._aborted.is_set():
+                vernacular_names._insert_vernacular_names(conn, buffer)
+
+
+class _ExoticStatusStage(_Stage):
+    """ Set exotic_be for the taxa (see exotic_status.py). Items: lists of taxa (dicts with id, gbifId, parentId and
+    acceptedId), parents and accepted taxa first. """
+
+    def __init__(self, config_parser, exotic_status_source, queue_size):
+        super().__init__("Exotic status", EXOTIC_STATUS_STEP, 1, queue_size)
+        self.config_parser = config_parser
+        self.exotic_status_source = exotic_status_source
+        self.alien_taxa = None
+        self.save_snapshot = None
+        self.n_taxa = 0
+        self.n_exotic_taxa = 0
+        self.n_unknown_lineages = 0  # taxa whose parent or accepted taxon has no exotic status yet
+        self._exotic_be_by_id = {}  # exotic status of the taxa received so far (and of their known parents)
+
+    def _load_exotic_be_of_dependencies(self, conn, taxa):
+        """ Parents and accepted taxa inserted before this run: their exotic_be is read from taxonomy (None if not
+        set yet) """
+        ids = {taxon[field] for taxon in taxa for field in ('parentId', 'acceptedId')} - {None}
+        ids -= {taxon['id'] for taxon in taxa}
+        ids -= self._exotic_be_by_id.keys()
+        if ids:
+            cur = execute_sql_from_jinja_string(conn, """SELECT "id", "exotic_be" FROM taxonomy
+                                                         WHERE "id" IN {{ ids | inclause }}""",
+                                                context={'ids': sorted(ids)})
+            for taxonomy_id, exotic_be in cur:
+                self._exotic_be_by_id[taxonomy_id] = exotic_be
+
+    def run(self):
+        # the checklist is downloaded while gbif_match goes on (new taxa wait in the queue)
+        alien_taxa, self.save_snapshot = exotic_status.get_alien_taxa(self.exotic_status_source, self.config_parser)
+        self.alien_taxa = set(alien_taxa)
+        with pooled_connection() as conn:
+            while True:
+                taxa = self.get()
+                if taxa is _END:
+                    break
+                self._load_exotic_be_of_dependencies(conn, taxa)
+                exotic_be_by_id = {}
+                for taxon in taxa:
+                    dependencies = [self._exotic_be_by_id.get(taxon[field])
+                                    for field in ('parentId', 'acceptedId') if taxon[field] is not None]
+                    exotic_be = taxon['gbifId'] in self.alien_taxa or True in dependencies
+                    if not exotic_be and None in dependencies:
+                        self.n_unknown_lineages += 1
+                    self._exotic_be_by_id[taxon['id']] = exotic_be
+                    exotic_be_by_id[taxon['id']] = exotic_be
+                exotic_status.set_exotic_be_of_taxa(conn, exotic_be_by_id)
+                self.n_taxa += len(exotic_be_by_id)
+                self.n_exotic_taxa += sum(exotic_be_by_id.values())
+
+
+def run_pipeline(conn, config_parser, keep_data, after_id, checkpoint, filter_lang, exotic_status_source):
+    """ Run the steps 4, 5 and 6 of transform_db.py concurrently (same parameters as the steps functions, plus the
+    filter_lang of populate_vernacular_names and the exotic_status_source of populate_is_exotic_be_field) """
+    queue_size = config_parser.getint('transform_db', 'pipeline-queue-size', fallback=PIPELINE_DEFAULT_QUEUE_SIZE)
+    n_workers = config_parser.getint('transform_db', 'pipeline-vernacular-names-workers',
+                                     fallback=PIPELINE_DEFAULT_VERNACULAR_NAMES_WORKERS)
+    msg = f"Pipeline mode: vernacular names ({n_workers} workers) and exotic status are processed as taxa are matched."
+    print(msg)
+    logging.info(msg)
+
+    start = time.time()
+    vernacular_names_stage = _VernacularNamesStage(config_parser, filter_lang, n_workers, queue_size)
+    exotic_status_stage = _ExoticStatusStage(config_parser, exotic_status_source, queue_size)
+    stages = [vernacular_names_stage, exotic_status_stage]
+
+    def _on_new_taxa(taxa):
+        for taxon in taxa:
+            vernacular_names_stage.put(taxon)
+        exotic_status_stage.put(taxa)
+
+    for stage in stages:
+        stage.start()
+    try:
+        gbif_match.gbif_match(conn, config_parser=config_parser, unmatched_only=keep_data, after_id=after_id,
+                              checkpoint=checkpoint, on_new_taxa=_on_new_taxa)
+        msg = f"GBIF match done in {round(time.time() - start)}s, waiting for the vernacular names and exotic status."
+        print(msg)
+        logging.info(msg)
+        for stage in stages:
+            stage.close()
+    except BaseException:
+        for stage in stages:
+            stage.abort()
+        raise
+
+    msg = f"Pipeline: {vernacular_names_stage.n_vernacular_names} vernacular names loaded for " \
+          f"{vernacular_names_stage.n_taxa} taxa, {exotic_status_stage.n_exotic_taxa} exotic taxa found among " \
+          f"{exotic_status_stage.n_taxa} new taxa in {round(time.time() - start)}s."
+    print(msg)
+    logging.info(msg)
+    if vernacular_names_stage.n_without_source > 0:
+        msg = f"Warning: {vernacular_names_stage.n_without_source} vernacular names without source. Contact GBIF: " \
+              f"https://github.com/gbif/gbif-api/issues/56"
+        print(msg)
+        logging.warning(msg)
+
+    # The taxa already in taxonomy before this run (kept data, or inserted before the interruption of a resumed run)
+    # didn't go through the pipeline
+    if keep_data or after_id is not None:
+        msg = "Pipeline: loading the vernacular names of the taxa inserted before this run."
+        print(msg)
+        logging.info(msg)
+        with metrics.step(VERNACULAR_NAMES_STEP):
+            vernacular_names.populate_vernacular_names(conn, config_parser=config_parser, empty_only=True,
+                                                       filter_lang=filter_lang,
+                                                       skip_ids=vernacular_names_stage.taxa_ids)
+    # their exotic status only has to be computed again if the checklist changed, or if some taxa (moved in the tree,
+    # or below a taxon without status) still have no exact one
+    checklist_changed = exotic_status_stage.save_snapshot is not None and (keep_data or after_id is not None)
+    cur = execute_sql_from_jinja_string(conn, """SELECT count(*) FROM taxonomy WHERE "exotic_be" IS NULL""")
+    if checklist_changed or exotic_status_stage.n_unknown_lineages > 0 or cur.fetchone()[0] > 0:
+        msg = "Pipeline: updating the exotic status of the taxa inserted before this run."
+        print(msg)
+        logging.info(msg)
+        with metrics.step(EXOTIC_STATUS_STEP):
+            exotic_status.populate_is_exotic_be_field(conn, config_parser=config_parser,
+                                                      exotic_status_source=exotic_status_source,
+                                                      alien_taxa=list(exotic_status_stage.alien_taxa))
+    # the exotic status of all the taxa now follows the current version of the checklist
+    if exotic_status_stage.save_snapshot is not None:
+        exotic_status_stage.save_snapshot()
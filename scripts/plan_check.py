@@ -0,0 +1,276 @@
+# Query plan check of the read queries of the new tables
+#
+# The queries of EXAMPLE_QUERIES.md, of speciesbim.py and the read queries of the transform_db steps are run with
+# EXPLAIN (ANALYZE, BUFFERS) on the synthetic dataset of benchmark.py (same database, created and transformed by all
+# the transform_db steps, including the creation of the indexes of create_indexes.sql). The check fails (exit code 1):
+#   - if a plan reads a table of more than min-table-rows rows with a sequential scan, unless the query needs the whole
+#     table (see PLAN_CHECK_QUERIES)
+#   - with --baseline: if a plan reads a table with a sequential scan that it didn't read that way in the baseline, or
+#     if it reads more than buffers-tolerance times more blocks (shared buffers hit + read) than in the baseline
+#
+#   python plan_check.py --taxa 20000 --save-baseline plan_baseline.json
+#   python plan_check.py --taxa 20000 --baseline plan_baseline.json
+#   python plan_check.py --reuse --baseline plan_baseline.json        # check the existing benchmark database again
+#
+# See the [plan_check] section of config.ini.
+import argparse
+import json
+import logging
+import os
+import sys
+
+import benchmark
+import helpers
+import speciesbim
+from helpers import execute_sql_from_jinja_string, get_database_connection, get_config, setup_log_file
+
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+LOG_FILE_PATH = "./logs/plan_check.log"
+
+PLAN_CHECK_DEFAULT_MIN_TABLE_ROWS = 1000
+PLAN_CHECK_DEFAULT_BUFFERS_TOLERANCE = 0.5
+# smaller differences of the number of blocks read are not considered as regressions
+PLAN_CHECK_MIN_BUFFERS_DIFFERENCE = 100
+
+EXAMPLE_1_ANCESTRY_SQL = """WITH RECURSIVE parents AS (
+                                SELECT id AS id, 0 AS number_of_ancestors, ARRAY [id] AS ancestry,
+                                       NULL :: INTEGER AS "parentId", id AS start_of_ancestry
+                                FROM taxonomy
+                                WHERE "parentId" IS NULL
+                                UNION
+                                SELECT child.id AS id, p.number_of_ancestors + 1 AS ancestry_size,
+                                       array_append(p.ancestry, child.id) AS ancestry, child."parentId" AS parentId,
+                                       coalesce(p.start_of_ancestry, child."parentId") AS start_of_ancestry
+                                FROM taxonomy child
+                                INNER JOIN parents p ON p.id = child."parentId"
+                            )
+                            SELECT p.id, p.number_of_ancestors, p.ancestry, p."parentId", p.start_of_ancestry,
+                                   t."scientificName", t."rankId", r.name AS "rank", kingdom."scientificName" AS kingdom
+                            FROM parents AS p, taxonomy AS t, rank AS r, taxonomy AS kingdom
+                            WHERE p.id = t.id AND t."rankId" = r.id AND kingdom.id = p.start_of_ancestry"""
+
+# (name, query, tables that the query may read with a sequential scan). The queries are rendered with the context
+# returned by _query_parameters
+PLAN_CHECK_QUERIES = [
+    # the recursive examples go through the whole tree
+    ('example 1: ancestry of all the taxa', EXAMPLE_1_ANCESTRY_SQL, ['taxonomy']),
+    ('example 2: taxon with its kingdom (recursive)', EXAMPLE_1_ANCESTRY_SQL + ' AND t.id = {{ taxon_id }}',
+     ['taxonomy']),
+    ('example 3: subtaxa (recursive)',
+     """WITH RECURSIVE subtaxa AS (
+            SELECT "id", "id" as "treeTop", "scientificName", "parentId" FROM taxonomy
+            UNION
+            SELECT t."id", s."treeTop", t."scientificName", t."parentId"
+            FROM taxonomy t
+            INNER JOIN subtaxa s ON s.id = t."parentId"
+        )
+        SELECT * FROM subtaxa WHERE "treeTop" = {{ parent_id }}""",
+     ['taxonomy']),
+    ('example 4: vernacular names, Belgian Species List first',
+     """WITH vernacularnames_sources_with_priority AS (
+            SELECT "id", "datasetKey", "datasetTitle",
+                   (CASE WHEN "datasetTitle" LIKE 'Belgian Species List' THEN TRUE ELSE FALSE END)
+                       "high_priority_source"
+            FROM vernacularnamesource
+        )
+        SELECT * FROM vernacularname
+        LEFT JOIN vernacularnames_sources_with_priority v on v.id = vernacularname.source
+        WHERE "taxonomyId" = {{ taxon_id }} AND language LIKE 'fr'
+        ORDER by high_priority_source DESC
+        LIMIT 2""",
+     []),
+    ('example 5: ancestors (taxonomy_closure)',
+     """SELECT t.*, r.name AS "rank", c.depth
+        FROM taxonomy_closure c
+        INNER JOIN taxonomy t ON t.id = c."ancestorId"
+        INNER JOIN rank r ON r.id = t."rankId"
+        WHERE c."descendantId" = {{ taxon_id }}
+        ORDER BY c.depth""",
+     []),
+    ('example 5: kingdom (taxonomy_closure)',
+     """SELECT t.*, r.name AS "rank", kingdom."scientificName" AS kingdom
+        FROM taxonomy t
+        INNER JOIN rank r ON r.id = t."rankId"
+        INNER JOIN taxonomy_closure c ON c."descendantId" = t.id
+        INNER JOIN taxonomy kingdom ON kingdom.id = c."ancestorId" AND kingdom."parentId" IS NULL
+        WHERE t.id = {{ taxon_id }}""",
+     []),
+    ('example 5: subtaxa (taxonomy_closure)',
+     """SELECT t.id, c."ancestorId" AS "treeTop", t."scientificName", t."parentId"
+        FROM taxonomy_closure c
+        INNER JOIN taxonomy t ON t.id = c."descendantId"
+        WHERE c."ancestorId" = {{ parent_id }}""",
+     []),
+    ('children of a taxon', """SELECT * FROM taxonomy WHERE "parentId" = {{ parent_id }}""", []),
+    ('synonyms of a taxon', """SELECT * FROM taxonomy WHERE "acceptedId" = {{ taxon_id }}""", []),
+    ('annexes of a taxon',
+     """SELECT a.* FROM annexscientificname a
+        INNER JOIN scientificname s ON s."id" = a."scientificNameId"
+        WHERE s."taxonomyId" = {{ taxon_id }}""",
+     []),
+    ('speciesbim: taxa', speciesbim.TAXA_SQL, []),
+    ('speciesbim: vernacular names', speciesbim.VERNACULAR_NAMES_SQL, []),
+    ('speciesbim: taxa by scientific name', speciesbim.IDS_BY_SCIENTIFIC_NAME_SQL, []),
+    # vernacular_names.py --keep-data, without taxa-limit: an anti-join of the whole tables
+    ('vernacular names: taxa without vernacular names',
+     """SELECT * FROM taxonomy
+        WHERE NOT EXISTS (SELECT vernacularname."taxonomyId" FROM vernacularname
+                          WHERE taxonomy.id = vernacularname."taxonomyId")
+        ORDER BY id""",
+     ['taxonomy', 'vernacularname']),
+    # the partial index taxonomy_exotic_be_null is only selective when most taxa have an exotic status (e.g. not after a
+    # run of step 4 alone)
+    ('exotic status: taxa to check', """SELECT count(*) FROM taxonomy WHERE "exotic_be" IS NULL""", ['taxonomy']),
+]
+
+
+def _query_parameters(conn):
+    """ Context of the queries: one of the deepest taxa with vernacular names (so that its parent has a small subtree),
+    its parent, its name... """
+    cur = execute_sql_from_jinja_string(conn, """SELECT t."id", t."parentId", t."scientificName" FROM taxonomy t
+                                                 WHERE t."parentId" IS NOT NULL
+                                                 AND EXISTS (SELECT 1 FROM vernacularname v
+                                                             WHERE v."taxonomyId" = t."id")
+                                                 ORDER BY (SELECT max(c."depth") FROM taxonomy_closure c
+                                                           WHERE c."descendantId" = t."id") DESC, t."id"
+                                                 LIMIT 1""")
+    row = cur.fetchone()
+    if row is None:
+        raise Exception("No taxon with vernacular names in the database: is it transformed?")
+    taxon_id, parent_id, scientific_name = row
+    name = ' '.join(scientific_name.split()[:2])
+    return {'taxon_id': taxon_id,
+            'parent_id': parent_id,
+            'ids': (taxon_id, parent_id),
+            'lang': 'fr',
+            'priority': speciesbim.HIGH_PRIORITY_VERNACULAR_NAMES_SOURCE,
+            'name': name,
+            'prefix': speciesbim.scientific_name_prefix(name)}
+
+
+def _table_rows(conn):
+    """ Returns a dict table name -> (estimated) number of rows, for the tables of the current schema """
+    cur = execute_sql_from_jinja_string(conn, """SELECT c.relname, c.reltuples FROM pg_class c
+                                                 INNER JOIN pg_namespace n ON n.oid = c.relnamespace
+                                                 WHERE n.nspname = current_schema() AND c.relkind = 'r'""")
+    return {row[0]: row[1] for row in cur}
+
+
+def _plan_nodes(plan):
+    yield plan
+    for subplan in plan.get('Plans', []):
+        yield from _plan_nodes(subplan)
+
+
+def explain(conn, sql, context):
+    """ Returns the summary (dict) of the plan of the query: nodes, sequentially scanned tables, blocks read and times
+    """
+    cur = execute_sql_from_jinja_string(conn, """EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) """ + sql, context=context)
+    result = cur.fetchone()[0]
+    if isinstance(result, str):
+        result = json.loads(result)
+    plan = result[0]['Plan']
+    nodes = list(_plan_nodes(plan))
+    return {'nodes': sorted({' '.join(filter(None, [node['Node Type'], node.get('Relation Name'),
+                                                   node.get('Index Name')])) for node in nodes}),
+            'seqScans': sorted({node['Relation Name'] for node in nodes if node['Node Type'] == 'Seq Scan'}),
+            'sharedBlocks': plan.get('Shared Hit Blocks', 0) + plan.get('Shared Read Blocks', 0),
+            'totalCost': plan['Total Cost'],
+            'executionMs': result[0].get('Execution Time')}
+
+
+def check_plans(conn, min_table_rows, buffers_tolerance, baseline=None):
+    """ Explain all the PLAN_CHECK_QUERIES. Returns (summaries: dict query name -> plan summary, failures: list of
+    messages) """
+    context = _query_parameters(conn)
+    table_rows = _table_rows(conn)
+    baseline_queries = baseline['queries'] if baseline is not None else {}
+    summaries = {}
+    failures = []
+    for name, sql, allowed_seq_scans in PLAN_CHECK_QUERIES:
+        summary = explain(conn, sql, context)
+        summaries[name] = summary
+        msg = f"{name}: {summary['sharedBlocks']} blocks, {summary['executionMs']}ms - {', '.join(summary['nodes'])}"
+        print(msg)
+        logging.info(msg)
+
+        for table in summary['seqScans']:
+            if table not in allowed_seq_scans and table_rows.get(table, 0) >= min_table_rows:
+                failures.append(f"{name}: sequential scan on {table} ({int(table_rows[table])} rows)")
+
+        previous = baseline_queries.get(name)
+        if previous is None:
+            continue
+        for table in set(summary['seqScans']) - set(previous['seqScans']):
+            if table_rows.get(table, 0) >= min_table_rows:
+                failures.append(f"{name}: new sequential scan on {table} (baseline: {', '.join(previous['nodes'])})")
+        if summary['sharedBlocks'] > previous['sharedBlocks'] * (1 + buffers_tolerance) \
+                and summary['sharedBlocks'] - previous['sharedBlocks'] >= PLAN_CHECK_MIN_BUFFERS_DIFFERENCE:
+            failures.append(f"{name}: {summary['sharedBlocks']} blocks read instead of {previous['sharedBlocks']}")
+    return summaries, failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the plans of the read queries on the benchmark dataset")
+    parser.add_argument('--taxa', type=int, default=10000, help="number of taxa in the legacy taxon table")
+    parser.add_argument('--reuse', action='store_true',
+                        help="check the existing benchmark database (already transformed) instead of recreating it")
+    parser.add_argument('--baseline', help="plan summaries of a previous run (see --save-baseline), to compare with")
+    parser.add_argument('--save-baseline', help="file where the plan summaries of this run are saved")
+    arguments = parser.parse_args()
+
+    setup_log_file(LOG_FILE_PATH)
+    config = get_config()
+    benchmark_database = config.get('benchmark', 'database', fallback=benchmark.BENCHMARK_DEFAULT_DATABASE)
+    min_rows = config.getint('plan_check', 'min-table-rows', fallback=PLAN_CHECK_DEFAULT_MIN_TABLE_ROWS)
+    tolerance = config.getfloat('plan_check', 'buffers-tolerance', fallback=PLAN_CHECK_DEFAULT_BUFFERS_TOLERANCE)
+
+    if not arguments.reuse:
+        msg = f"Creating and transforming the benchmark database {benchmark_database} ({arguments.taxa} taxa)..."
+        print(msg)
+        logging.info(msg)
+        benchmark.create_benchmark_database(config, benchmark_database)
+    previous_config_file_path = helpers.CONFIG_FILE_PATH
+    plan_check_config_path = benchmark.write_benchmark_config(config, benchmark_database)
+    gbif_server = None
+    try:
+        plan_check_config = get_config()
+        connection = get_database_connection()
+        if not arguments.reuse:
+            benchmark.populate_benchmark_database(connection, arguments.taxa, n_duplicates=100,
+                                                  occurrences_per_species=1)
+            gbif_server = benchmark.start_gbif_stand_in(benchmark.SyntheticBackbone(n_species=arguments.taxa),
+                                                        latency=0)
+            benchmark.run_steps(connection, plan_check_config, gbif_server)
+    finally:
+        # also when a step fails: no benchmark_*.ini left behind
+        if gbif_server is not None:
+            gbif_server.shutdown()
+        os.remove(plan_check_config_path)
+        helpers.CONFIG_FILE_PATH = previous_config_file_path
+
+    baseline_plans = None
+    if arguments.baseline:
+        with open(arguments.baseline) as f:
+            baseline_plans = json.load(f)
+        if not arguments.reuse and baseline_plans.get('taxa') != arguments.taxa:
+            print(f"Warning: the baseline was made with {baseline_plans.get('taxa')} taxa (blocks not comparable)")
+    plans, plan_failures = check_plans(connection, min_rows, tolerance, baseline_plans)
+
+    if arguments.save_baseline:
+        with open(arguments.save_baseline, 'w') as f:
+            json.dump({'commit': benchmark.current_commit(),
+                       'taxa': None if arguments.reuse else arguments.taxa,
+                       'queries': plans}, f, indent=2)
+        msg = f"Plan summaries saved in {arguments.save_baseline}"
+        print(msg)
+        logging.info(msg)
+
+    for failure in plan_failures:
+        print(f"FAILED: {failure}")
+        logging.error(failure)
+    msg = f"Plan check: {len(plans)} queries, {len(plan_failures)} failures."
+    print(msg)
+    logging.info(msg)
+    sys.exit(1 if plan_failures else 0)
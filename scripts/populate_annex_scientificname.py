@@ -1,5 +1,5 @@
 from helpers import get_database_connection, get_config, setup_log_file, execute_sql_from_jinja_string, \
-    insert_or_get_scientificnameid
+    insert_or_get_scientificnameid, batch_transaction, execute_copy_from_file, ProgressReporter
 from csv import reader
 import time
 import logging
@@ -30,6 +30,59 @@ def _load_annex_data_from_file(path):
     return annex_scientificnames
 
 
+def _populate_annex_scientificname_bulk(conn, config_parser, annex_file, n_taxa_max):
+    """ Set-based version of populate_annex_scientificname
+
+    The annex file is loaded with COPY in a staging table, then all (scientificName, authorship) pairs are added to
+    scientificname and all rows to annexscientificname with one statement each. Everything happens in a single
+    transaction.
+
+    Returns the number of rows inserted in annexscientificname """
+    with batch_transaction(conn, config_parser, 'annex_scientificname'):
+        # columns of the annex file, in the same order. "lineNumber" keeps the order of the file (for taxa-limit)
+        execute_sql_from_jinja_string(conn, """CREATE TEMPORARY TABLE annex_staging (
+                                                   "lineNumber" serial,
+                                                   "annexCode" character varying(255),
+                                                   "scientificNameInAnnex" character varying(1023),
+                                                   "scientificName" character varying(255),
+                                                   "authorship" character varying(255),
+                                                   "pageNumber" character varying(255),
+                                                   "remarks" character varying(1023)
+                                               ) ON COMMIT DROP""")
+        with open(annex_file) as csvfile:
+            # FORCE_NOT_NULL: empty fields are loaded as '' (as the row by row version does), not as NULL
+            execute_copy_from_file(conn,
+                                   """COPY annex_staging ("annexCode", "scientificNameInAnnex", "scientificName",
+                                                          "authorship", "pageNumber", "remarks")
+                                      FROM STDIN WITH (FORMAT csv, HEADER true,
+                                                       FORCE_NOT_NULL ("scientificName", "authorship", "remarks"))""",
+                                   csvfile)
+
+        execute_sql_from_jinja_string(conn, """DELETE FROM annex_staging WHERE "lineNumber" > {{ n_taxa_max }}""",
+                                      context={'n_taxa_max': n_taxa_max})
+
+        execute_sql_from_jinja_string(conn, """INSERT INTO scientificname ("scientificName", "authorship")
+                                               SELECT DISTINCT "scientificName", NULLIF("authorship", '')
+                                               FROM annex_staging
+                                               WHERE "scientificName" != ''
+                                               ON CONFLICT DO NOTHING""")
+
+        cur = execute_sql_from_jinja_string(conn, """INSERT INTO annexscientificname ("scientificNameId",
+                                                         "scientificNameInAnnex", "isScientificName", "annexCode",
+                                                         "remarks")
+                                                     SELECT sn."id", s."scientificNameInAnnex",
+                                                            s."scientificName" != '', s."annexCode", s."remarks"
+                                                     FROM annex_staging s
+                                                     LEFT JOIN scientificname sn
+                                                     ON s."scientificName" != ''
+                                                     AND sn."scientificName" = s."scientificName"
+                                                     -- same authorship as the one inserted above: a legacy
+                                                     -- ('X', '') name isn't matched besides ('X', NULL)
+                                                     AND sn."authorship" IS NOT DISTINCT FROM NULLIF(s."authorship", '')
+                                                     ORDER BY s."lineNumber" """)
+        return cur.rowcount
+
+
 def populate_annex_scientificname(conn, config_parser, annex_file):
     """ Populate the table annexscientificname
 
@@ -49,41 +102,42 @@ def populate_annex_scientificname(conn, config_parser, annex_file):
         n_taxa_max = len(annex_names)
     start = time.time()
     counter_insertions = 0
-    for annex_entry in annex_names:
-        if counter_insertions < n_taxa_max:
-            dict_for_annexscientificname = {k: annex_entry[k] for k in FIELDS_ANNEXSCIENTIFICNAME}
-            if (dict_for_annexscientificname['isScientificName'] is True):
-                dict_for_scientificname = { k: annex_entry[k] for k in annex_entry.keys() - FIELDS_ANNEXSCIENTIFICNAME }
-                if dict_for_scientificname['authorship'] == '':
-                    dict_for_scientificname['authorship'] = None
-                id_scn = insert_or_get_scientificnameid(conn,
-                                                        scientific_name=dict_for_scientificname['scientificName'],
-                                                        authorship=dict_for_scientificname['scientificName'])
-                dict_for_annexscientificname['scientificNameId'] = id_scn
-            # insert in annexscientificname
-            template = """INSERT INTO annexscientificname ({{ col_names | surround_by_quote | join(', ') | sqlsafe 
-            }}) VALUES {{ values | inclause }} """
-            execute_sql_from_jinja_string(
-                conn,
-                template,
-                context={'col_names': tuple(dict_for_annexscientificname.keys()),
-                         'values': tuple(dict_for_annexscientificname.values())}
-            )
-            counter_insertions += 1
-            # running infos on screen (no logging)
-            if counter_insertions % 20 == 0:
-                elapsed_time = time.time() - start
-                expected_time = elapsed_time / counter_insertions * (n_taxa_max - counter_insertions)
-                info_message = "\r" + \
-                               f"{counter_insertions}/{n_taxa_max} taxa inserted in annexscientificname in" + \
-                               f" {round(elapsed_time, 2)}s." + \
-                               f" Expected time to go: {round(expected_time, 2)}s."
-                print(info_message, end="", flush=True)
-        else:
-            break
+
+    if config_parser.getboolean('annex_scientificname', 'bulk', fallback=False):
+        counter_insertions = _populate_annex_scientificname_bulk(conn, config_parser, annex_file, n_taxa_max)
+    else:
+        # writes are committed by batches (see commit-every-rows and commit-every-seconds)
+        progress = ProgressReporter("Insert taxa in annexscientificname", total=n_taxa_max)
+        with batch_transaction(conn, config_parser, 'annex_scientificname') as transaction:
+            for annex_entry in annex_names:
+                if counter_insertions < n_taxa_max:
+                    dict_for_annexscientificname = {k: annex_entry[k] for k in FIELDS_ANNEXSCIENTIFICNAME}
+                    if (dict_for_annexscientificname['isScientificName'] is True):
+                        dict_for_scientificname = { k: annex_entry[k] for k in annex_entry.keys() - FIELDS_ANNEXSCIENTIFICNAME }
+                        if dict_for_scientificname['authorship'] == '':
+                            dict_for_scientificname['authorship'] = None
+                        id_scn = insert_or_get_scientificnameid(conn,
+                                                                scientific_name=dict_for_scientificname['scientificName'],
+                                                                authorship=dict_for_scientificname['authorship'])
+                        dict_for_annexscientificname['scientificNameId'] = id_scn
+                    # insert in annexscientificname
+                    template = """INSERT INTO annexscientificname ({{ col_names | surround_by_quote | join(', ') | sqlsafe 
+                    }}) VALUES {{ values | inclause }} """
+                    execute_sql_from_jinja_string(
+                        conn,
+                        template,
+                        context={'col_names': tuple(dict_for_annexscientificname.keys()),
+                                 'values': tuple(dict_for_annexscientificname.values())}
+                    )
+                    counter_insertions += 1
+                    transaction.row_done()
+                    progress.update()
+                else:
+                    break
+        progress.close()
     # Logging and statistics
     end = time.time()
-    n_taxa_inserted = f"\nTotal number of taxa inserted in annexscientificname: {counter_insertions}"
+    n_taxa_inserted = f"Total number of taxa inserted in annexscientificname: {counter_insertions}"
     print(n_taxa_inserted)
     logging.info(n_taxa_inserted)
     elapsed_time = f"Table annexscientificname populated in {round(end - start)}s."
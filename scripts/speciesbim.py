@@ -0,0 +1,295 @@
+# Read API of the species database, for the applications using it (instead of copying the queries of
+# EXAMPLE_QUERIES.md)
+#
+#   import speciesbim
+#
+#   with pooled_connection() as conn:
+#       speciesbim.get_taxon(conn, 32)                  # taxonomy fields + rank and kingdom names (example 2)
+#       speciesbim.ancestors(conn, 32)                  # the taxon and its ancestors, up to the kingdom (example 1)
+#       speciesbim.subtaxa(conn, 5)                     # the taxon and all its descendants (example 3)
+#       speciesbim.vernacular_names(conn, 8, 'fr')      # Belgian Species List names first (example 4)
+#       speciesbim.find_by_scientific_name(conn, "Pelophylax ridibundus")
+#
+# No recursive query is run: the hierarchy comes from a TaxonomyTree (see taxonomy_tree.py) loaded at the first
+# ancestors/subtaxa call, the kingdom from taxonomy_closure. The functions taking many ids (get_taxa,
+# vernacular_names_of_taxa) query the missing ones by batches, and all the results are kept in a bounded LRU cache.
+#
+# The cache and the tree are dropped when a transform_db.py run completes: the completion time of the last step (see
+# transform_db_run_state) is checked at most every check-every-seconds. See the [speciesbim] section of config.ini.
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from helpers import execute_sql_from_jinja_string, get_config
+from taxonomy_tree import TaxonomyTree
+
+SPECIESBIM_DEFAULT_CACHE_SIZE = 100000
+SPECIESBIM_DEFAULT_CHECK_EVERY_SECONDS = 5
+SPECIESBIM_DEFAULT_BATCH_SIZE = 1000
+
+# vernacular names from that source come first
+HIGH_PRIORITY_VERNACULAR_NAMES_SOURCE = 'Belgian Species List'
+
+
+class LruCache(object):
+    """ Thread-safe dict-like cache keeping the max_entries most recently used entries """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        """ Returns a dict key -> value of the keys found in the cache """
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    found[key] = self._entries[key]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, values):
+        with self._lock:
+            for key, value in values.items():
+                self._entries[key] = value
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# The queries are also checked by plan_check.py (their plans must use the indexes of create_indexes.sql)
+TAXA_SQL = """SELECT t.*, r."name" AS "rank",
+                     (SELECT k."scientificName" FROM taxonomy_closure c
+                      INNER JOIN taxonomy k ON k."id" = c."ancestorId"
+                      WHERE c."descendantId" = t."id" AND k."parentId" IS NULL) AS "kingdom"
+              FROM taxonomy t
+              LEFT JOIN rank r ON r."id" = t."rankId"
+              WHERE t."id" IN {{ ids | inclause }}"""
+
+VERNACULAR_NAMES_SQL = """SELECT v."taxonomyId", v."name", v."language", s."datasetKey", s."datasetTitle"
+                          FROM vernacularname v
+                          LEFT JOIN vernacularnamesource s ON s."id" = v."source"
+                          WHERE v."taxonomyId" IN {{ ids | inclause }}
+                          {% if lang %} AND v."language" = {{ lang }} {% endif %}
+                          ORDER BY v."taxonomyId", s."datasetTitle" IS NOT DISTINCT FROM {{ priority }} DESC, v."id" """
+
+# taxa whose name is the given one (with or without authorship), or matched to it in scientificname
+IDS_BY_SCIENTIFIC_NAME_SQL = """SELECT "id" FROM taxonomy
+                                WHERE "scientificName" = {{ name }} OR "scientificName" LIKE {{ prefix }}
+                                UNION
+                                SELECT "taxonomyId" FROM scientificname
+                                WHERE "scientificName" = {{ name }} AND "taxonomyId" IS NOT NULL
+                                ORDER BY 1"""
+
+
+def scientific_name_prefix(name):
+    """ LIKE pattern of the names starting with name followed by an authorship """
+    return name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + ' %'
+
+
+class SpeciesBim(object):
+    """ Cached queries on the species database (see the module documentation). The connections are given by the
+    caller at each call, so an instance can be shared by threads using their own connections. """
+
+    def __init__(self, cache_size=SPECIESBIM_DEFAULT_CACHE_SIZE,
+                 check_every_seconds=SPECIESBIM_DEFAULT_CHECK_EVERY_SECONDS, batch_size=SPECIESBIM_DEFAULT_BATCH_SIZE):
+        self.check_every_seconds = check_every_seconds
+        self.batch_size = batch_size
+        self.cache = LruCache(cache_size)
+        self._lock = threading.Lock()  # data version and tree
+        self._data_version = None
+        self._last_check = None
+        self._tree = None
+
+    @classmethod
+    def from_config(cls, config_parser):
+        return cls(cache_size=config_parser.getint('speciesbim', 'cache-size',
+                                                   fallback=SPECIESBIM_DEFAULT_CACHE_SIZE),
+                   check_every_seconds=config_parser.getfloat('speciesbim', 'check-every-seconds',
+                                                              fallback=SPECIESBIM_DEFAULT_CHECK_EVERY_SECONDS),
+                   batch_size=config_parser.getint('speciesbim', 'batch-size', fallback=SPECIESBIM_DEFAULT_BATCH_SIZE))
+
+    def invalidate(self):
+        """ Drop the cached results and the taxonomy tree """
+        with self._lock:
+            self._tree = None
+            self.cache.clear()
+
+    def _check_data_version(self, conn):
+        # drop the cache if a transform_db.py run has completed since the previous check
+        now = time.monotonic()
+        if self._last_check is not None and now - self._last_check < self.check_every_seconds:
+            return
+        self._last_check = now
+        cur = execute_sql_from_jinja_string(conn, """SELECT to_regclass('transform_db_run_state') IS NOT NULL""")
+        version = None
+        if cur.fetchone()[0]:
+            cur = execute_sql_from_jinja_string(conn, """SELECT max("completed") FROM transform_db_run_state""")
+            version = cur.fetchone()[0]
+        if version != self._data_version:
+            if self._data_version is not None:
+                logging.info(f"speciesbim: the database has been updated ({version}), cache invalidated.")
+            self.invalidate()
+            self._data_version = version
+
+    def _get_tree(self, conn):
+        with self._lock:
+            if self._tree is None:
+                self._tree = TaxonomyTree.load(conn)
+            return self._tree
+
+    def _cached_batches(self, conn, kind, ids, load_batch):
+        # values of the cache keys (kind, id) for all the ids: the missing ones are loaded batch_size ids at a time by
+        # load_batch(conn, ids) (returning a dict id -> value, without the ids that don't exist)
+        self._check_data_version(conn)
+        found = {key[1]: value for key, value in self.cache.get_many([(kind, i) for i in ids]).items()}
+        missing = [i for i in dict.fromkeys(ids) if i not in found]
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            loaded = load_batch(conn, batch)
+            self.cache.set_many({(kind, i): loaded.get(i) for i in batch})
+            found.update({i: loaded.get(i) for i in batch})
+        return found
+
+    @staticmethod
+    def _load_taxa(conn, ids):
+        cur = execute_sql_from_jinja_string(conn, TAXA_SQL, context={'ids': tuple(ids)}, dict_cursor=True)
+        return {row['id']: dict(row) for row in cur}
+
+    def get_taxa(self, conn, taxonomy_ids):
+        """ Returns a dict taxonomy id -> taxon (dict: taxonomy fields, rank and kingdom), without the unknown ids """
+        taxa = self._cached_batches(conn, 'taxon', list(taxonomy_ids), self._load_taxa)
+        return {i: dict(taxon) for i, taxon in taxa.items() if taxon is not None}
+
+    def get_taxon(self, conn, taxonomy_id):
+        """ Returns the taxon (see get_taxa), or None if there is no taxon with that id """
+        return self.get_taxa(conn, [taxonomy_id]).get(taxonomy_id)
+
+    def _taxa_in_order(self, conn, ids):
+        taxa = self.get_taxa(conn, ids)
+        return [taxa[i] for i in ids if i in taxa]
+
+    def ancestors(self, conn, taxonomy_id):
+        """ Returns the taxon and its parent, grand-parent... up to the kingdom (list of taxa, see get_taxa) """
+        self._check_data_version(conn)
+        tree = self._get_tree(conn)
+        if taxonomy_id not in tree:
+            return self._taxa_in_order(conn, [taxonomy_id])
+        return self._taxa_in_order(conn, [taxonomy_id] + tree.ancestors(taxonomy_id))
+
+    def subtaxa(self, conn, taxonomy_id):
+        """ Returns the taxon and all its descendants, in depth-first order (list of taxa, see get_taxa) """
+        self._check_data_version(conn)
+        tree = self._get_tree(conn)
+        if taxonomy_id not in tree:
+            return self._taxa_in_order(conn, [taxonomy_id])
+        return self._taxa_in_order(conn, [taxonomy_id] + tree.descendants(taxonomy_id))
+
+    @staticmethod
+    def _load_vernacular_names(conn, ids, lang):
+        cur = execute_sql_from_jinja_string(conn, VERNACULAR_NAMES_SQL,
+                                            context={'ids': tuple(ids), 'lang': lang,
+                                                     'priority': HIGH_PRIORITY_VERNACULAR_NAMES_SOURCE},
+                                            dict_cursor=True)
+        names = {i: [] for i in ids}
+        for row in cur:
+            names[row['taxonomyId']].append({'name': row['name'],
+                                             'language': row['language'],
+                                             'datasetKey': row['datasetKey'],
+                                             'datasetTitle': row['datasetTitle']})
+        return names
+
+    def vernacular_names_of_taxa(self, conn, taxonomy_ids, lang=None):
+        """ Returns a dict taxonomy id -> list of vernacular names (dicts: name, language, datasetKey and datasetTitle
+        of the source) in the language lang (2-letters code, None for all), Belgian Species List names first """
+        names = self._cached_batches(conn, f'vernacular_names_{lang}', list(taxonomy_ids),
+                                     lambda c, ids: self._load_vernacular_names(c, ids, lang))
+        return {i: copy.deepcopy(n) for i, n in names.items()}
+
+    def vernacular_names(self, conn, taxonomy_id, lang=None):
+        """ Returns the vernacular names of a taxon (see vernacular_names_of_taxa) """
+        return self.vernacular_names_of_taxa(conn, [taxonomy_id], lang)[taxonomy_id]
+
+    @staticmethod
+    def _load_ids_by_scientific_name(conn, names):
+        ids_by_name = {}
+        for name in names:
+            cur = execute_sql_from_jinja_string(conn, IDS_BY_SCIENTIFIC_NAME_SQL,
+                                                context={'name': name, 'prefix': scientific_name_prefix(name)})
+            ids_by_name[name] = [row[0] for row in cur]
+        return ids_by_name
+
+    def find_by_scientific_name(self, conn, scientific_name):
+        """ Returns the taxa (see get_taxa) named scientific_name, with any authorship (e.g. "Pelophylax ridibundus"
+        finds "Pelophylax ridibundus (Pallas, 1771)"), or matched to that name in scientificname """
+        scientific_name = ' '.join(scientific_name.split())
+        ids = self._cached_batches(conn, 'scientific_name', [scientific_name],
+                                   self._load_ids_by_scientific_name)[scientific_name]
+        return self._taxa_in_order(conn, ids)
+
+    def stats_message(self):
+        total = self.cache.hits + self.cache.misses
+        hit_ratio = self.cache.hits / total * 100 if total > 0 else 0
+        return f"speciesbim cache: {self.cache.hits} hits, {self.cache.misses} misses ({hit_ratio:.2f}% hit ratio), " \
+               f"{len(self.cache)} entries."
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_default():
+    """ Returns the (process-wide) SpeciesBim instance used by the module functions, configured by the [speciesbim]
+    section of config.ini """
+    global _default
+
+    with _default_lock:
+        if _default is None:
+            _default = SpeciesBim.from_config(get_config())
+    return _default
+
+
+def get_taxon(conn, taxonomy_id):
+    return get_default().get_taxon(conn, taxonomy_id)
+
+
+def get_taxa(conn, taxonomy_ids):
+    return get_default().get_taxa(conn, taxonomy_ids)
+
+
+def ancestors(conn, taxonomy_id):
+    return get_default().ancestors(conn, taxonomy_id)
+
+
+def subtaxa(conn, taxonomy_id):
+    return get_default().subtaxa(conn, taxonomy_id)
+
+
+def vernacular_names(conn, taxonomy_id, lang=None):
+    return get_default().vernacular_names(conn, taxonomy_id, lang)
+
+
+def vernacular_names_of_taxa(conn, taxonomy_ids, lang=None):
+    return get_default().vernacular_names_of_taxa(conn, taxonomy_ids, lang)
+
+
+def find_by_scientific_name(conn, scientific_name):
+    return get_default().find_by_scientific_name(conn, scientific_name)
+
+
+def invalidate_cache():
+    get_default().invalidate()
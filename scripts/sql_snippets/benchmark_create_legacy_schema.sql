@@ -0,0 +1,40 @@
+-- Minimal version of the legacy (BIM) schema, with the tables and columns used by the transform_db steps
+-- (used by benchmark.py, in a dedicated database)
+DROP SCHEMA IF EXISTS biodiv CASCADE;
+CREATE SCHEMA biodiv;
+
+CREATE TABLE biodiv.taxon (
+    "id" integer PRIMARY KEY,
+    "acceptedname" character varying(255),
+    "scientificnameauthorship" character varying(255),
+    "parentid" integer
+);
+
+CREATE TABLE biodiv.commontaxa (
+    "id" serial PRIMARY KEY,
+    "nptaxonid" integer
+);
+
+CREATE TABLE biodiv.media (
+    "id" serial PRIMARY KEY,
+    "taxonid" integer
+);
+
+CREATE TABLE biodiv.identifiablespecies (
+    "id" integer PRIMARY KEY,
+    "taxonid" integer
+);
+
+CREATE TABLE biodiv.occurence (
+    "id" serial PRIMARY KEY,
+    "identifiablespeciesid" integer
+);
+
+CREATE TABLE biodiv.speciesannex (
+    "id" serial PRIMARY KEY,
+    "taxonid" integer
+);
+
+CREATE TABLE biodiv.annex (
+    "annexcode" character varying(255) PRIMARY KEY
+);
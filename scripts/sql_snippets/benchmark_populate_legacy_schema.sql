@@ -0,0 +1,36 @@
+-- Synthetic content for the legacy schema (see benchmark_create_legacy_schema.sql)
+--
+-- Taxon i is named "Genus<i / genus_size> species<i>" (as the synthetic GBIF Backbone served by benchmark.py), except
+-- one in unmatched_every that has a name unknown to the backbone. Ids above n_taxa are duplicates (same name and
+-- authorship) of the first taxa.
+INSERT INTO biodiv.taxon ("id", "acceptedname", "scientificnameauthorship")
+SELECT i,
+       CASE WHEN mod(i, {{ unmatched_every }}) = 0 THEN 'Unknownus name' || i
+            ELSE 'Genus' || (i / {{ genus_size }}) || ' species' || i END,
+       CASE WHEN mod(i, 10) = 0 THEN NULL ELSE 'Author' || (mod(i, 50)) || ', 1900' END
+FROM generate_series(1, {{ n_taxa }}) AS i;
+
+INSERT INTO biodiv.taxon ("id", "acceptedname", "scientificnameauthorship")
+SELECT {{ n_taxa }} + i, "acceptedname", "scientificnameauthorship"
+FROM biodiv.taxon JOIN generate_series(1, {{ n_duplicates }}) AS i ON biodiv.taxon."id" = i;
+
+-- references to the taxa: populate_scientificname only keeps the taxa used by commontaxa, media or occurence
+INSERT INTO biodiv.commontaxa ("nptaxonid")
+SELECT "id" FROM biodiv.taxon WHERE mod("id", 3) = 0;
+
+INSERT INTO biodiv.media ("taxonid")
+SELECT "id" FROM biodiv.taxon WHERE mod("id", 5) = 0 OR "id" > {{ n_taxa }};
+
+INSERT INTO biodiv.identifiablespecies ("id", "taxonid")
+SELECT "id", "id" FROM biodiv.taxon WHERE mod("id", 2) = 0;
+
+INSERT INTO biodiv.occurence ("identifiablespeciesid")
+SELECT s."id" FROM biodiv.identifiablespecies s, generate_series(1, {{ occurrences_per_species }});
+
+INSERT INTO biodiv.speciesannex ("taxonid")
+SELECT "id" FROM biodiv.taxon WHERE mod("id", 100) = 0;
+
+INSERT INTO biodiv.annex ("annexcode")
+VALUES {% for annex_code in annex_codes %}({{ annex_code }}){% if not loop.last %}, {% endif %}{% endfor %};
+
+ANALYZE;
@@ -0,0 +1,13 @@
+-- Trigram indexes used by fuzzy_match.py (requires the pg_trgm extension)
+-- GiST (not GIN) indexes: they support the ordering by distance (<<->), so the best candidates are found without
+-- computing the similarity with every name
+-- ! fuzzymatchbackbonename is not dropped by drop_new_tables_if_exists.sql: it only depends on the local backbone
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS taxonomy_scientificname_trgm ON taxonomy USING gist ("scientificName" gist_trgm_ops);
+
+CREATE TABLE IF NOT EXISTS fuzzymatchbackbonename (
+    "gbifId" integer NOT NULL, -- key in the GBIF Backbone
+    "canonicalName" character varying(255) NOT NULL,
+    "backboneVersion" character varying(50) NOT NULL -- version of the local backbone the names come from
+);
@@ -0,0 +1,23 @@
+-- Secondary indexes of the new tables (see create_new_tables.sql, which only has the primary keys and the unique
+-- constraints), for the lookups of EXAMPLE_QUERIES.md, speciesbim.py and the steps of transform_db.py
+-- Created by the last step of transform_db.py, after the bulk load (the inserts don't have to maintain them), and kept
+-- by the --keep-data runs. Checked by plan_check.py
+CREATE INDEX IF NOT EXISTS taxonomy_parent_id ON taxonomy("parentId");
+CREATE INDEX IF NOT EXISTS taxonomy_accepted_id ON taxonomy("acceptedId");
+-- exact and prefix (LIKE) lookups, whatever the collation of the database
+CREATE INDEX IF NOT EXISTS taxonomy_scientific_name ON taxonomy("scientificName" varchar_pattern_ops);
+-- taxa whose exotic status is still unknown (see exotic_status.py)
+CREATE INDEX IF NOT EXISTS taxonomy_exotic_be_null ON taxonomy("id") WHERE "exotic_be" IS NULL;
+
+CREATE INDEX IF NOT EXISTS scientificname_taxonomy_id ON scientificname("taxonomyId");
+
+CREATE INDEX IF NOT EXISTS vernacularname_taxonomy_id_language ON vernacularname("taxonomyId", "language");
+
+CREATE INDEX IF NOT EXISTS annexscientificname_scientific_name_id ON annexscientificname("scientificNameId");
+
+ANALYZE taxonomy;
+ANALYZE taxonomy_closure;
+ANALYZE scientificname;
+ANALYZE vernacularname;
+ANALYZE vernacularnamesource;
+ANALYZE annexscientificname;
@@ -1,3 +1,5 @@
+-- The secondary indexes are created after the data is loaded, see create_indexes.sql
+
 -- That table contains taxonomic data from GBIF (obtained after matches on the content of scientificname table)
 -- ! Content of this table should stay totally GBIF-populated (so it can be dropped and recreated at any time by running the scripts again)
 CREATE table rank (
@@ -15,6 +17,16 @@ CREATE TABLE taxonomy (
     "exotic_be" boolean -- as returned by GBIF (info from GRIIS Belgium checklist)
 );
 
+-- Materialized closure of the taxonomy hierarchy (based on "parentId"): one row for each (ancestor, descendant) pair,
+-- including each taxon with itself (depth = 0). Maintained incrementally by gbif_match (see taxonomy_closure.py)
+CREATE TABLE taxonomy_closure (
+    "ancestorId" integer NOT NULL REFERENCES taxonomy(id) ON DELETE CASCADE,
+    "descendantId" integer NOT NULL REFERENCES taxonomy(id) ON DELETE CASCADE,
+    "depth" integer NOT NULL, -- number of levels between ancestor and descendant
+    PRIMARY KEY ("ancestorId", "descendantId")
+);
+CREATE INDEX taxonomy_closure_descendant_depth ON taxonomy_closure("descendantId", "depth");
+
 CREATE TYPE gbifmatchtype AS ENUM ('EXACT', 'FUZZY', 'HIGHERRANK', 'NONE');
 -- table contains scientificnames in use in the database, a link to "taxonomy" and metadata about the taxonomic match at GBIF
 CREATE TABLE scientificname (
@@ -27,6 +39,7 @@ CREATE TABLE scientificname (
     "lastMatched" timestamp with time zone, -- when was a GBIF match last attempted?
     "matchConfidence" smallint,
     "matchType" gbifmatchtype,
+    "backboneVersion" character varying(50), -- version of the GBIF Backbone used for the last match
     CONSTRAINT scn_auth UNIQUE("scientificName", "authorship")
 );
 CREATE UNIQUE INDEX scn_auth_not_null ON scientificname("scientificName")
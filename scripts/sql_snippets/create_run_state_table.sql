@@ -0,0 +1,8 @@
+-- Progress of transform_db.py, used to resume an interrupted run (see transform_db.py --resume)
+-- ! Not dropped by drop_new_tables_if_exists.sql: it has to survive step 0
+CREATE TABLE IF NOT EXISTS transform_db_run_state (
+    "step" character varying(50) PRIMARY KEY,
+    "started" timestamp with time zone,
+    "completed" timestamp with time zone, -- NULL if the step is running or has failed
+    "lastRowId" integer -- for the resumable steps: id of the last processed (and committed) row
+);
@@ -4,5 +4,6 @@ DROP TABLE IF EXISTS annexscientificname;
 DROP TABLE IF EXISTS scientificname;
 DROP TYPE IF EXISTS gbifmatchtype;
 DROP TABLE IF EXISTS gbiftaxonomy; -- Previous name of the taxonomy table, in case the DB is outdated
+DROP TABLE IF EXISTS taxonomy_closure;
 DROP TABLE IF EXISTS taxonomy;
 DROP TABLE IF EXISTS rank;
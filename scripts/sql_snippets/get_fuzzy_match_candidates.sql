@@ -0,0 +1,25 @@
+-- Fuzzy match candidates of a batch of names: for each name, the max_candidates most similar names of taxonomy (and
+-- of the local backbone if include_backbone), with a word similarity of at least min_score
+SELECT n."id", c."source", c."gbifId", c."candidateName", c."score"
+FROM (VALUES
+    {% for name in names %}
+    ({{ name.id }}, {{ name.scientificName }}){% if not loop.last %},{% endif %}
+    {% endfor %}
+) AS n("id", "scientificName")
+CROSS JOIN LATERAL (
+    (SELECT 'taxonomy' AS "source", t."gbifId", t."scientificName" AS "candidateName",
+            word_similarity(n."scientificName", t."scientificName") AS "score"
+     FROM taxonomy t
+     ORDER BY n."scientificName" <<-> t."scientificName"
+     LIMIT {{ max_candidates }})
+    {% if include_backbone %}
+    UNION ALL
+    (SELECT 'backbone' AS "source", b."gbifId", b."canonicalName" AS "candidateName",
+            word_similarity(n."scientificName", b."canonicalName") AS "score"
+     FROM fuzzymatchbackbonename b
+     ORDER BY n."scientificName" <<-> b."canonicalName"
+     LIMIT {{ max_candidates }})
+    {% endif %}
+) AS c
+WHERE c."score" >= {{ min_score }}
+ORDER BY n."id", c."score" DESC;
@@ -1,19 +1,28 @@
 SELECT * FROM scientificname
+WHERE TRUE
 {% if demo %}
-WHERE "scientificName" IN (
+    AND "scientificName" IN (
         'Elachista', -- no match to GBIF Backbone will be found
         'Triturus alpestris', -- synonym of Ichthyosaura alpestris
         'Fallopia japonica', -- exotic and synonym of Reynoutria japonica
         'Trentepholia' -- accepted genus
     )
-    {% if unmatched_only %}
+{% endif %}
+{% if incremental %}
+    -- never matched, matched against another version of the backbone, or matched too long ago
+    AND ("lastMatched" IS NULL
+         OR "backboneVersion" IS DISTINCT FROM {{ backbone_version }}
+         {% if matched_before %}
+         OR "lastMatched" < {{ matched_before }}
+         {% endif %}
+        )
+{% elif unmatched_only %}
     AND "taxonomyId" is NULL
-    {% endif %}
-{% else %}
-    {% if unmatched_only %}
-    WHERE "taxonomyId" is NULL
-    {% endif %}
 {% endif %}
+{% if after_id %}
+    AND "id" > {{ after_id }} -- resume after the last processed name
+{% endif %}
+ORDER BY "id"
 {% if limit %}
 LIMIT {{ limit }}
 {% endif %};
@@ -0,0 +1,5 @@
+-- Idempotent upgrades of the new tables created by previous versions of create_new_tables.sql: the --keep-data runs of
+-- transform_db.py don't recreate them, nor the runs which don't start with step 0 (--resume, --from-step, --only-step).
+-- Run at the start of those transform_db.py runs only (nothing to do on tables created by the current
+-- create_new_tables.sql)
+ALTER TABLE IF EXISTS scientificname ADD COLUMN IF NOT EXISTS "backboneVersion" character varying(50);
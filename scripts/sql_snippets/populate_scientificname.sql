@@ -6,5 +6,8 @@ id IN (SELECT taxonid FROM biodiv.identifiablespecies WHERE
 id IN (SELECT identifiablespeciesid FROM biodiv.occurence))
 {% if limit %}
 LIMIT {{ limit }}
+{% endif %}
+{% if keep_existing %}
+ON CONFLICT DO NOTHING
 {% endif %};
 
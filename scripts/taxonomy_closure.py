@@ -0,0 +1,116 @@
+# The taxonomy_closure table materializes the hierarchy of the taxonomy table (based on "parentId"): it contains one
+# row for each (ancestor, descendant) pair, including each taxon with itself (depth = 0).
+#
+# Ancestry, kingdom and subtaxa lookups (see EXAMPLE_QUERIES.md) are then simple indexed joins instead of recursive
+# queries over the whole taxonomy table.
+#
+# gbif_match maintains it incrementally (add_to_taxonomy_closure after insertions, move_in_taxonomy_closure when the
+# parent of a taxon changes), after creating it in the databases whose taxonomy table predates it. Running this
+# script rebuilds it from scratch.
+import logging
+import time
+
+from helpers import execute_sql_from_jinja_string, get_database_connection, get_config, setup_log_file
+
+
+def add_to_taxonomy_closure(conn, taxonomy_ids):
+    """ Add the closure rows of newly inserted taxa (the taxa themselves and all their ancestors)
+
+    The parentId of the taxa must already be set. The ancestors are found by walking up the taxonomy table, so the
+    order of taxonomy_ids (and whether their parents are part of it) doesn't matter. """
+    if not taxonomy_ids:
+        return
+    template = """WITH RECURSIVE ancestors AS (
+                      SELECT "id" AS "ancestorId", "id" AS "descendantId", "parentId", 0 AS "depth"
+                      FROM taxonomy
+                      WHERE "id" IN {{ taxonomy_ids | inclause }}
+                      UNION ALL
+                      SELECT parent."id", a."descendantId", parent."parentId", a."depth" + 1
+                      FROM ancestors a
+                      INNER JOIN taxonomy parent ON parent."id" = a."parentId"
+                  )
+                  INSERT INTO taxonomy_closure ("ancestorId", "descendantId", "depth")
+                  SELECT "ancestorId", "descendantId", "depth" FROM ancestors
+                  ON CONFLICT DO NOTHING"""
+    execute_sql_from_jinja_string(conn, sql_string=template, context={'taxonomy_ids': tuple(taxonomy_ids)})
+
+
+def move_in_taxonomy_closure(conn, taxonomy_id):
+    """ Update the closure rows after a change of the parentId of the taxon taxonomy_id (which moves its whole subtree)
+    """
+    # disconnect the subtree from its former ancestors
+    template = """DELETE FROM taxonomy_closure
+                  WHERE "descendantId" IN (SELECT "descendantId" FROM taxonomy_closure WHERE "ancestorId" = {{ id }})
+                  AND "ancestorId" NOT IN (SELECT "descendantId" FROM taxonomy_closure WHERE "ancestorId" = {{ id }})"""
+    execute_sql_from_jinja_string(conn, sql_string=template, context={'id': taxonomy_id})
+    # connect it to the ancestors of its new parent
+    template = """INSERT INTO taxonomy_closure ("ancestorId", "descendantId", "depth")
+                  SELECT super."ancestorId", sub."descendantId", super."depth" + sub."depth" + 1
+                  FROM taxonomy_closure super, taxonomy_closure sub, taxonomy t
+                  WHERE t."id" = {{ id }}
+                  AND super."descendantId" = t."parentId"
+                  AND sub."ancestorId" = t."id"
+                  ON CONFLICT DO NOTHING"""
+    execute_sql_from_jinja_string(conn, sql_string=template, context={'id': taxonomy_id})
+
+
+def create_taxonomy_closure_if_missing(conn):
+    """ Create and fill the taxonomy_closure table of a database whose taxonomy table was created without it (before
+    the table existed, see create_new_tables.sql)
+
+    Returns True if the table has been created """
+    cur = execute_sql_from_jinja_string(conn, """SELECT to_regclass('taxonomy') IS NOT NULL,
+                                                        to_regclass('taxonomy_closure') IS NOT NULL""")
+    taxonomy_exists, closure_exists = cur.fetchone()
+    if not taxonomy_exists or closure_exists:
+        return False
+
+    start = time.time()
+    # same definition as in create_new_tables.sql
+    template = """CREATE TABLE IF NOT EXISTS taxonomy_closure (
+                      "ancestorId" integer NOT NULL REFERENCES taxonomy(id) ON DELETE CASCADE,
+                      "descendantId" integer NOT NULL REFERENCES taxonomy(id) ON DELETE CASCADE,
+                      "depth" integer NOT NULL,
+                      PRIMARY KEY ("ancestorId", "descendantId")
+                  )"""
+    execute_sql_from_jinja_string(conn, sql_string=template)
+    execute_sql_from_jinja_string(conn, """CREATE INDEX IF NOT EXISTS taxonomy_closure_descendant_depth
+                                           ON taxonomy_closure("descendantId", "depth")""")
+    n_rows = rebuild_taxonomy_closure(conn)
+    msg = f"Table taxonomy_closure created and filled ({n_rows} rows) in {round(time.time() - start, 2)}s."
+    print(msg)
+    logging.info(msg)
+    return True
+
+
+def rebuild_taxonomy_closure(conn):
+    """ Recreate the whole content of the taxonomy_closure table from the taxonomy table
+
+    Returns the number of rows in taxonomy_closure """
+    execute_sql_from_jinja_string(conn, """TRUNCATE taxonomy_closure""")
+    template = """WITH RECURSIVE closure AS (
+                      SELECT "id" AS "ancestorId", "id" AS "descendantId", 0 AS "depth"
+                      FROM taxonomy
+                      UNION ALL
+                      SELECT c."ancestorId", child."id", c."depth" + 1
+                      FROM closure c
+                      INNER JOIN taxonomy child ON child."parentId" = c."descendantId"
+                  )
+                  INSERT INTO taxonomy_closure ("ancestorId", "descendantId", "depth")
+                  SELECT "ancestorId", "descendantId", "depth" FROM closure"""
+    cur = execute_sql_from_jinja_string(conn, sql_string=template)
+    execute_sql_from_jinja_string(conn, """ANALYZE taxonomy_closure""")
+    return cur.rowcount
+
+
+if __name__ == "__main__":
+    connection = get_database_connection()
+    config = get_config()
+    setup_log_file("./logs/taxonomy_closure.log")
+
+    if not create_taxonomy_closure_if_missing(connection):
+        start = time.time()
+        n_rows = rebuild_taxonomy_closure(connection)
+        msg = f"Table taxonomy_closure rebuilt ({n_rows} rows) in {round(time.time() - start, 2)}s."
+        print(msg)
+        logging.info(msg)
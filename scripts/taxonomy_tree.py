@@ -0,0 +1,212 @@
+# Compact in-memory copy of the hierarchy of the taxonomy table
+#
+# The taxa are stored in parallel arrays (stdlib array module), sorted by id: id, gbifId, rankId and the positions
+# (indexes in the arrays) of the parent and of the accepted taxon. Children and synonyms are indexed in CSR form (one
+# offsets array and one flat array of positions), and a preorder numbering of the parent tree gives the kingdom
+# (root), the depth and the subtree membership of each taxon in constant time.
+#
+# Memory use is a few dozen bytes per taxon (instead of several hundreds with a dict of dicts), and the tree is built
+# from a single streamed query in linear time (plus the sort of the gbifId index), so it can be rebuilt at each run.
+#
+#   tree = TaxonomyTree.load(conn)
+#   tree.kingdom(taxonomy_id), tree.ancestors(taxonomy_id), tree.descendants(taxonomy_id), ...
+#
+# Taxa are identified by their taxonomy ids in the public methods. Unknown ids raise a KeyError.
+import array
+import bisect
+import logging
+import time
+
+from helpers import iter_sql_from_jinja_string
+
+NO_INDEX = -1
+
+
+def _build_csr(n, pointers):
+    """ Returns (offsets, values) such that values[offsets[i]:offsets[i + 1]] are the positions j with
+    pointers[j] == i, in increasing order """
+    offsets = array.array('i', [0]) * (n + 1)
+    for target in pointers:
+        if target != NO_INDEX:
+            offsets[target + 1] += 1
+    for i in range(n):
+        offsets[i + 1] += offsets[i]
+    values = array.array('i', [0]) * offsets[n]
+    next_slot = array.array('i', offsets[:n])
+    for j, target in enumerate(pointers):
+        if target != NO_INDEX:
+            values[next_slot[target]] = j
+            next_slot[target] += 1
+    return offsets, values
+
+
+class TaxonomyTree(object):
+    """ Hierarchy (parents and accepted taxa) of the taxonomy table, see the module documentation """
+
+    def __init__(self, ids, gbif_ids, rank_ids, parent_ids, accepted_ids):
+        # ids (sorted), gbif_ids, rank_ids, parent_ids, accepted_ids: parallel sequences (None for no parent/accepted)
+        self._ids = array.array('q', ids)
+        self._gbif_ids = array.array('q', gbif_ids)
+        self._rank_ids = array.array('i', (r if r is not None else NO_INDEX for r in rank_ids))
+        n = len(self._ids)
+
+        self._parents = array.array('i', (self._index_or_none(i) for i in parent_ids))
+        self._accepted = array.array('i', (self._index_or_none(i) for i in accepted_ids))
+
+        # positions sorted by gbifId, for the lookups by GBIF key
+        self._by_gbif_id = array.array('i', sorted(range(n), key=self._gbif_ids.__getitem__))
+        self._sorted_gbif_ids = array.array('q', (self._gbif_ids[i] for i in self._by_gbif_id))
+
+        self._children_offsets, self._children = _build_csr(n, self._parents)
+        # a synonym whose accepted taxon is also its parent is only listed as a child
+        self._synonyms_offsets, self._synonyms = _build_csr(
+            n, array.array('i', (a if a != p else NO_INDEX for a, p in zip(self._accepted, self._parents))))
+
+        self._build_preorder()
+
+    @classmethod
+    def load(cls, conn):
+        """ Build the tree from the content of the taxonomy table (one streamed query) """
+        start = time.time()
+        ids, gbif_ids, rank_ids, parent_ids, accepted_ids = [], [], [], [], []
+        for row in iter_sql_from_jinja_string(conn, """SELECT "id", "gbifId", "rankId", "parentId", "acceptedId"
+                                                       FROM taxonomy ORDER BY "id" """):
+            ids.append(row[0])
+            gbif_ids.append(row[1])
+            rank_ids.append(row[2])
+            parent_ids.append(row[3])
+            accepted_ids.append(row[4])
+        tree = cls(ids, gbif_ids, rank_ids, parent_ids, accepted_ids)
+        logging.info(f"Taxonomy tree of {len(tree)} taxa loaded in {round(time.time() - start, 2)}s.")
+        return tree
+
+    def _index_or_none(self, taxonomy_id):
+        if taxonomy_id is None:
+            return NO_INDEX
+        i = bisect.bisect_left(self._ids, taxonomy_id)
+        if i < len(self._ids) and self._ids[i] == taxonomy_id:
+            return i
+        return NO_INDEX
+
+    def _build_preorder(self):
+        # Preorder numbering of the parent tree (iterative, from the roots): the subtree of a taxon is the range
+        # [preorder, preorder + subtree size) of the numbering. Taxa in a parent cycle (invalid data) are not numbered
+        n = len(self._ids)
+        self._preorder = array.array('i', [NO_INDEX]) * n
+        self._order = array.array('i')  # preorder number -> position
+        self._roots = array.array('i', [NO_INDEX]) * n
+        self._depths = array.array('i', [0]) * n
+        stack = [i for i in range(n) if self._parents[i] == NO_INDEX]
+        stack.reverse()
+        while stack:
+            i = stack.pop()
+            self._preorder[i] = len(self._order)
+            self._order.append(i)
+            parent = self._parents[i]
+            if parent == NO_INDEX:
+                self._roots[i] = i
+            else:
+                self._roots[i] = self._roots[parent]
+                self._depths[i] = self._depths[parent] + 1
+            # reversed, so children are numbered in increasing position order
+            stack.extend(reversed(self._children[self._children_offsets[i]:self._children_offsets[i + 1]]))
+
+        self._subtree_sizes = array.array('i', [1]) * n
+        for i in reversed(self._order):
+            if self._parents[i] != NO_INDEX:
+                self._subtree_sizes[self._parents[i]] += self._subtree_sizes[i]
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, taxonomy_id):
+        return self._index_or_none(taxonomy_id) != NO_INDEX
+
+    def _index(self, taxonomy_id):
+        i = self._index_or_none(taxonomy_id)
+        if i == NO_INDEX:
+            raise KeyError(taxonomy_id)
+        return i
+
+    def _id_or_none(self, i):
+        return self._ids[i] if i != NO_INDEX else None
+
+    def id_of_gbif_id(self, gbif_id):
+        """ Returns the taxonomy id of the taxon with this GBIF key (None if not in the tree) """
+        j = bisect.bisect_left(self._sorted_gbif_ids, gbif_id)
+        if j < len(self._sorted_gbif_ids) and self._sorted_gbif_ids[j] == gbif_id:
+            return self._ids[self._by_gbif_id[j]]
+        return None
+
+    def gbif_id(self, taxonomy_id):
+        return self._gbif_ids[self._index(taxonomy_id)]
+
+    def rank_id(self, taxonomy_id):
+        rank_id = self._rank_ids[self._index(taxonomy_id)]
+        return rank_id if rank_id != NO_INDEX else None
+
+    def parent(self, taxonomy_id):
+        return self._id_or_none(self._parents[self._index(taxonomy_id)])
+
+    def accepted(self, taxonomy_id):
+        return self._id_or_none(self._accepted[self._index(taxonomy_id)])
+
+    def children(self, taxonomy_id):
+        i = self._index(taxonomy_id)
+        return [self._ids[j] for j in self._children[self._children_offsets[i]:self._children_offsets[i + 1]]]
+
+    def synonyms(self, taxonomy_id):
+        """ Taxa pointing to taxonomy_id as accepted taxon (except its children) """
+        i = self._index(taxonomy_id)
+        return [self._ids[j] for j in self._synonyms[self._synonyms_offsets[i]:self._synonyms_offsets[i + 1]]]
+
+    def ancestors(self, taxonomy_id):
+        """ Ids of the parent, grand-parent... up to the kingdom """
+        result = []
+        i = self._parents[self._index(taxonomy_id)]
+        while i != NO_INDEX and len(result) < len(self._ids):  # length check: protection against parent cycles
+            result.append(self._ids[i])
+            i = self._parents[i]
+        return result
+
+    def kingdom(self, taxonomy_id):
+        """ Id of the root of the tree of taxonomy_id (itself for a root, None if in a parent cycle) """
+        return self._id_or_none(self._roots[self._index(taxonomy_id)])
+
+    def depth(self, taxonomy_id):
+        return self._depths[self._index(taxonomy_id)]
+
+    def is_in_subtree(self, taxonomy_id, ancestor_id):
+        """ True if ancestor_id is taxonomy_id or one of its ancestors (constant time) """
+        i = self._preorder[self._index(taxonomy_id)]
+        j = self._index(ancestor_id)
+        root = self._preorder[j]
+        return i != NO_INDEX and root != NO_INDEX and root <= i < root + self._subtree_sizes[j]
+
+    def descendants(self, taxonomy_id, include_synonyms=False):
+        """ Ids of the children, grand-children... of taxonomy_id (in preorder). With include_synonyms, the synonyms
+        of these taxa (and their descendants, recursively) are also included, and the ids are sorted """
+        if include_synonyms:
+            return sorted(self.subtrees([taxonomy_id], include_synonyms=True) - {taxonomy_id})
+        j = self._index(taxonomy_id)
+        root = self._preorder[j]
+        if root == NO_INDEX:
+            return []
+        return [self._ids[i] for i in self._order[root + 1:root + self._subtree_sizes[j]]]
+
+    def subtrees(self, taxonomy_ids, include_synonyms=False):
+        """ Set of the ids of the taxa taxonomy_ids and of all their descendants (and synonyms, recursively, if
+        include_synonyms), in linear time in the size of the result """
+        visited = bytearray(len(self._ids))
+        to_visit = [self._index(taxonomy_id) for taxonomy_id in taxonomy_ids]
+        result = set()
+        while to_visit:
+            i = to_visit.pop()
+            if visited[i]:
+                continue
+            visited[i] = 1
+            result.add(self._ids[i])
+            to_visit.extend(self._children[self._children_offsets[i]:self._children_offsets[i + 1]])
+            if include_synonyms:
+                to_visit.extend(self._synonyms[self._synonyms_offsets[i]:self._synonyms_offsets[i + 1]])
+        return result
@@ -0,0 +1,35 @@
+import os
+import sys
+import uuid
+
+import psycopg2
+import pytest
+
+# the scripts import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import helpers  # noqa: E402
+
+
+@pytest.fixture
+def db_conn():
+    """ Connection to the database of config.ini, with a new (empty) schema as search_path, dropped at the end
+
+    The tests using it are skipped when there is no config.ini or when the database can't be reached. """
+    try:
+        conn = psycopg2.connect(**helpers._get_connection_parameters(helpers.get_config()))
+    except Exception as e:
+        pytest.skip(f"No test database: {e}")
+    conn.autocommit = True
+    schema = f"test_{uuid.uuid4().hex}"
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA {schema}")
+        cur.execute(f"SET search_path TO {schema}")
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA {schema} CASCADE")
+        conn.close()
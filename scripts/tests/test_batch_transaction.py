@@ -0,0 +1,62 @@
+from unittest import mock
+
+import pytest
+
+import helpers
+
+
+class _FakeTime(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def fake_time():
+    clock = _FakeTime()
+    with mock.patch.object(helpers, 'time', clock):
+        yield clock
+
+
+def test_commits_every_n_rows(fake_time):
+    conn = mock.MagicMock(autocommit=True)
+    with helpers.BatchTransaction(conn, commit_every_rows=3, commit_every_seconds=60) as transaction:
+        assert conn.autocommit is False
+        for _ in range(7):
+            transaction.row_done()
+        assert conn.commit.call_count == 2
+    # the last (incomplete) batch is committed at the end
+    assert conn.commit.call_count == 3
+    assert conn.autocommit is True
+
+
+def test_commits_every_n_seconds(fake_time):
+    conn = mock.MagicMock(autocommit=True)
+    checkpoints = []
+    with helpers.BatchTransaction(conn, commit_every_rows=1000, commit_every_seconds=10,
+                                  before_commit=lambda: checkpoints.append(fake_time.now)) as transaction:
+        transaction.row_done(0)
+        fake_time.now += 9
+        transaction.row_done(0)
+        assert checkpoints == []
+        fake_time.now += 1
+        transaction.row_done(0)
+        assert checkpoints == [1010.0]
+    assert conn.commit.call_count == 2
+
+
+def test_rolls_back_the_current_batch_on_error(fake_time):
+    conn = mock.MagicMock(autocommit=True)
+    after_commit = mock.MagicMock()
+    with pytest.raises(ValueError):
+        with helpers.BatchTransaction(conn, commit_every_rows=2, after_commit=after_commit) as transaction:
+            transaction.row_done()
+            transaction.row_done()
+            transaction.row_done()
+            raise ValueError("failed row")
+    # the first batch is kept, the second one is rolled back
+    assert conn.commit.call_count == 1 and after_commit.call_count == 1
+    conn.rollback.assert_called_once_with()
+    assert conn.autocommit is True
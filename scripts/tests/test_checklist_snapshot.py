@@ -0,0 +1,91 @@
+import zipfile
+from unittest import mock
+
+import pytest
+
+import checklist_snapshot
+from checklist_snapshot import ChecklistSnapshots, get_checklist_nub_keys
+
+GRIIS_BE = '6d9e952f-948c-4483-9807-575348147c7e'
+
+META_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<archive xmlns="http://rs.tdwg.org/dwc/text/" metadata="eml.xml">
+  <core encoding="UTF-8" fieldsTerminatedBy="\\t" linesTerminatedBy="\\n" fieldsEnclosedBy="" ignoreHeaderLines="1"
+        rowType="http://rs.tdwg.org/dwc/terms/Taxon">
+    <files><location>taxon.txt</location></files>
+    <id index="0"/>
+{fields}
+  </core>
+</archive>
+"""
+
+
+def _meta_xml(terms):
+    return META_XML.format(fields="\n".join(f'    <field index="{i}" term="http://rs.tdwg.org/dwc/terms/{term}"/>'
+                                            for i, term in enumerate(terms)))
+
+
+@pytest.fixture
+def snapshots(tmp_path):
+    return ChecklistSnapshots(str(tmp_path / 'snapshots.sqlite'))
+
+
+def test_unchanged_checklist_is_read_from_the_snapshot(snapshots):
+    snapshots.save(GRIIS_BE, '2023-10-01T10:00:00', [5217, 2427091])
+    with mock.patch.object(checklist_snapshot, 'gbif_dataset_modified', return_value='2023-10-01T10:00:00'), \
+            mock.patch.object(checklist_snapshot, '_download_nub_keys') as download:
+        nub_keys, save_snapshot = get_checklist_nub_keys(snapshots, GRIIS_BE)
+    download.assert_not_called()
+    assert sorted(nub_keys) == [5217, 2427091] and save_snapshot is None
+
+
+def test_changed_checklist_is_downloaded_and_saved_when_applied(snapshots):
+    snapshots.save(GRIIS_BE, '2023-10-01T10:00:00', [5217, 2427091])
+    with mock.patch.object(checklist_snapshot, 'gbif_dataset_modified', return_value='2023-11-15T08:30:00'), \
+            mock.patch.object(checklist_snapshot, '_download_nub_keys', return_value=[5217, 8]):
+        nub_keys, save_snapshot = get_checklist_nub_keys(snapshots, GRIIS_BE)
+    assert nub_keys == [5217, 8]
+    # the previous snapshot is kept until the caller has applied the new content
+    assert snapshots.get_version(GRIIS_BE) == '2023-10-01T10:00:00'
+    save_snapshot()
+    assert snapshots.get_version(GRIIS_BE) == '2023-11-15T08:30:00'
+    assert sorted(snapshots.get_nub_keys(GRIIS_BE)) == [8, 5217]
+
+
+def test_archive_with_nub_keys(tmp_path):
+    archive = tmp_path / 'dwca-griis-belgium'
+    archive.mkdir()
+    (archive / 'meta.xml').write_text(_meta_xml(['taxonID', 'scientificName', 'nubKey']))
+    (archive / 'taxon.txt').write_text("id\tscientificName\tnubKey\n"
+                                       "1\tPelophylax ridibundus (Pallas, 1771)\t5217\n"
+                                       "2\tUnmatched name\t\n")
+    assert checklist_snapshot._read_archive_nub_keys(str(archive)) == [5217]
+
+
+def test_zipped_archive_without_nub_keys_is_matched_on_the_backbone(tmp_path):
+    archive = tmp_path / 'dwca-griis-belgium.zip'
+    with zipfile.ZipFile(archive, 'w') as z:
+        z.writestr('meta.xml', _meta_xml(['taxonID', 'scientificName', 'scientificNameAuthorship']))
+        z.writestr('taxon.txt', "id\tscientificName\tscientificNameAuthorship\n"
+                                "1\tPelophylax ridibundus\t(Pallas, 1771)\n"
+                                "2\tOenanthe L.\tL.\n"
+                                "3\tUnmatched name\t\n")
+    matches = {"Pelophylax ridibundus (Pallas, 1771)": {'matchType': 'EXACT', 'usageKey': 5217},
+               "Oenanthe L.": {'matchType': 'EXACT', 'usageKey': 3034893}}
+
+    with mock.patch.object(checklist_snapshot, 'gbif_name_backbone',
+                           side_effect=lambda name, strict: matches.get(name, {'matchType': 'NONE'})):
+        assert checklist_snapshot._read_archive_nub_keys(str(archive)) == [5217, 3034893]
+
+
+def test_archive_version_is_its_modification_date(snapshots, tmp_path):
+    archive = tmp_path / 'dwca'
+    archive.mkdir()
+    with mock.patch.object(checklist_snapshot, '_read_archive_nub_keys', return_value=[5217]) as read, \
+            mock.patch.object(checklist_snapshot, 'gbif_dataset_modified') as registry:
+        nub_keys, save_snapshot = get_checklist_nub_keys(snapshots, GRIIS_BE, archive_path=str(archive))
+        save_snapshot()
+        nub_keys, save_snapshot = get_checklist_nub_keys(snapshots, GRIIS_BE, archive_path=str(archive))
+    registry.assert_not_called()
+    assert read.call_count == 1 and nub_keys == [5217] and save_snapshot is None
+    assert snapshots.get_version(GRIIS_BE).startswith("archive ")
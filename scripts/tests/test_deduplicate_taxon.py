@@ -0,0 +1,21 @@
+from unittest import mock
+
+import deduplicate_taxon
+import helpers
+
+
+def test_row_by_row_replaces_each_duplicate():
+    executed = []
+
+    def execute(conn, sql_string, context=None, dict_cursor=False):
+        executed.append((sql_string, context))
+
+    with mock.patch.object(deduplicate_taxon, 'execute_sql_from_jinja_string', execute), \
+            mock.patch.object(helpers, '_verbose', True):
+        deduplicate_taxon._deduplicate_taxon_row_by_row(mock.MagicMock(), {12: 3})
+
+    updates = [context for sql_string, context in executed if sql_string.startswith("UPDATE")]
+    assert [(u['table'], u['column']) for u in updates] == deduplicate_taxon.REFERENCING_COLUMNS
+    assert all(u['old_id'] == 12 and u['new_id'] == 3 for u in updates)
+    sql_string, context = executed[-1]
+    assert sql_string.startswith("DELETE FROM biodiv.taxon") and context['old_id'] == 12
@@ -0,0 +1,69 @@
+from unittest import mock
+
+import pytest
+
+import helpers
+
+
+class _FakeTime(object):
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def fake_time():
+    clock = _FakeTime()
+    with mock.patch.object(helpers, 'time', clock):
+        yield clock
+
+
+def test_hits_do_not_write_to_the_cache(tmp_path):
+    cache = helpers.GbifCache(str(tmp_path / 'cache.sqlite'), ttl=3600, max_entries=10)
+    cache.set('species/match?{}', {'matchType': 'EXACT'})
+    changes = cache._conn.total_changes
+    for _ in range(3):
+        assert cache.get('species/match?{}') == (True, {'matchType': 'EXACT'})
+    assert cache._conn.total_changes == changes
+    assert cache._conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+
+
+def test_entries_expire_after_the_ttl(tmp_path, fake_time):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = helpers.GbifCache(path, ttl=3600, max_entries=10)
+    cache.set('species?{"key": 5}', {'key': 5})
+    fake_time.now += 3600
+    # kept by the file
+    assert helpers.GbifCache(path, ttl=3600, max_entries=10).get('species?{"key": 5}') == (True, {'key': 5})
+
+    fake_time.now += 1
+    assert cache.get('species?{"key": 5}') == (False, None)
+    assert cache._n_entries == 0 and (cache.hits, cache.misses) == (0, 1)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, fake_time):
+    cache = helpers.GbifCache(str(tmp_path / 'cache.sqlite'), ttl=3600, max_entries=10)
+    for i in range(10):
+        cache.set(f"species?{i}", i)
+        fake_time.now += 1
+    # older than the lastAccess resolution (36s): entry 0 becomes the most recently used
+    fake_time.now += 60
+    assert cache.get("species?0") == (True, 0)
+
+    cache.set("species?10", 10)
+    # one entry over max_entries: 1 + 10% of the cache are evicted
+    assert cache.evictions == 2 and cache._n_entries == 9
+    assert [cache.get(f"species?{i}")[0] for i in range(11)] == [True, False, False] + [True] * 8
+
+
+def test_endpoint_entries_are_removed_when_the_backbone_version_changes(tmp_path):
+    cache = helpers.GbifCache(str(tmp_path / 'cache.sqlite'), ttl=3600, max_entries=10)
+    cache.set('species/match?{"name": "Rana"}', {'matchType': 'EXACT'})
+    cache.set('dataset/suggest?{"q": "GRIIS"}', [])
+    assert not cache.invalidate_if_changed('backboneVersion', '2022-11-23', endpoints=['species/match'])
+    assert not cache.invalidate_if_changed('backboneVersion', '2022-11-23', endpoints=['species/match'])
+    assert cache.invalidate_if_changed('backboneVersion', '2023-08-28', endpoints=['species/match'])
+    assert cache.get('species/match?{"name": "Rana"}')[0] is False
+    assert cache.get('dataset/suggest?{"q": "GRIIS"}') == (True, [])
@@ -0,0 +1,104 @@
+import configparser
+from unittest import mock
+
+import gbif_match
+
+
+def _match_all(rows):
+    sent = []
+
+    def match(scientific_name, authorship):
+        sent.append((scientific_name, authorship))
+        return {'matchType': 'EXACT', 'usageKey': len(sent)}
+
+    groups = gbif_match._MatchGroups(enabled=True)
+    results = [groups.get_or_match(row, match) for row in rows]
+    return sent, results
+
+
+def test_et_al_authorship_is_sent_unchanged():
+    sent, _ = _match_all([{'scientificName': "Carex  flava", 'authorship': " Hook. et al."}])
+    assert sent == [("Carex flava", "Hook. et al.")]
+
+
+def test_rows_of_a_group_are_matched_once_with_the_first_row_name():
+    sent, results = _match_all([{'scientificName': "Rana ridibunda", 'authorship': "Pallas et Mill."},
+                                {'scientificName': "rana  ridibunda", 'authorship': "Pallas & Mill."},
+                                {'scientificName': "Rana ridibunda", 'authorship': "Pallas et al."}])
+    assert sent == [("Rana ridibunda", "Pallas et Mill."), ("Rana ridibunda", "Pallas et al.")]
+    assert results[0] is results[1]
+
+
+class _Cursor(list):
+    @property
+    def rowcount(self):
+        return len(self)
+
+
+def test_row_mode_writes_the_other_rows_of_a_group_together():
+    config = configparser.ConfigParser()
+    config.read_dict({'demo_mode': {'demo': 'False'}, 'gbif_match': {'scientificnames-limit': '', 'batch-size': ''}})
+    rows = _Cursor([{'id': 1, 'scientificName': "Rana ridibunda", 'authorship': None},
+                    {'id': 2, 'scientificName': "Bufo bufo", 'authorship': None},
+                    {'id': 3, 'scientificName': "Rana  ridibunda", 'authorship': None}])
+    updated, bulk_updated = [], []
+
+    with mock.patch.object(gbif_match, 'create_taxonomy_closure_if_missing'), \
+            mock.patch.object(gbif_match, '_get_backbone_version', return_value='2023-08-28'), \
+            mock.patch.object(gbif_match, 'execute_sql_from_file', return_value=rows), \
+            mock.patch.object(gbif_match, '_load_taxonomy_index', return_value={}), \
+            mock.patch.object(gbif_match, '_match_name', side_effect=lambda name, authorship, backbone, name_usages: {
+                'matchType': 'EXACT', 'usageKey': 100 + len(name), 'confidence': 99}), \
+            mock.patch.object(gbif_match, '_add_taxon_tree', side_effect=lambda conn, key, **kwargs: key), \
+            mock.patch.object(gbif_match, '_update_match_info',
+                              side_effect=lambda conn, match_info, row_id: updated.append(row_id)), \
+            mock.patch.object(gbif_match, '_bulk_update_match_info',
+                              side_effect=lambda conn, matches_info: bulk_updated.append(list(matches_info))), \
+            mock.patch.object(gbif_match, 'gbif_cache_stats_message', return_value=''):
+        gbif_match.gbif_match(mock.MagicMock(), config)
+
+    assert updated == [1, 2]
+    assert len(bulk_updated) == 1
+    [(row_id, match_info)] = bulk_updated[0]
+    assert row_id == 3 and match_info['taxonomyId'] == 114
+
+
+def test_each_run_has_its_own_name_usages_memo():
+    config = configparser.ConfigParser()
+    config.read_dict({'demo_mode': {'demo': 'False'}, 'gbif_match': {'scientificnames-limit': '', 'batch-size': ''}})
+    memos = []
+
+    def match_names(rows, name_usages=None, **kwargs):
+        memos.append((name_usages, dict(name_usages)))
+        name_usages[5] = {'key': 5}
+        return iter([])
+
+    with mock.patch.object(gbif_match, 'create_taxonomy_closure_if_missing'), \
+            mock.patch.object(gbif_match, '_get_backbone_version', return_value='2023-08-28'), \
+            mock.patch.object(gbif_match, 'execute_sql_from_file', return_value=_Cursor([{'id': 1}])), \
+            mock.patch.object(gbif_match, '_load_taxonomy_index', return_value={}), \
+            mock.patch.object(gbif_match, '_match_names', match_names), \
+            mock.patch.object(gbif_match, 'gbif_cache_stats_message', return_value=''):
+        gbif_match.gbif_match(mock.MagicMock(), config)
+        gbif_match.gbif_match(mock.MagicMock(), config)
+
+    # the entries fetched by the first run aren't seen by the second one
+    assert memos[0][0] is not memos[1][0] and memos[1][1] == {}
+
+
+def test_new_lineages_come_parents_and_accepted_taxa_first():
+    name_usages = {1: {'key': 1},
+                   10: {'key': 10, 'parentKey': 1},
+                   100: {'key': 100, 'parentKey': 10},
+                   101: {'key': 101, 'parentKey': 10},
+                   200: {'key': 200, 'parentKey': 10, 'acceptedKey': 100}}
+    taxonomy_index = {1: {'id': 1}}  # only the kingdom is already in taxonomy
+
+    ordered = gbif_match._collect_new_lineages([200, 101, 100], taxonomy_index, name_usages=name_usages)
+
+    keys = [name_usage_info['key'] for name_usage_info in ordered]
+    assert sorted(keys) == [10, 100, 101, 200]
+    for name_usage_info in ordered:
+        for dependency in (name_usage_info.get('parentKey'), name_usage_info.get('acceptedKey')):
+            if dependency is not None and dependency not in taxonomy_index:
+                assert keys.index(dependency) < keys.index(name_usage_info['key'])
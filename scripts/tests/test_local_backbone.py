@@ -0,0 +1,53 @@
+import pytest
+
+from local_backbone import LocalBackbone
+
+TAXON_TSV_COLUMNS = ['taxonID', 'parentNameUsageID', 'acceptedNameUsageID', 'scientificName',
+                     'scientificNameAuthorship', 'canonicalName', 'taxonRank', 'taxonomicStatus', 'kingdom']
+TAXA = [
+    ['1', '', '', 'Animalia', '', 'Animalia', 'kingdom', 'accepted', 'Animalia'],
+    ['6', '', '', 'Plantae', '', 'Plantae', 'kingdom', 'accepted', 'Plantae'],
+    # homonyms: a genus of birds and a genus of plants
+    ['2492483', '1', '', 'Oenanthe Vieillot, 1816', 'Vieillot, 1816', 'Oenanthe', 'genus', 'accepted', 'Animalia'],
+    ['3034893', '6', '', 'Oenanthe L.', 'L.', 'Oenanthe', 'genus', 'accepted', 'Plantae'],
+    ['2427091', '1', '', 'Rana ridibunda Pallas, 1771', 'Pallas, 1771', 'Rana ridibunda', 'species', 'accepted',
+     'Animalia'],
+    # two synonyms of the same accepted taxon
+    ['5217', '1', '2427091', 'Pelophylax ridibundus (Pallas, 1771)', '(Pallas, 1771)', 'Pelophylax ridibundus',
+     'species', 'homotypic synonym', 'Animalia'],
+    ['5218', '1', '2427091', 'Pelophylax ridibundus Auct.', 'Auct.', 'Pelophylax ridibundus', 'species',
+     'homotypic synonym', 'Animalia'],
+]
+
+
+@pytest.fixture
+def backbone(tmp_path):
+    taxon_file = tmp_path / 'Taxon.tsv'
+    taxon_file.write_text('\n'.join('\t'.join(row) for row in [TAXON_TSV_COLUMNS] + TAXA) + '\n', encoding='utf-8')
+    return LocalBackbone.build(str(tmp_path / 'backbone.sqlite'), str(taxon_file))
+
+
+def test_homonyms_resolving_to_different_taxa_are_not_matched(backbone):
+    match = backbone.name_backbone('Oenanthe')
+    assert match['matchType'] == 'NONE'
+    assert match['note'] == "Multiple equal matches for Oenanthe"
+
+
+def test_authorship_resolves_homonyms(backbone):
+    match = backbone.name_backbone('Oenanthe', 'L.')
+    assert (match['matchType'], match['usageKey'], match['kingdom']) == ('EXACT', 3034893, 'Plantae')
+
+
+def test_synonyms_of_the_same_accepted_taxon_are_not_ambiguous(backbone):
+    match = backbone.name_backbone('Pelophylax ridibundus')
+    assert match['matchType'] == 'EXACT' and match['synonym']
+    assert match['acceptedUsageKey'] == 2427091
+
+
+def test_name_usage(backbone):
+    assert backbone.name_usage(5217) == {'key': 5217, 'nubKey': 5217,
+                                         'scientificName': 'Pelophylax ridibundus (Pallas, 1771)',
+                                         'canonicalName': 'Pelophylax ridibundus', 'authorship': '(Pallas, 1771)',
+                                         'rank': 'SPECIES', 'taxonomicStatus': 'HOMOTYPIC_SYNONYM',
+                                         'kingdom': 'Animalia', 'parentKey': 1, 'acceptedKey': 2427091}
+    assert backbone.name_usage(42) == {}
@@ -0,0 +1,59 @@
+import threading
+
+from metrics import Metrics, NO_STEP
+
+
+def _statement_steps(metrics):
+    return sorted((s['step'], s['statement']) for s in metrics.summary()['statements'])
+
+
+def test_concurrent_threads_record_in_their_own_step():
+    metrics = Metrics()
+    in_step = threading.Barrier(2)
+
+    def stage(step):
+        with metrics.step(step):
+            in_step.wait()  # both threads are in their step
+            metrics.record_statement(f"insert {step}", 0.01, 1)
+
+    with metrics.step('4'):
+        threads = [threading.Thread(target=stage, args=(step,)) for step in ('5', '6')]
+        for thread in threads:
+            thread.start()
+        metrics.record_statement("match", 0.01, 1)
+        for thread in threads:
+            thread.join()
+    metrics.record_statement("summary", 0.01, 1)
+
+    assert _statement_steps(metrics) == [('4', 'match'), ('5', 'insert 5'), ('6', 'insert 6'), (NO_STEP, 'summary')]
+    assert sorted(metrics.summary()['steps']) == ['4', '5', '6']
+
+
+def test_workers_without_step_use_the_step_of_the_main_thread():
+    metrics = Metrics()
+    with metrics.step('4'):
+        worker = threading.Thread(target=metrics.record_gbif_call, args=('species/match', 0.1, 100))
+        worker.start()
+        worker.join()
+    assert [(g['step'], g['calls']) for g in metrics.summary()['gbif']] == [('4', 1)]
+
+
+def test_a_step_entered_by_several_threads_is_counted_once():
+    metrics = Metrics()
+    release = threading.Event()
+    entered = threading.Barrier(3)
+
+    def worker():
+        with metrics.step('5'):
+            entered.wait()
+            release.wait()
+
+    threads = [threading.Thread(target=worker) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    entered.wait()
+    assert metrics._active_steps['5'][0] == 2
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert metrics._active_steps == {} and list(metrics.step_durations) == ['5']
@@ -0,0 +1,29 @@
+import configparser
+import contextlib
+from unittest import mock
+
+import pipeline
+
+
+def test_exotic_status_of_parents_inserted_before_the_run():
+    stage = pipeline._ExoticStatusStage(configparser.ConfigParser(), 'griis', queue_size=10)
+    stage._queue.put([{'id': 10, 'gbifId': 1010, 'parentId': 1, 'acceptedId': None},
+                      {'id': 11, 'gbifId': 1011, 'parentId': 2, 'acceptedId': None},
+                      {'id': 12, 'gbifId': 5217, 'parentId': 2, 'acceptedId': None},
+                      {'id': 13, 'gbifId': 1013, 'parentId': 11, 'acceptedId': 10}])
+    stage._queue.put(pipeline._END)
+    written = {}
+
+    # taxonomy: 1 is exotic, the status of 2 isn't known yet
+    with mock.patch.object(pipeline.exotic_status, 'get_alien_taxa', return_value=([5217], None)), \
+            mock.patch.object(pipeline, 'pooled_connection', side_effect=lambda: contextlib.nullcontext()), \
+            mock.patch.object(pipeline, 'execute_sql_from_jinja_string',
+                              return_value=[(1, True), (2, None)]) as execute_sql, \
+            mock.patch.object(pipeline.exotic_status, 'set_exotic_be_of_taxa',
+                              side_effect=lambda conn, exotic_be_by_id: written.update(exotic_be_by_id)):
+        stage.run()
+
+    assert execute_sql.call_args.kwargs['context'] == {'ids': [1, 2]}
+    assert written == {10: True, 11: False, 12: True, 13: True}
+    # 11 will be fixed by the recompute of the whole taxonomy
+    assert stage.n_unknown_lineages == 1
@@ -0,0 +1,44 @@
+import configparser
+
+import populate_annex_scientificname
+
+ANNEX_CSV = """annexCode,scientificNameInAnnex,scientificName,authorship,pageNumber,remarks
+A1,Rana ridibunda,Rana ridibunda,,1,
+A1,Bufo bufo L.,Bufo bufo,L.,1,
+A2,Frogs,,,2,not a scientific name
+"""
+
+
+def test_bulk_load_links_each_annex_row_once(db_conn, tmp_path):
+    with db_conn.cursor() as cur:
+        cur.execute("""CREATE TABLE scientificname (
+                           "id" serial PRIMARY KEY,
+                           "scientificName" character varying(255) NOT NULL,
+                           "authorship" character varying(255),
+                           CONSTRAINT scn_auth UNIQUE("scientificName", "authorship"));
+                       CREATE UNIQUE INDEX scn_auth_not_null ON scientificname("scientificName")
+                       WHERE "authorship" IS NULL;
+                       CREATE TABLE annexscientificname (
+                           "id" serial PRIMARY KEY,
+                           "scientificNameId" integer REFERENCES scientificname(id),
+                           "scientificNameInAnnex" character varying(1023) NOT NULL,
+                           "remarks" character varying (1023),
+                           "isScientificName" boolean,
+                           "annexCode" character varying(255))""")
+        # legacy name with an empty authorship (copied as-is by populate_scientificname.sql)
+        cur.execute("""INSERT INTO scientificname ("scientificName", "authorship") VALUES ('Rana ridibunda', '')""")
+    annex_file = tmp_path / 'annexes.csv'
+    annex_file.write_text(ANNEX_CSV)
+
+    n_rows = populate_annex_scientificname._populate_annex_scientificname_bulk(
+        db_conn, configparser.ConfigParser(), str(annex_file), n_taxa_max=10)
+
+    assert n_rows == 3
+    with db_conn.cursor() as cur:
+        cur.execute("""SELECT a."scientificNameInAnnex", s."scientificName", s."authorship"
+                       FROM annexscientificname a
+                       LEFT JOIN scientificname s ON s."id" = a."scientificNameId"
+                       ORDER BY a."id" """)
+        assert cur.fetchall() == [('Rana ridibunda', 'Rana ridibunda', None),
+                                  ('Bufo bufo L.', 'Bufo bufo', 'L.'),
+                                  ('Frogs', None, None)]
@@ -0,0 +1,80 @@
+from unittest import mock
+
+import pytest
+
+import speciesbim
+from speciesbim import LruCache, SpeciesBim
+
+
+def test_lru_cache_evicts_the_least_recently_used_entries():
+    cache = LruCache(max_entries=2)
+    cache.set_many({'a': 1, 'b': 2})
+    assert cache.get_many(['a']) == {'a': 1}
+    cache.set_many({'c': 3})
+    assert cache.get_many(['a', 'b', 'c']) == {'a': 1, 'c': 3}
+    assert (len(cache), cache.hits, cache.misses) == (2, 3, 1)
+    cache.clear()
+    assert len(cache) == 0 and cache.get_many(['a']) == {}
+
+
+class _Database(object):
+    """ Stand-in for execute_sql_from_jinja_string: the transform_db_run_state version and the TAXA_SQL query """
+
+    def __init__(self, taxa):
+        self.taxa = taxa
+        self.version = '2023-10-01 10:00:00'
+        self.loaded_batches = []
+
+    def execute(self, conn, sql_string, context=None, dict_cursor=False):
+        cur = mock.MagicMock()
+        if 'to_regclass' in sql_string:
+            cur.fetchone.return_value = (True,)
+        elif 'transform_db_run_state' in sql_string:
+            cur.fetchone.return_value = (self.version,)
+        else:
+            assert sql_string == speciesbim.TAXA_SQL
+            self.loaded_batches.append(list(context['ids']))
+            cur.__iter__.return_value = [self.taxa[i] for i in context['ids'] if i in self.taxa]
+        return cur
+
+
+@pytest.fixture
+def database():
+    db = _Database({i: {'id': i, 'scientificName': f"Taxon {i}"} for i in range(1, 6)})
+    with mock.patch.object(speciesbim, 'execute_sql_from_jinja_string', db.execute):
+        yield db
+
+
+def test_taxa_are_loaded_by_batches_and_cached(database):
+    bim = SpeciesBim(check_every_seconds=0, batch_size=2)
+    taxa = bim.get_taxa(None, [1, 2, 3, 4, 5, 42])
+    assert sorted(taxa) == [1, 2, 3, 4, 5]
+    assert database.loaded_batches == [[1, 2], [3, 4], [5, 42]]
+
+    # unknown ids are cached too
+    assert bim.get_taxon(None, 3) == {'id': 3, 'scientificName': "Taxon 3"} and bim.get_taxon(None, 42) is None
+    assert len(database.loaded_batches) == 3
+
+
+def test_cache_is_invalidated_when_a_transform_db_run_completes(database):
+    bim = SpeciesBim(check_every_seconds=0)
+    bim.get_taxon(None, 1)
+    bim.get_taxon(None, 1)
+    assert len(database.loaded_batches) == 1
+
+    database.version = '2023-11-15 08:30:00'
+    database.taxa[1]['scientificName'] = "Renamed taxon"
+    assert bim.get_taxon(None, 1)['scientificName'] == "Renamed taxon"
+    assert len(database.loaded_batches) == 2
+
+
+def test_data_version_is_checked_at_most_every_check_every_seconds(database):
+    bim = SpeciesBim(check_every_seconds=3600)
+    bim.get_taxon(None, 1)
+    database.version = '2023-11-15 08:30:00'
+    bim.get_taxon(None, 1)
+    assert len(database.loaded_batches) == 1
+
+    bim.invalidate()
+    bim.get_taxon(None, 1)
+    assert len(database.loaded_batches) == 2
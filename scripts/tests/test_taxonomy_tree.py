@@ -0,0 +1,68 @@
+from unittest import mock
+
+import pytest
+
+import taxonomy_tree
+from taxonomy_tree import TaxonomyTree
+
+# (id, parentId, acceptedId)
+TAXA = [
+    (1, None, None),  # Animalia
+    (2, 1, None),  # Chordata
+    (3, 2, None),  # Amphibia
+    (4, 3, None),  # Rana
+    (5, 3, None),  # Pelophylax
+    (6, 5, None),  # Pelophylax ridibundus
+    (7, 4, 6),  # Rana ridibunda, synonym of Pelophylax ridibundus
+    (8, 5, 5),  # synonym of its parent: only listed as a child
+    (9, None, None),  # Plantae
+    (11, 12, None),  # parent cycle (invalid data)
+    (12, 11, None),
+]
+
+
+@pytest.fixture
+def tree():
+    ids, parent_ids, accepted_ids = zip(*TAXA)
+    return TaxonomyTree(ids, [i * 100 for i in ids], [None] * len(ids), parent_ids, accepted_ids)
+
+
+def test_hierarchy(tree):
+    assert len(tree) == 11 and 7 in tree and 10 not in tree
+    assert tree.parent(7) == 4 and tree.accepted(7) == 6 and tree.parent(1) is None
+    assert tree.children(5) == [6, 8]
+    assert tree.synonyms(6) == [7] and tree.synonyms(5) == []
+    assert tree.ancestors(7) == [4, 3, 2, 1]
+    assert (tree.kingdom(7), tree.kingdom(9), tree.depth(7)) == (1, 9, 4)
+    assert tree.id_of_gbif_id(700) == 7 and tree.id_of_gbif_id(1000) is None
+    assert tree.gbif_id(7) == 700 and tree.rank_id(7) is None
+    with pytest.raises(KeyError):
+        tree.parent(10)
+
+
+def test_descendants(tree):
+    assert tree.descendants(3) == [4, 7, 5, 6, 8]
+    assert tree.descendants(6) == []
+    # the synonym of Pelophylax ridibundus is in the subtree of Rana
+    assert tree.descendants(5, include_synonyms=True) == [6, 7, 8]
+    assert tree.is_in_subtree(7, 3) and tree.is_in_subtree(3, 3) and not tree.is_in_subtree(7, 5)
+
+
+def test_subtrees(tree):
+    assert tree.subtrees([4, 9]) == {4, 7, 9}
+    assert tree.subtrees([5], include_synonyms=True) == {5, 6, 7, 8}
+    assert tree.subtrees([]) == set()
+
+
+def test_parent_cycles_are_not_walked_forever(tree):
+    assert tree.kingdom(11) is None
+    assert tree.descendants(11) == []
+    assert len(tree.ancestors(11)) == len(tree)  # stopped by the length check
+    assert tree.subtrees([11]) == {11, 12}
+
+
+def test_load(tree):
+    rows = [(i, i * 100, 1, parent_id, accepted_id) for i, parent_id, accepted_id in TAXA]
+    with mock.patch.object(taxonomy_tree, 'iter_sql_from_jinja_string', return_value=iter(rows)):
+        loaded = TaxonomyTree.load(mock.MagicMock())
+    assert len(loaded) == len(tree) and loaded.descendants(3) == tree.descendants(3) and loaded.rank_id(7) == 1
@@ -0,0 +1,48 @@
+from unittest import mock
+
+import pytest
+
+import helpers
+
+
+class _FakeTime(object):
+    """ Clock advanced by sleep() only (the tests use rates whose waits are exact floats) """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_time():
+    clock = _FakeTime()
+    with mock.patch.object(helpers, 'time', clock):
+        yield clock
+
+
+def test_requests_are_spaced_at_the_rate_after_the_burst(fake_time):
+    bucket = helpers.TokenBucket(rate=4)
+    for _ in range(4):
+        bucket.acquire()
+    assert fake_time.now == 0
+
+    for _ in range(8):
+        bucket.acquire()
+    assert fake_time.now == pytest.approx(2.0)
+
+
+def test_idle_time_only_refills_up_to_the_capacity(fake_time):
+    bucket = helpers.TokenBucket(rate=2, capacity=3)
+    for _ in range(3):
+        bucket.acquire()
+    fake_time.now += 100
+
+    for _ in range(5):
+        bucket.acquire()
+    # 3 tokens available after the pause, then 2 per second
+    assert fake_time.now == pytest.approx(101.0)
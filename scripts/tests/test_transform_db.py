@@ -0,0 +1,32 @@
+import argparse
+import configparser
+from unittest import mock
+
+import pytest
+
+import transform_db
+
+
+def _run(**args):
+    arguments = argparse.Namespace(**dict({'resume': False, 'from_step': None, 'only_step': None, 'keep_data': False},
+                                          **args))
+    steps = [(step, message, mock.MagicMock()) for step, message, _ in transform_db.STEPS]
+    with mock.patch.object(transform_db, 'STEPS', steps), \
+            mock.patch.object(transform_db, '_load_run_state', return_value={}), \
+            mock.patch.object(transform_db, '_clear_run_state'), \
+            mock.patch.object(transform_db, '_start_step'), \
+            mock.patch.object(transform_db, '_complete_step'), \
+            mock.patch.object(transform_db, '_write_metrics'), \
+            mock.patch.object(transform_db, '_migrate_new_tables') as migrate_new_tables:
+        transform_db.run_transform_db(mock.MagicMock(), configparser.ConfigParser(), arguments)
+    return migrate_new_tables.called
+
+
+@pytest.mark.parametrize('args, migrated', [({}, False),
+                                            ({'keep_data': True}, True),
+                                            ({'from_step': '0'}, False),
+                                            ({'from_step': '4'}, True),
+                                            ({'only_step': '5'}, True),
+                                            ({'resume': True}, False)])
+def test_existing_tables_are_migrated_when_step_0_does_not_recreate_them(args, migrated):
+    assert _run(**args) is migrated
@@ -0,0 +1,71 @@
+import configparser
+import threading
+from unittest import mock
+
+import vernacular_names
+
+
+class _Cursor(list):
+    @property
+    def rowcount(self):
+        return len(self)
+
+
+def test_registry_is_not_queried_under_the_lock():
+    lock = threading.Lock()
+    ids_by_title, ids_by_key = {}, {'7ddf754f': 3}
+
+    def suggest(q):
+        assert not lock.locked()
+        return [{'key': '7ddf754f', 'title': q}]
+
+    with mock.patch.object(vernacular_names, 'gbif_dataset_suggest', side_effect=suggest) as gbif_dataset_suggest:
+        for _ in range(2):
+            assert vernacular_names._get_vernacularnamesource_id(None, 'Belgian Species List', ids_by_title,
+                                                                 ids_by_key, lock=lock) == 3
+    assert gbif_dataset_suggest.call_count == 1
+    assert ids_by_title == {'Belgian Species List': 3}
+
+
+def test_source_unknown_to_the_registry():
+    ids_by_title = {}
+    with mock.patch.object(vernacular_names, 'gbif_dataset_suggest', return_value=[]) as gbif_dataset_suggest, \
+            mock.patch.object(vernacular_names, '_insert_or_get_vernacularnamesource') as insert:
+        for _ in range(2):
+            assert vernacular_names._get_vernacularnamesource_id(None, 'Unknown checklist', ids_by_title, {}) is None
+    assert gbif_dataset_suggest.call_count == 1
+    insert.assert_not_called()
+
+
+def test_checkpoint_moves_forward_on_taxa_without_names():
+    config = configparser.ConfigParser()
+    config.read_dict({'vernacular_names': {'taxa-limit': '', 'commit-every-seconds': '0'}})
+    taxa = _Cursor([{'id': i, 'gbifId': 100 + i} for i in (1, 2, 3)])
+    checkpoints = []
+
+    with mock.patch.object(vernacular_names, 'execute_sql_from_jinja_string', return_value=taxa), \
+            mock.patch.object(vernacular_names, '_load_vernacularnamesources', return_value=({}, {})), \
+            mock.patch.object(vernacular_names, '_get_vernacular_names_gbif', return_value=[]), \
+            mock.patch.object(vernacular_names, '_insert_vernacular_names'):
+        vernacular_names.populate_vernacular_names(mock.MagicMock(), config, empty_only=True, filter_lang=['fr'],
+                                                   checkpoint=checkpoints.append)
+
+    assert checkpoints[:3] == [1, 2, 3]
+
+
+def test_skipped_taxa_are_not_processed(db_conn):
+    with db_conn.cursor() as cur:
+        cur.execute("""CREATE TABLE taxonomy ("id" integer PRIMARY KEY, "gbifId" integer)""")
+        cur.execute("""CREATE TABLE vernacularname ("taxonomyId" integer)""")
+        cur.execute("""INSERT INTO taxonomy VALUES (1, 101), (2, 102), (3, 103), (4, 104)""")
+        cur.execute("""INSERT INTO vernacularname VALUES (4)""")
+    config = configparser.ConfigParser()
+    config.read_dict({'vernacular_names': {'taxa-limit': ''}})
+    processed = []
+
+    with mock.patch.object(vernacular_names, '_load_vernacularnamesources', return_value=({}, {})), \
+            mock.patch.object(vernacular_names, '_get_vernacular_names_gbif',
+                              side_effect=lambda gbif_taxon_id, languages3: processed.append(gbif_taxon_id) or []):
+        vernacular_names.populate_vernacular_names(db_conn, config, empty_only=True, skip_ids={2, 42})
+
+    assert processed == [101, 103]
@@ -3,6 +3,23 @@
 
 # Before running this script, make sure you have a config.ini file in the current directory
 # You can start by copying config.ini.example to config.ini and change its content.
+#
+# The progress of the run is saved in the transform_db_run_state table: completed steps and, for the long running
+# steps (4 and 5), the id of the last processed row. Usage:
+#
+#   python transform_db.py                  # full run (drops and recreates the new tables)
+#   python transform_db.py --resume         # continue an interrupted run where it stopped
+#   python transform_db.py --from-step 5    # run steps 5, 6 and 7 only
+#   python transform_db.py --only-step 6    # run step 6 only
+#   python transform_db.py --keep-data      # non-destructive: keep the existing taxonomy/scientificname data, only
+#                                           # match unmatched names and load names for taxa without vernacular names
+#
+# --keep-data can be combined with the other options (use the same options when resuming a run).
+#
+# With [transform_db] pipeline = True in config.ini, steps 5 and 6 are processed during step 4, as taxa are matched
+# (see pipeline.py), when step 4 is run. With --keep-data or --resume, the taxa inserted before the run are processed
+# after the match, not concurrently (only the ones the pipeline didn't see).
+import argparse
 import os
 import logging
 
@@ -10,74 +27,247 @@ import deduplicate_taxon
 import gbif_match
 import vernacular_names
 import exotic_status
+import pipeline
 import populate_annex_scientificname
 
 
-from helpers import execute_sql_from_file, get_database_connection, get_config, setup_log_file
+from helpers import execute_sql_from_file, execute_sql_from_jinja_string, get_database_connection, get_config, \
+    setup_log_file, gbif_cache_stats_message, prepared_statements_stats_message
+from metrics import metrics, write_json_summary, write_prometheus_textfile
 
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
 LOG_FILE_PATH = "./logs/transform_db.log"
+METRICS_DEFAULT_JSON_FILE = "./logs/transform_db_metrics.json"
 ANNEX_FILE_PATH = os.path.join(__location__, "../data/raw/official_annexes.csv")
 ANNEX_FILE_PATH_DEMO = os.path.join(__location__, "../data/raw/official_annexes_demo.csv")
 
 # GBIF datasetKey of checklist: Global Register of Introduced and Invasive Species - Belgium
 GRIIS_DATASET_UUID = "6d9e952f-948c-4483-9807-575348147c7e"
 
-setup_log_file(LOG_FILE_PATH)
-conn = get_database_connection()
-config = get_config()
-# activate/deactivate demo mode
-demo = config.getboolean('demo_mode', 'demo')
+# list of 2-letters language codes (ISO 639-1) of the vernacular names
+VERNACULAR_NAMES_LANGUAGES = ['fr', 'nl', 'en']
 
-with conn:
-    message = "Prepare: Solve duplicates in taxon table"
-    print(message)
-    logging.info(message)
+
+def _prepare(conn, config, keep_data, after_id, checkpoint):
     deduplicate_taxon.deduplicate_taxon(conn, config_parser=config)
 
-    message = "Step 0: Drop our new tables if they already exists (idempotent script)"
-    print(message)
-    logging.info(message)
-    execute_sql_from_file(conn, 'drop_new_tables_if_exists.sql')
 
-    message = "Step 1: create the new tables"
-    print(message)
-    logging.info(message)
-    execute_sql_from_file(conn, 'create_new_tables.sql')
+def _drop_new_tables(conn, config, keep_data, after_id, checkpoint):
+    if keep_data:
+        print("Skipped (--keep-data)")
+    else:
+        execute_sql_from_file(conn, 'drop_new_tables_if_exists.sql')
 
-    message = "Step 2: populate the scientificname table based on the actual content"
-    print(message)
-    logging.info(message)
+
+def _create_new_tables(conn, config, keep_data, after_id, checkpoint):
+    if keep_data:
+        print("Skipped (--keep-data)")
+    else:
+        execute_sql_from_file(conn, 'create_new_tables.sql')
+
+
+def _populate_scientificname(conn, config, keep_data, after_id, checkpoint):
     execute_sql_from_file(conn, 'populate_scientificname.sql',
-                          {'limit': config.get('transform_db', 'scientificnames-limit')})
+                          {'limit': config.get('transform_db', 'scientificnames-limit'),
+                           'keep_existing': keep_data})
 
-    message = "Step 3: populate annexscientificname table based on official annexes"
-    print(message)
-    logging.info(message)
-    if demo:
+
+def _populate_annexscientificname(conn, config, keep_data, after_id, checkpoint):
+    if config.getboolean('demo_mode', 'demo'):
         annex_file = ANNEX_FILE_PATH_DEMO
     else:
         annex_file = ANNEX_FILE_PATH
+    # the table is entirely derived from the annex file: start again from scratch if it already has content (previous
+    # or interrupted run)
+    execute_sql_from_jinja_string(conn, """DELETE FROM annexscientificname""")
+    populate_annex_scientificname.populate_annex_scientificname(conn, config_parser=config, annex_file=annex_file)
 
-    populate_annex_scientificname.populate_annex_scientificname(conn, config_parser=config,
-                                                                annex_file=annex_file)
 
-    message = "Step 4: populate taxonomy table with matches to GBIF Backbone and related backbone tree " +\
-              "and update scientificname table"
-    print(message)
-    logging.info(message)
-    gbif_match.gbif_match(conn, config_parser=config, unmatched_only=False)
+def _gbif_match(conn, config, keep_data, after_id, checkpoint):
+    gbif_match.gbif_match(conn, config_parser=config, unmatched_only=keep_data, after_id=after_id,
+                          checkpoint=checkpoint)
+
+
+def _populate_vernacular_names(conn, config, keep_data, after_id, checkpoint):
+    vernacular_names.populate_vernacular_names(conn, config_parser=config, empty_only=keep_data,
+                                               filter_lang=VERNACULAR_NAMES_LANGUAGES, after_id=after_id,
+                                               checkpoint=checkpoint)
+
+
+def _populate_exotic_be(conn, config, keep_data, after_id, checkpoint):
+    exotic_status.populate_is_exotic_be_field(conn, config_parser=config, exotic_status_source=GRIIS_DATASET_UUID)
+
+
+def _create_indexes(conn, config, keep_data, after_id, checkpoint):
+    execute_sql_from_file(conn, 'create_indexes.sql')
+
+
+def _run_pipeline(conn, config, keep_data, after_id, checkpoint):
+    pipeline.run_pipeline(conn, config_parser=config, keep_data=keep_data, after_id=after_id, checkpoint=checkpoint,
+                          filter_lang=VERNACULAR_NAMES_LANGUAGES, exotic_status_source=GRIIS_DATASET_UUID)
+
+
+def _done_by_pipeline(conn, config, keep_data, after_id, checkpoint):
+    print("Skipped (done in step 4, pipeline mode)")
 
-    message = "Step 5: populate vernacular names from GBIF for each entry in the taxonomy table"
+
+# (step, message, function), in execution order
+STEPS = [
+    ('prepare', "Prepare: Solve duplicates in taxon table", _prepare),
+    ('0', "Step 0: Drop our new tables if they already exists (idempotent script)", _drop_new_tables),
+    ('1', "Step 1: create the new tables", _create_new_tables),
+    ('2', "Step 2: populate the scientificname table based on the actual content", _populate_scientificname),
+    ('3', "Step 3: populate annexscientificname table based on official annexes", _populate_annexscientificname),
+    ('4', "Step 4: populate taxonomy table with matches to GBIF Backbone and related backbone tree " +
+          "and update scientificname table", _gbif_match),
+    ('5', "Step 5: populate vernacular names from GBIF for each entry in the taxonomy table",
+     _populate_vernacular_names),
+    ('6', "Step 6: populate field exotic_be (values: True of False) from GRIIS checklist for each entry in " +
+          "taxonomy table ", _populate_exotic_be),
+    ('7', "Step 7: create the indexes of the new tables and update their statistics", _create_indexes)
+]
+STEP_IDS = [step for step, _, _ in STEPS]
+
+
+def _load_run_state(conn):
+    """ Returns a dict step -> row (as a dict) of transform_db_run_state """
+    execute_sql_from_file(conn, 'create_run_state_table.sql')
+    cur = execute_sql_from_jinja_string(conn, """SELECT * FROM transform_db_run_state""", dict_cursor=True)
+    return {row['step']: dict(row) for row in cur}
+
+
+def _clear_run_state(conn, steps):
+    execute_sql_from_jinja_string(conn, """DELETE FROM transform_db_run_state WHERE "step" IN {{ steps | inclause }}""",
+                                  context={'steps': tuple(steps)})
+
+
+def _start_step(conn, step):
+    execute_sql_from_jinja_string(conn, """INSERT INTO transform_db_run_state ("step", "started")
+                                           VALUES ({{ step }}, now())
+                                           ON CONFLICT ("step") DO UPDATE SET "started" = now(), "completed" = NULL""",
+                                  context={'step': step})
+
+
+def _checkpoint_step(conn, step, last_row_id):
+    # called by the steps just before each commit: saved in the same transaction as the processed rows
+    execute_sql_from_jinja_string(conn, """UPDATE transform_db_run_state SET "lastRowId" = {{ last_row_id }}
+                                           WHERE "step" = {{ step }}""",
+                                  context={'step': step, 'last_row_id': last_row_id})
+
+
+def _complete_step(conn, step):
+    execute_sql_from_jinja_string(conn, """UPDATE transform_db_run_state SET "completed" = now()
+                                           WHERE "step" = {{ step }}""",
+                                  context={'step': step})
+
+
+def _migrate_new_tables(conn):
+    """ Bring the new tables of an existing database up to date (see migrate_new_tables.sql) """
+    execute_sql_from_file(conn, 'migrate_new_tables.sql')
+
+
+def _steps_to_run(args, run_state):
+    """ Returns a list of (step, after_id) tuples """
+    if args.only_step is not None:
+        return [(args.only_step, None)]
+    if args.from_step is not None:
+        return [(step, None) for step in STEP_IDS[STEP_IDS.index(args.from_step):]]
+    if args.resume:
+        steps = []
+        for step in STEP_IDS:
+            state = run_state.get(step)
+            if state is not None and state['completed'] is not None:
+                continue
+            # the first unfinished step restarts after its last checkpoint (if any), the next ones from scratch
+            after_id = state['lastRowId'] if state is not None and not steps else None
+            steps.append((step, after_id))
+        return steps
+    return [(step, None) for step in STEP_IDS]
+
+
+def _write_metrics(config):
+    json_file = config.get('metrics', 'json-file', fallback=METRICS_DEFAULT_JSON_FILE)
+    if json_file:
+        write_json_summary(os.path.join(__location__, json_file))
+        message = f"Metrics saved in {json_file}"
+        print(message)
+        logging.info(message)
+    prometheus_textfile = config.get('metrics', 'prometheus-textfile', fallback='')
+    if prometheus_textfile:
+        write_prometheus_textfile(os.path.join(__location__, prometheus_textfile))
+
+    for statement in metrics.summary()['statements'][:5]:
+        message = f"Step {statement['step']}: {statement['calls']} x {statement['statement']} " \
+                  f"({round(statement['seconds']['sum'], 2)}s)"
+        print(message)
+        logging.info(message)
+
+
+def run_transform_db(conn, config, args):
+    run_state = _load_run_state(conn)
+    steps_to_run = _steps_to_run(args, run_state)
+    if not steps_to_run:
+        message = "All steps are already completed, nothing to resume."
+        print(message)
+        logging.info(message)
+        return
+
+    # forget the previous progress of the steps we're about to (re)run, except the checkpoint we resume from
+    _clear_run_state(conn, [step for step, after_id in steps_to_run if after_id is None])
+    # the tables are kept when step 0 isn't run (--resume, --from-step, --only-step) or skipped (--keep-data)
+    if args.keep_data or '0' not in [step for step, _ in steps_to_run]:
+        _migrate_new_tables(conn)
+
+    steps = {step: (message, function) for step, message, function in STEPS}
+    if config.getboolean('transform_db', 'pipeline', fallback=False) and '4' in [s for s, _ in steps_to_run]:
+        steps['4'] = (steps['4'][0] + " (pipeline mode: with steps 5 and 6)", _run_pipeline)
+        steps['5'] = (steps['5'][0], _done_by_pipeline)
+        steps['6'] = (steps['6'][0], _done_by_pipeline)
+    try:
+        for step, after_id in steps_to_run:
+            message, function = steps[step]
+            if after_id is not None:
+                message += f" (resumed after row id {after_id})"
+            print(message)
+            logging.info(message)
+
+            _start_step(conn, step)
+            with metrics.step(step):
+                function(conn, config, keep_data=args.keep_data, after_id=after_id,
+                         checkpoint=lambda last_row_id, step=step: _checkpoint_step(conn, step, last_row_id))
+            _complete_step(conn, step)
+    finally:
+        # also written if a step failed: the metrics show where the time was spent until then
+        _write_metrics(config)
+
+    message = gbif_cache_stats_message()
     print(message)
     logging.info(message)
-    # list of 2-letters language codes (ISO 639-1)
-    languages = ['fr', 'nl', 'en']
-    vernacular_names.populate_vernacular_names(conn, config_parser=config, empty_only=False, filter_lang=languages)
 
-    message = "Step 6: populate field exotic_be (values: True of False) from GRIIS checklist for each entry in " \
-              "taxonomy table "
+    message = prepared_statements_stats_message()
     print(message)
     logging.info(message)
-    exotic_status.populate_is_exotic_be_field(conn, config_parser=config, exotic_status_source=GRIIS_DATASET_UUID)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transform the BIM database to the new version")
+    steps_selection = parser.add_mutually_exclusive_group()
+    steps_selection.add_argument('--resume', action='store_true',
+                                 help="continue the last run: skip the completed steps, restart the interrupted one "
+                                      "after its last checkpoint")
+    steps_selection.add_argument('--from-step', choices=STEP_IDS, help="run this step and the following ones")
+    steps_selection.add_argument('--only-step', choices=STEP_IDS, help="run this step only")
+    parser.add_argument('--keep-data', action='store_true',
+                        help="non-destructive mode: keep the existing taxonomy/scientificname data (tables are not "
+                             "dropped, only unmatched names are matched and only taxa without vernacular names are "
+                             "processed). In pipeline mode, the taxa already in taxonomy are processed after the "
+                             "match, not concurrently")
+    arguments = parser.parse_args()
+
+    setup_log_file(LOG_FILE_PATH)
+    connection = get_database_connection()
+    config = get_config()
+
+    with connection:
+        run_transform_db(connection, config, arguments)
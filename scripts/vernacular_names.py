@@ -1,10 +1,13 @@
+import contextlib
 import logging
 import time
 from pycountry import languages as pylang
-from pygbif import registry
 
 from helpers import execute_sql_from_jinja_string, get_database_connection, setup_log_file, get_config, \
-    paginated_name_usage
+    iter_name_usage, gbif_dataset_suggest, batch_transaction, execute_values_sql, \
+    log_verbose, ProgressReporter
+
+DEFAULT_INSERT_BATCH_SIZE = 1000
 
 
 def _iso639_1_to_2_dict(lang):
@@ -43,12 +46,12 @@ def _get_vernacular_names_gbif(gbif_taxon_id, languages3=None):
     #  {'taxonKey': 5, 'vernacularName': 'schimmels', 'language': 'nld', 'country': 'BE',
     #   'source': 'Belgian Species List', 'sourceTaxonKey': 100489794}]
 
-    names_data = paginated_name_usage(key=gbif_taxon_id, data="vernacularNames")
+    names_data = iter_name_usage(key=gbif_taxon_id, data="vernacularNames")
 
     if languages3 is not None:
-        names_data = [nd for nd in names_data if nd['language'] in languages3]
+        return [nd for nd in names_data if nd['language'] in languages3]
 
-    return names_data
+    return list(names_data)
 
 
 def _insert_or_get_vernacularnamesource(conn, uuid, title):
@@ -77,19 +80,124 @@ def _insert_or_get_vernacularnamesource(conn, uuid, title):
     return cur.fetchone()['id']
 
 
-def populate_vernacular_names(conn, config_parser, empty_only, filter_lang=None):
+def _load_vernacularnamesources(conn):
+    """ Returns a dict datasetTitle -> id and a dict datasetKey -> id, with the content of vernacularnamesource """
+    ids_by_title = {}
+    ids_by_key = {}
+    cur = execute_sql_from_jinja_string(conn, """SELECT "id", "datasetKey", "datasetTitle" FROM vernacularnamesource""",
+                                        dict_cursor=True)
+    for source in cur:
+        ids_by_title[source['datasetTitle']] = source['id']
+        ids_by_key[source['datasetKey']] = source['id']
+    return ids_by_title, ids_by_key
+
+
+def _get_vernacularnamesource_id(conn, dataset_title, ids_by_title, ids_by_key, lock=None):
+    """ Returns the id of the vernacularnamesource with the given title (None if the GBIF registry doesn't know it)
+
+    ids_by_title and ids_by_key are the run-scoped caches (see _load_vernacularnamesources), kept up to date: the GBIF
+    registry is asked once per title (or a few times, if threads look up the same new title at the same time), and the
+    vernacularnamesource table once per new source. lock (optional) protects the caches when they are shared by
+    multiple threads: it is only held while the caches are read or written, not during the registry and database
+    queries. """
+    cache_lock = lock if lock is not None else contextlib.nullcontext()
+    with cache_lock:
+        if dataset_title in ids_by_title:
+            return ids_by_title[dataset_title]
+
+    dataset = gbif_dataset_suggest(q=dataset_title)
+    if not dataset:
+        msg = f"Warning: no GBIF dataset found for the vernacular names source '{dataset_title}', its names are " \
+              f"saved without source."
+        print(msg)
+        logging.warning(msg)
+        with cache_lock:
+            ids_by_title[dataset_title] = None
+        return None
+
+    datasetKey = dataset[0]['key']
+    with cache_lock:
+        source_id = ids_by_key.get(datasetKey)
+    if source_id is None:
+        source_id = _insert_or_get_vernacularnamesource(conn=conn, uuid=datasetKey, title=dataset_title)
+    with cache_lock:
+        ids_by_key.setdefault(datasetKey, source_id)
+        ids_by_title[dataset_title] = ids_by_key[datasetKey]
+        return ids_by_title[dataset_title]
+
+
+def _language_codes(filter_lang):
+    """ Returns a (languages3, filter_lang_dict) tuple for filter_lang (list of 2-letters codes, or None): the list of
+    3-letters codes to keep (see _get_vernacular_names_gbif) and the dict 3-letters -> 2-letters codes """
+    if filter_lang is None:
+        return None, None
+    filter_lang_dict = _iso639_1_to_2_dict(filter_lang)
+    return list(filter_lang_dict.keys()), filter_lang_dict
+
+
+def _vernacular_names_of_taxon(conn, taxon, languages3, filter_lang_dict, ids_by_title, ids_by_key, lock=None):
+    """ Get the vernacular names of a taxonomy row from GBIF
+
+    Returns a list of (taxonomyId, language, name, source) tuples (see _insert_vernacular_names) and the number of
+    names without source """
+    taxonomy_id = taxon['id']
+    vernacular_names = []
+    no_source_counter = 0
+    for vernacular_name in _get_vernacular_names_gbif(taxon['gbifId'], languages3=languages3):
+        name = vernacular_name.get('vernacularName')
+        lang_code = filter_lang_dict[vernacular_name.get('language')]
+        dataset_title = vernacular_name.get('source')
+        if dataset_title is None:
+            log_verbose(f"Warning: vernacular name {name} for taxon with ID: {taxonomy_id} without source.")
+            no_source_counter += 1
+            dataset_id = None
+        else:
+            dataset_id = _get_vernacularnamesource_id(conn, dataset_title, ids_by_title, ids_by_key, lock=lock)
+
+        log_verbose(f"Now saving '{name}'({lang_code}) for taxon with ID: {taxonomy_id} (source: {dataset_title})")
+        vernacular_names.append((taxonomy_id, lang_code, name, dataset_id))
+    return vernacular_names, no_source_counter
+
+
+def _insert_vernacular_names(conn, vernacular_names):
+    # vernacular_names: list of (taxonomyId, language, name, source) tuples, inserted by multi-row INSERTs
+    if vernacular_names:
+        execute_values_sql(conn,
+                           """INSERT INTO vernacularname("taxonomyId", "language", "name", "source") VALUES %s""",
+                           vernacular_names,
+                           page_size=len(vernacular_names))
+
+
+def populate_vernacular_names(conn, config_parser, empty_only, filter_lang=None, after_id=None, checkpoint=None,
+                              skip_ids=None):
     # If empty only, only process the taxa currently without vernacular names
     # Otherwise, process all entries in the taxonomy table
     # filter_lang is a list of language codes (ISO 639-1 Code) (default: no filtering)
+    # Taxa are processed by increasing id. after_id (optional): only process the taxa with a greater id (to resume an
+    # interrupted run). checkpoint (optional): called with the id of the last saved taxon just before each commit, in
+    # the same transaction
+    # skip_ids (optional): ids of taxa not to process (e.g. already processed by the pipeline, see pipeline.py)
+    if skip_ids:
+        # joined as a temporary table rather than a giant NOT IN (...) list
+        execute_sql_from_jinja_string(conn, """CREATE TEMPORARY TABLE IF NOT EXISTS skipped_taxon ("id" integer PRIMARY KEY)""")
+        execute_sql_from_jinja_string(conn, """TRUNCATE skipped_taxon""")
+        execute_values_sql(conn, """INSERT INTO skipped_taxon ("id") VALUES %s""",
+                           [(taxon_id,) for taxon_id in sorted(skip_ids)])
+        execute_sql_from_jinja_string(conn, """ANALYZE skipped_taxon""")
+
     if empty_only:
         taxa_selection_sql = """SELECT *
                                 FROM taxonomy
-                                WHERE NOT EXISTS (SELECT vernacularname."taxonomyId" FROM vernacularname WHERE taxonomy.id = vernacularname."taxonomyId") {% if limit %} LIMIT {{ limit }} {% endif %}"""
+                                WHERE NOT EXISTS (SELECT vernacularname."taxonomyId" FROM vernacularname WHERE taxonomy.id = vernacularname."taxonomyId") {% if after_id %} AND id > {{ after_id }} {% endif %} {% if skip_ids %} AND NOT EXISTS (SELECT 1 FROM skipped_taxon WHERE skipped_taxon.id = taxonomy.id) {% endif %} ORDER BY id {% if limit %} LIMIT {{ limit }} {% endif %}"""
     else:
-        taxa_selection_sql = """SELECT * FROM taxonomy {% if limit %} LIMIT {{ limit }} {% endif %}"""
+        taxa_selection_sql = """SELECT * FROM taxonomy WHERE TRUE {% if after_id %} AND id > {{ after_id }} {% endif %} {% if skip_ids %} AND NOT EXISTS (SELECT 1 FROM skipped_taxon WHERE skipped_taxon.id = taxonomy.id) {% endif %} ORDER BY id {% if limit %} LIMIT {{ limit }} {% endif %}"""
 
     limit = config_parser.get('vernacular_names', 'taxa-limit')
-    cur = execute_sql_from_jinja_string(conn, sql_string=taxa_selection_sql, context={'limit': limit}, dict_cursor=True)
+    cur = execute_sql_from_jinja_string(conn, sql_string=taxa_selection_sql,
+                                        context={'limit': limit, 'after_id': after_id, 'skip_ids': bool(skip_ids)},
+                                        dict_cursor=True)
+    if skip_ids:
+        execute_sql_from_jinja_string(conn, """DROP TABLE skipped_taxon""")
 
     msg = f"We'll now load vernacular names for {cur.rowcount} entries in the taxonomy table. Languages: "
     if filter_lang is not None:
@@ -97,60 +205,62 @@ def populate_vernacular_names(conn, config_parser, empty_only, filter_lang=None)
     print(msg)
     logging.info(msg)
 
-    # Create dictionary mapping 3-letter codes (as stored in GBIF) and 2-letter codes
-    if filter_lang is not None:
-        filter_lang_dict = _iso639_1_to_2_dict(filter_lang)
-    else:
-        filter_lang_dict = None
+    # 3-letter codes (as stored in GBIF) and mapping to 2-letter codes
+    languages3, filter_lang_dict = _language_codes(filter_lang)
 
-    # Get list of 3-letters format languages
-    languages3 = None
-    if filter_lang_dict is not None:
-        languages3 = list(filter_lang_dict.keys())
+    # run-scoped cache of the vernacular name sources
+    ids_by_title, ids_by_key = _load_vernacularnamesources(conn)
+    # names are buffered and inserted by batches
+    insert_batch_size = config_parser.getint('vernacular_names', 'insert-batch-size',
+                                             fallback=DEFAULT_INSERT_BATCH_SIZE)
+    vernacular_names_buffer = []
 
     total_vernacularnames_counter = 0
     total_taxa_counter = 0
+    no_source_counter = 0
     start_time = time.time()
 
-    for taxon in cur:
-        taxonomy_id = taxon['id']
-        gbif_taxon_id = taxon['gbifId']
-
-        total_taxa_counter += 1
-
-        vns = _get_vernacular_names_gbif(gbif_taxon_id, languages3=languages3)
-        datasets = {}
-        for vernacular_name in vns:
-            name = vernacular_name.get('vernacularName')
-            lang_code = filter_lang_dict[vernacular_name.get('language')]
-            dataset_title = vernacular_name.get('source')
-            if dataset_title is None:
-                print(f"Warning: vernacular name {name} for taxon with ID: {taxonomy_id} without source. Contact GBIF: https://github.com/gbif/gbif-api/issues/56")
-                datasets[dataset_title] = None
-            else:
-                if dataset_title not in datasets.keys():
-                    dataset = registry.dataset_suggest(dataset_title)
-                    datasetKey = dataset[0]['key']
-                    datasets[dataset_title] = datasetKey
-            datasetKey = datasets[dataset_title]
-            dataset_id = _insert_or_get_vernacularnamesource(conn= conn, uuid=datasetKey, title=dataset_title)
-
-            msg = f"Now saving '{name}'({lang_code}) for taxon with ID: {taxonomy_id} (source: {dataset_title})"
-            print(msg)
-            logging.info(msg)
-
-            insert_template = """INSERT INTO vernacularname("taxonomyId", "language", "name", "source") VALUES ({{ taxonomy_id}}, {{ lang_code }}, {{ name }}, {{ source }})"""
-            execute_sql_from_jinja_string(conn, sql_string=insert_template, context={'taxonomy_id': taxonomy_id,
-                                                                                     'lang_code': lang_code,
-                                                                                     'name': name,
-                                                                                     'source': dataset_id})
-            total_vernacularnames_counter += 1
+    # id of the last processed taxon, saved by checkpoint with each batch (with the names still in the buffer)
+    last_taxonomy_id = None
+
+    def _checkpoint():
+        _insert_vernacular_names(conn, vernacular_names_buffer)
+        vernacular_names_buffer.clear()
+        if checkpoint is not None and last_taxonomy_id is not None:
+            checkpoint(last_taxonomy_id)
+
+    # writes are committed by batches (see commit-every-rows and commit-every-seconds)
+    progress = ProgressReporter("Load vernacular names", total=cur.rowcount)
+    with batch_transaction(conn, config_parser, 'vernacular_names', before_commit=_checkpoint) as transaction:
+        for taxon in cur:
+            taxonomy_id = taxon['id']
+            total_taxa_counter += 1
+
+            vernacular_names, n_without_source = _vernacular_names_of_taxon(conn, taxon, languages3, filter_lang_dict,
+                                                                            ids_by_title, ids_by_key)
+            vernacular_names_buffer += vernacular_names
+            total_vernacularnames_counter += len(vernacular_names)
+            no_source_counter += n_without_source
+            last_taxonomy_id = taxonomy_id
+
+            if len(vernacular_names_buffer) >= insert_batch_size:
+                _insert_vernacular_names(conn, vernacular_names_buffer)
+                vernacular_names_buffer.clear()
+            # called for each taxon (even without names), so that commit-every-seconds also moves the checkpoint
+            # forward on the taxa without vernacular names
+            transaction.row_done(len(vernacular_names))
+            progress.update()
+    progress.close()
 
     end_time = time.time()
 
     msg = f"Done loading {total_vernacularnames_counter} (for {total_taxa_counter} taxa) vernacular names in {round(end_time - start_time)}s."
     print(msg)
     logging.info(msg)
+    if no_source_counter > 0:
+        msg = f"Warning: {no_source_counter} vernacular names without source. Contact GBIF: https://github.com/gbif/gbif-api/issues/56"
+        print(msg)
+        logging.warning(msg)
 
 
 if __name__ == "__main__":